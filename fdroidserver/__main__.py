@@ -82,12 +82,14 @@ COMMANDS_INTERNAL = [
     "execute_sudo",
     "fetch_repo",
     "fetch_srclibs",
+    "gc_git_objects",
     "install_ndk",
     "make_source_tarball",
     "prepare_source",
     "pull",
     "pull_verify",
     "push",
+    "run_buildcycle",
     "schedule_buildcycle",
     "schedule_verify",
     "send_buildcycle",
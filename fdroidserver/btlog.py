@@ -34,11 +34,12 @@ import logging
 import os
 import shutil
 import tempfile
+import xml.sax.handler
 import zipfile
 from argparse import ArgumentParser
 from typing import Optional
 
-import defusedxml.minidom
+import defusedxml.sax
 import git
 import requests
 
@@ -46,6 +47,121 @@ from . import _, common, deploy
 from .exception import FDroidException
 
 
+def _escape_xml(text):
+    """Escape text and attribute values the same way as minidom."""
+    return (
+        text.replace('&', '&amp;')
+        .replace('<', '&lt;')
+        .replace('"', '&quot;')
+        .replace('>', '&gt;')
+    )
+
+
+class _PrettyXMLWriter(xml.sax.handler.ContentHandler):
+    """Format XML the same as minidom's toprettyxml(), while parsing it.
+
+    This needs no DOM tree, only the text since the last tag and
+    whether each open element had child elements yet.
+
+    """
+
+    def __init__(self, fp):
+        super().__init__()
+        self.fp = fp
+        self.stack = []  # [tag name, has child elements, text]
+
+    def _flush_text(self, element):
+        if element[2]:
+            indent = '\t' * len(self.stack)
+            self.fp.write(_escape_xml(indent + element[2] + '\n').encode('utf-8'))
+            element[2] = ''
+
+    def startDocument(self):
+        self.fp.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+
+    def startElement(self, name, attrs):
+        if self.stack:
+            parent = self.stack[-1]
+            if not parent[1]:
+                parent[1] = True
+                self.fp.write(b'>\n')
+            self._flush_text(parent)
+        tag = '\t' * len(self.stack) + '<' + name
+        for k, v in attrs.items():
+            tag += ' %s="%s"' % (k, _escape_xml(v))
+        self.fp.write(tag.encode('utf-8'))
+        self.stack.append([name, False, ''])
+
+    def characters(self, content):
+        self.stack[-1][2] += content
+
+    def endElement(self, name):
+        element = self.stack[-1]
+        if element[1]:
+            self._flush_text(element)
+            self.stack.pop()
+            end = '\t' * len(self.stack) + '</%s>\n' % name
+        else:
+            self.stack.pop()
+            if element[2]:
+                end = '>%s</%s>\n' % (_escape_xml(element[2]), name)
+            else:
+                end = '/>\n'
+        self.fp.write(end.encode('utf-8'))
+
+
+def _get_filesystemlog_state_path(repodir):
+    return os.path.join(
+        'tmp', 'manifests', 'btlog', repodir.replace('/', '_') + '.json'
+    )
+
+
+def _stat_file(path):
+    stat = os.stat(path)
+    return [
+        stat.st_size,
+        stat.st_ctime_ns,
+        stat.st_mtime_ns,
+        stat.st_mode,
+        stat.st_uid,
+        stat.st_gid,
+    ]
+
+
+def _make_filesystemlog(repodir, fslogfile):
+    """Return the size, times, mode and owner of all files in repodir.
+
+    If `fdroid update` wrote a manifest of repodir, then only the
+    files that changed since the last run are stat'ed, the rest comes
+    from the last filesystemlog.json.
+
+    """
+    state_path = _get_filesystemlog_state_path(repodir)
+    manifest = common.load_repo_manifest(common.get_repo_manifest_path(repodir))
+    previous = common.load_repo_manifest(state_path)
+    output = None
+    if os.path.exists(fslogfile):
+        with open(fslogfile) as fp:
+            output = json.load(fp)
+    if manifest is None or previous is None or output is None:
+        output = dict()
+        for root, dirs, files in os.walk(repodir):
+            for f in files:
+                repofile = os.path.join(root, f)
+                output[os.path.relpath(repofile, repodir)] = _stat_file(repofile)
+    else:
+        for f in set(previous) - set(manifest):
+            output.pop(f, None)
+        for f, entry in manifest.items():
+            if entry != previous.get(f) or f not in output:
+                repofile = os.path.join(repodir, f)
+                if not os.path.isdir(repofile):
+                    output[f] = _stat_file(repofile)
+    if manifest is not None:
+        common.write_repo_manifest(state_path, manifest)
+    return collections.OrderedDict(sorted(output.items()))
+
+
 def make_binary_transparency_log(
     repodirs: collections.abc.Iterable,
     btrepo: str = 'binary_transparency',
@@ -109,14 +225,13 @@ For more info on this idea:
             if not os.path.exists(repof):
                 continue
             dest = os.path.join(cpdir, f)
+            with open(repof, 'rb') as fp:
+                data = fp.read()
             if f.endswith('.xml'):
-                doc = defusedxml.minidom.parse(repof)
-                output = doc.toprettyxml(encoding='utf-8')
-                with open(dest, 'wb') as f:
-                    f.write(output)
+                with open(dest, 'wb') as fp:
+                    defusedxml.sax.parseString(data, _PrettyXMLWriter(fp))
             elif f.endswith('.json'):
-                with open(repof) as fp:
-                    output = json.load(fp, object_pairs_hook=collections.OrderedDict)
+                output = json.loads(data, object_pairs_hook=collections.OrderedDict)
                 with open(dest, 'w') as fp:
                     json.dump(output, fp, indent=2)
             gitrepo.index.add([repof])
@@ -125,6 +240,10 @@ For more info on this idea:
             if not os.path.exists(repof):
                 continue
             dest = os.path.join(cpdir, f)
+            if os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(
+                repof
+            ):
+                continue  # the signature did not change since the last run
             jarin = zipfile.ZipFile(repof, 'r')
             jarout = zipfile.ZipFile(dest, 'w')
             for info in jarin.infolist():
@@ -134,23 +253,8 @@ For more info on this idea:
             jarin.close()
             gitrepo.index.add([repof])
 
-        output_files = []
-        for root, dirs, files in os.walk(repodir):
-            for f in files:
-                output_files.append(os.path.relpath(os.path.join(root, f), repodir))
-        output = collections.OrderedDict()
-        for f in sorted(output_files):
-            repofile = os.path.join(repodir, f)
-            stat = os.stat(repofile)
-            output[f] = (
-                stat.st_size,
-                stat.st_ctime_ns,
-                stat.st_mtime_ns,
-                stat.st_mode,
-                stat.st_uid,
-                stat.st_gid,
-            )
         fslogfile = os.path.join(cpdir, 'filesystemlog.json')
+        output = _make_filesystemlog(repodir, fslogfile)
         with open(fslogfile, 'w') as fp:
             json.dump(output, fp, indent=2)
         gitrepo.index.add([os.path.join(repodir, 'filesystemlog.json')])
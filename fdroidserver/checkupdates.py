@@ -21,16 +21,21 @@
 
 import configparser
 import copy
+import hashlib
+import json
 import logging
 import os
 import re
 import subprocess
 import sys
+import tempfile
+import threading
 import traceback
 import urllib.error
 import urllib.parse
-import urllib.request
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional
 
@@ -47,6 +52,113 @@ from .exception import (
 # https://gitlab.com/fdroid/checkupdates-runner/-/blob/1861899262a62a4ed08fa24e5449c0368dfb7617/.gitlab-ci.yml#L36
 BOT_EMAIL = 'fdroidci@bubu1.eu'
 
+# the refs of each app's source repo and what was found at the last check
+REFS_CACHE_DIR = Path('tmp') / 'checkupdates-refs'
+
+# the pages of the HTTP update checks, with their ETag/Last-Modified
+HTTP_CACHE_DIR = Path('tmp') / 'checkupdates-http'
+
+# with --jobs, how many apps may fetch from the same host at once
+MAX_CONNECTIONS_PER_HOST = 4
+
+_locks = dict()
+_locks_lock = threading.Lock()
+
+
+def _get_host(url: str) -> str:
+    """Get the hostname of a URL, including scp-like git URLs."""
+    parsed = urllib.parse.urlparse(url or '')
+    if parsed.hostname:
+        return parsed.hostname
+    m = re.match(r'^[^@/]+@([^:/]+):', url or '')
+    return m.group(1) if m else url
+
+
+def _get_lock(key, factory):
+    with _locks_lock:
+        if key not in _locks:
+            _locks[key] = factory()
+        return _locks[key]
+
+
+@contextmanager
+def _host_slot(url: str):
+    """Limit the concurrent connections to the host of url."""
+    host = _get_host(url)
+    with _get_lock(('host', host), lambda: threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)):
+        yield
+
+
+@contextmanager
+def _source_slot(app: metadata.App):
+    """Get exclusive use of the app's build dir and a connection to its source host.
+
+    Apps using the same srclib share a build dir, so they must not be
+    checked at the same time.
+    """
+    build_dir = str(common.get_build_dir(app))
+    with _get_lock(('build_dir', build_dir), threading.Lock), _host_slot(app.Repo):
+        yield
+
+
+class HttpCache:
+    """Cache the pages of the HTTP update checks.
+
+    Each URL is only requested once per run, even when many apps use
+    it.  If cachedir is given, the pages are also stored there with
+    their ETag and Last-Modified headers, so the next run can send a
+    conditional request and the server only has to answer "304 Not
+    Modified".  All requests go through the shared keep-alive session.
+    """
+
+    def __init__(self, cachedir: Optional[Path] = None):
+        self.cachedir = cachedir
+        self.pages = dict()
+
+    def _get_cache_path(self, url: str) -> Path:
+        return self.cachedir / (hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def get(self, url: str) -> str:
+        """Get the page at url as a str."""
+        with _get_lock(('url', url), threading.Lock):
+            if url in self.pages:
+                return self.pages[url]
+
+            cached = dict()
+            if self.cachedir:
+                try:
+                    with open(self._get_cache_path(url)) as fp:
+                        cached = json.load(fp)
+                except (OSError, ValueError):
+                    pass
+            headers = dict(net.HEADERS)
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('lastModified'):
+                headers['If-Modified-Since'] = cached['lastModified']
+
+            logging.debug("...requesting {0}".format(url))
+            with _host_slot(url):
+                r = net.get_session().get(url, headers=headers, timeout=20)
+            if r.status_code == 304 and 'page' in cached:
+                page = cached['page']
+            else:
+                r.raise_for_status()
+                page = r.content.decode('utf-8')
+                if self.cachedir and ('ETag' in r.headers or 'Last-Modified' in r.headers):
+                    path = self._get_cache_path(url)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    data = {'etag': r.headers.get('ETag'), 'lastModified': r.headers.get('Last-Modified'),
+                            'page': page}
+                    path.with_suffix('.tmp').write_text(json.dumps(data))
+                    os.replace(path.with_suffix('.tmp'), path)
+            self.pages[url] = page
+            return page
+
+
+# set by main() to share the pages between all apps of a run
+http_cache = None
+
 
 def check_http(app: metadata.App) -> tuple[Optional[str], Optional[int]]:
     """Check for a new version by looking at a document retrieved via HTTP.
@@ -86,34 +198,80 @@ def check_http(app: metadata.App) -> tuple[Optional[str], Optional[int]]:
         if not parsed.netloc or not parsed.scheme or parsed.scheme != 'https':
             raise FDroidException(_('UpdateCheckData has invalid URL: {url}').format(url=urlver))
 
-    logging.debug("...requesting {0}".format(urlcode))
-    req = urllib.request.Request(urlcode, None, headers=net.HEADERS)
-    resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
-    page = resp.read().decode('utf-8')
+    cache = http_cache or HttpCache()
+    page = cache.get(urlcode)
 
-    m = re.search(codeex, page)
+    m = common.compile_regex(codeex).search(page)
     if not m:
         raise FDroidException("No RE match for versionCode")
     vercode = common.version_code_string_to_int(m.group(1).strip())
 
     if urlver != '.':
-        logging.debug("...requesting {0}".format(urlver))
-        req = urllib.request.Request(urlver, None)
-        resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
-        page = resp.read().decode('utf-8')
+        page = cache.get(urlver)
 
-    m = re.search(verex, page)
+    m = common.compile_regex(verex).search(page)
     if not m:
         raise FDroidException("No RE match for version")
     version = m.group(1)
 
-    if app.UpdateCheckIgnore and re.search(app.UpdateCheckIgnore, version):
+    if app.UpdateCheckIgnore and common.compile_regex(app.UpdateCheckIgnore).search(version):
         logging.info("Version {version} for {appid} is ignored".format(version=version, appid=app.id))
         return (None, None)
 
     return (version, vercode)
 
 
+# the files in which check_tags() looks for the version
+VERSION_FILE_NAMES = (
+    'AndroidManifest.xml', 'pom.xml', 'build.gradle', 'build-extras.gradle', 'build.gradle.kts'
+)
+
+
+def _is_version_file(path: str) -> bool:
+    """Check whether path is a manifest or a string resource that can hold a version."""
+    p = Path(path)
+    return p.name in VERSION_FILE_NAMES or (p.parent.name == 'values' and p.suffix == '.xml')
+
+
+def get_tag_source_tree(app: metadata.App, vcs: common.vcs, tag: str, tmpdir: Path) -> Path:
+    """Get a directory with the files of tag that are needed to find the version.
+
+    Checking out each tag is slow for big repos, so the needed files are
+    read straight from the git objects into tmpdir, without touching the
+    worktree.  Only if the last build uses submodules, the tag is checked
+    out in the build dir.
+
+    Parameters
+    ----------
+    app
+        The App instance to check for updates for.
+    vcs
+        The VCS instance of the app's source repo.
+    tag
+        The tag to get the files of.
+    tmpdir
+        Where to write the files, unless the tag is checked out.
+
+    Returns
+    -------
+    tree_dir
+        The directory with the source files of tag.
+    """
+    last_build = get_last_build_from_app(app)
+    if last_build.submodules:
+        vcs.deinitsubmodules()
+        vcs.gotorevision(tag)
+        try_init_submodules(app, last_build, vcs)
+        return Path(vcs.local)
+
+    extra = set()
+    if app.UpdateCheckData:
+        filecode, codeex, filever, verex = app.UpdateCheckData.split('|')
+        extra = {os.path.normpath(f) for f in (filecode, filever) if f and f != '.'}
+    vcs.extractfiles(tag, tmpdir, lambda path: path in extra or _is_version_file(path))
+    return tmpdir
+
+
 def check_tags(app: metadata.App, pattern: str) -> tuple[str, int, str]:
     """Check for a new version by looking at the tags in the source repo.
 
@@ -171,93 +329,91 @@ def check_tags(app: metadata.App, pattern: str) -> tuple[str, int, str]:
 
     tags = []
     if repotype == 'git':
-        tags = vcs.latesttags()
+        tags = vcs.latesttags(pattern, 5)
+        if not tags:
+            raise FDroidException(_('No matching tags found') if pattern else _('No tags found'))
+        logging.debug("Latest tags: " + ','.join(tags))
     else:
         tags = vcs.gettags()
-    if not tags:
-        raise FDroidException(_('No tags found'))
-
-    logging.debug("All tags: " + ','.join(tags))
-    if pattern:
-        pat = re.compile(pattern)
-        tags = [tag for tag in tags if pat.match(tag)]
         if not tags:
-            raise FDroidException(_('No matching tags found'))
-        logging.debug("Matching tags: " + ','.join(tags))
-
-    if len(tags) > 5 and repotype == 'git':
-        tags = tags[:5]
-        logging.debug("Latest tags: " + ','.join(tags))
-
-    for tag in tags:
-        logging.debug("Check tag: '{0}'".format(tag))
-        vcs.deinitsubmodules()
-        vcs.gotorevision(tag)
-        try_init_submodules(app, last_build, vcs)
-
-        if app.UpdateCheckData:
-            filecode, codeex, filever, verex = app.UpdateCheckData.split('|')
-
-            if filecode:
-                filecode = build_dir / filecode
-                if not filecode.is_file():
-                    logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filecode, tag))
-                    continue
-                filecontent = filecode.read_text()
-            else:
-                filecontent = tag
-
-            vercode = tag
-            if codeex:
-                m = re.search(codeex, filecontent)
-                if not m:
-                    logging.debug(f"UpdateCheckData regex {codeex} for versionCode"
-                                  f" has no match in tag {tag}")
-                    continue
-
-                vercode = m.group(1).strip()
-
-            if filever:
-                if filever != '.':
-                    filever = build_dir / filever
-                    if filever.is_file():
-                        filecontent = filever.read_text()
-                    else:
-                        logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filever, tag))
+            raise FDroidException(_('No tags found'))
+
+        logging.debug("All tags: " + ','.join(tags))
+        if pattern:
+            pat = common.compile_regex(pattern)
+            tags = [tag for tag in tags if pat.match(tag)]
+            if not tags:
+                raise FDroidException(_('No matching tags found'))
+            logging.debug("Matching tags: " + ','.join(tags))
+
+    with tempfile.TemporaryDirectory(prefix='fdroid-checkupdates-') as tmpdir:
+        for i, tag in enumerate(tags):
+            logging.debug("Check tag: '{0}'".format(tag))
+            tree_dir = get_tag_source_tree(app, vcs, tag, Path(tmpdir) / str(i))
+
+            if app.UpdateCheckData:
+                filecode, codeex, filever, verex = app.UpdateCheckData.split('|')
+
+                if filecode:
+                    filecode = tree_dir / filecode
+                    if not filecode.is_file():
+                        logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filecode, tag))
+                        continue
+                    filecontent = filecode.read_text()
+                else:
+                    filecontent = tag
+
+                vercode = tag
+                if codeex:
+                    m = common.compile_regex(codeex).search(filecontent)
+                    if not m:
+                        logging.debug(f"UpdateCheckData regex {codeex} for versionCode"
+                                      f" has no match in tag {tag}")
+                        continue
+
+                    vercode = m.group(1).strip()
+
+                if filever:
+                    if filever != '.':
+                        filever = tree_dir / filever
+                        if filever.is_file():
+                            filecontent = filever.read_text()
+                        else:
+                            logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filever, tag))
+                else:
+                    filecontent = tag
+
+                version = tag
+                if verex:
+                    m = common.compile_regex(verex).search(filecontent)
+                    if not m:
+                        logging.debug(f"UpdateCheckData regex {verex} for versionName"
+                                      f" has no match in tag {tag}")
+                        continue
+
+                    version = m.group(1)
+
+                logging.debug("UpdateCheckData found version {0} ({1})"
+                              .format(version, vercode))
+                vercode = common.version_code_string_to_int(vercode)
+                if vercode > hcode:
+                    htag = tag
+                    hcode = vercode
+                    hver = version
             else:
-                filecontent = tag
-
-            version = tag
-            if verex:
-                m = re.search(verex, filecontent)
-                if not m:
-                    logging.debug(f"UpdateCheckData regex {verex} for versionName"
-                                  f" has no match in tag {tag}")
-                    continue
-
-                version = m.group(1)
-
-            logging.debug("UpdateCheckData found version {0} ({1})"
-                          .format(version, vercode))
-            vercode = common.version_code_string_to_int(vercode)
-            if vercode > hcode:
-                htag = tag
-                hcode = vercode
-                hver = version
-        else:
-            for subdir in possible_subdirs(app):
-                root_dir = build_dir / subdir
-                paths = common.manifest_paths(root_dir, last_build.gradle)
-                version, vercode, _package = common.parse_androidmanifests(paths, app)
-                if version in ('Unknown', 'Ignore'):
-                    version = tag
-                if vercode:
-                    logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
-                                  .format(subdir, version, vercode))
-                    if vercode > hcode:
-                        htag = tag
-                        hcode = vercode
-                        hver = version
+                for subdir in possible_subdirs(app, tree_dir):
+                    root_dir = tree_dir / subdir
+                    paths = common.manifest_paths(root_dir, last_build.gradle)
+                    version, vercode, _package = common.parse_androidmanifests(paths, app)
+                    if version in ('Unknown', 'Ignore'):
+                        version = tag
+                    if vercode:
+                        logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
+                                      .format(subdir, version, vercode))
+                        if vercode > hcode:
+                            htag = tag
+                            hcode = vercode
+                            hver = version
 
     if hver:
         if htag != tags[0]:
@@ -378,7 +534,7 @@ def dirs_with_manifest(startdir: str):
             yield Path(root)
 
 
-def possible_subdirs(app: metadata.App):
+def possible_subdirs(app: metadata.App, build_dir: Optional[Path] = None):
     """Try to find a new subdir starting from the root build_dir.
 
     Yields said subdir relative to the build dir if found, None otherwise.
@@ -387,16 +543,19 @@ def possible_subdirs(app: metadata.App):
     ----------
     app
         The app to check for subdirs
+    build_dir
+        The source tree to search, defaults to the app's build dir
 
     Yields
     ------
     subdir : :class:`pathlib.Path` or None
         A possible subdir, None if no subdir could be found
     """
-    if app.RepoType == 'srclib':
-        build_dir = Path('build/srclib') / app.Repo
-    else:
-        build_dir = Path('build') / app.id
+    if build_dir is None:
+        if app.RepoType == 'srclib':
+            build_dir = Path('build/srclib') / app.Repo
+        else:
+            build_dir = Path('build') / app.id
 
     last_build = get_last_build_from_app(app)
 
@@ -499,6 +658,131 @@ def operate_vercode(operation: str, vercode: int) -> int:
     return vercode
 
 
+def get_remote_refs_digest(app: metadata.App) -> Optional[str]:
+    """Get a digest of all refs in the app's source repo, using git ls-remote.
+
+    This is a single cheap request, compared to fetching the repo.
+
+    Returns
+    -------
+    digest
+        The SHA-256 of the list of refs, or None if the repo is not a
+        git repo or could not be reached.
+    """
+    if app.RepoType != 'git':
+        return None
+    vcs = common.getvcs(app.RepoType, app.Repo, common.get_build_dir(app))
+    p = vcs.git(['ls-remote', '--', app.Repo], output=False)
+    if p.returncode != 0:
+        logging.debug("git ls-remote failed for {appid}: {output}".format(appid=app.id, output=p.output))
+        return None
+    refs = sorted(line for line in p.output.splitlines() if '\t' in line)
+    return hashlib.sha256('\n'.join(refs).encode()).hexdigest()
+
+
+def _get_check_inputs_digest(app: metadata.App) -> str:
+    """Get a digest of the metadata that the result of a version check depends on."""
+    last_build = get_last_build_from_app(app)
+    inputs = [app.Repo, app.RepoType, app.UpdateCheckMode, app.UpdateCheckData,
+              app.UpdateCheckIgnore, app.UpdateCheckName, app.AutoName,
+              last_build.gradle, last_build.submodules]
+    return hashlib.sha256(json.dumps(inputs, default=str).encode()).hexdigest()
+
+
+def _load_refs_cache(app: metadata.App, refs: str):
+    """Get the last check result, if neither the refs nor the metadata changed since."""
+    try:
+        with open(REFS_CACHE_DIR / (app.id + '.json')) as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if data.get('refs') != refs or data.get('metadata') != _get_check_inputs_digest(app):
+        return None
+    version, vercode, tag = data['found']
+    return (version, vercode, tag, None)
+
+
+def _save_refs_cache(app: metadata.App, refs: str, found) -> None:
+    version, vercode, tag, commitmsg = found
+    path = REFS_CACHE_DIR / (app.id + '.json')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {'refs': refs, 'metadata': _get_check_inputs_digest(app), 'found': [version, vercode, tag]}
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
+
+
+def check_app_version(app: metadata.App) -> Optional[tuple[str, int, Optional[str], Optional[str]]]:
+    """Find the latest version and the name of a single app.
+
+    This is the part of checkupdates that mostly waits for the network,
+    so it can run for many apps at the same time.  It only changes the
+    app's AutoName, it does not write any metadata.
+
+    For the Tags and RepoManifest modes, the refs of the source repo are
+    compared with the ones seen at the last check first.  If nothing
+    changed, neither upstream nor in the relevant metadata, the last
+    result is used without fetching the repo.  Removing
+    tmp/checkupdates-refs/ forces a full check.
+
+    Parameters
+    ----------
+    app
+        The app to check for updates for.
+
+    Returns
+    -------
+    found
+        None if checking is disabled, otherwise a tuple of the versionName,
+        the versionCode, the Git reference they were found at, and the
+        commit message about a changed AutoName, if any.
+
+    Raises
+    ------
+    :exc:`~fdroidserver.exception.MetaDataException`
+        If the app has an invalid UpdateCheckMode.
+    :exc:`~fdroidserver.exception.FDroidException`
+        If no version information could be found.
+    """
+    tag = None
+    refs = None
+    mode = app.UpdateCheckMode
+    if mode == 'HTTP':
+        (version, vercode) = check_http(app)
+    elif mode in ('None', 'Static'):
+        logging.debug('Checking disabled')
+        return None
+    elif mode.startswith('Tags') or mode == 'RepoManifest' or mode.startswith('RepoManifest/'):
+        with _host_slot(app.Repo):
+            refs = get_remote_refs_digest(app)
+        found = _load_refs_cache(app, refs) if refs else None
+        if found:
+            logging.info(_('No changes in the source repo since the last check'))
+            return found
+        with _source_slot(app):
+            if mode.startswith('Tags'):
+                pattern = mode[5:] if len(mode) > 4 else None
+                (version, vercode, tag) = check_tags(app, pattern)
+            elif mode == 'RepoManifest':
+                (version, vercode) = check_repomanifest(app)
+            else:
+                tag = mode[13:]
+                (version, vercode) = check_repomanifest(app, tag)
+    else:
+        raise MetaDataException(_('Invalid UpdateCheckMode: {mode}').format(mode=mode))
+
+    if not version or not vercode:
+        raise FDroidException(_('no version information found'))
+
+    with _source_slot(app):
+        autoname_commitmsg = fetch_autoname(app, tag)
+    found = (version, vercode, tag, autoname_commitmsg)
+    # a changed AutoName is only in the metadata once it is written
+    if refs and not autoname_commitmsg:
+        _save_refs_cache(app, refs, found)
+    return found
+
+
 def checkupdates_app(app: metadata.App, auto: bool, make_commit: bool = False) -> None:
     """Check for new versions and updated name of a single app.
 
@@ -519,30 +803,38 @@ def checkupdates_app(app: metadata.App, auto: bool, make_commit: bool = False) -
         than the found version, auto-update was requested but an app has no
         CurrentVersionCode or (Git) commiting the changes failed.
     """
-    # If a change is made, commitmsg should be set to a description of it.
-    # Only if this is set, changes will be written back to the metadata.
-    commitmsg = None
+    update_app(app, check_app_version(app), auto, make_commit)
 
-    tag = None
-    mode = app.UpdateCheckMode
-    if mode.startswith('Tags'):
-        pattern = mode[5:] if len(mode) > 4 else None
-        (version, vercode, tag) = check_tags(app, pattern)
-    elif mode == 'RepoManifest':
-        (version, vercode) = check_repomanifest(app)
-    elif mode.startswith('RepoManifest/'):
-        tag = mode[13:]
-        (version, vercode) = check_repomanifest(app, tag)
-    elif mode == 'HTTP':
-        (version, vercode) = check_http(app)
-    elif mode in ('None', 'Static'):
-        logging.debug('Checking disabled')
+
+def update_app(app: metadata.App, found, auto: bool, make_commit: bool = False) -> None:
+    """Apply what check_app_version() found to a single app.
+
+    This writes back changes to the metadata file and creates a Git
+    commit if requested, so it must only run for one app at a time.
+
+    Parameters
+    ----------
+    app
+        The app to update.
+    found
+        The return value of check_app_version() for this app.
+
+    Raises
+    ------
+    :exc:`~fdroidserver.exception.MetaDataException`
+        If the app has an invalid AutoUpdateMode.
+    :exc:`~fdroidserver.exception.FDroidException`
+        If the current version is newer than the found version, auto-update
+        was requested but an app has no CurrentVersionCode or (Git) commiting
+        the changes failed.
+    """
+    if found is None:
         return
-    else:
-        raise MetaDataException(_('Invalid UpdateCheckMode: {mode}').format(mode=mode))
+    (version, vercode, tag, autoname_commitmsg) = found
 
-    if not version or not vercode:
-        raise FDroidException(_('no version information found'))
+    # If a change is made, commitmsg should be set to a description of it.
+    # Only if this is set, changes will be written back to the metadata.
+    commitmsg = None
 
     if app.VercodeOperation:
         vercodes = sorted([
@@ -567,7 +859,7 @@ def checkupdates_app(app: metadata.App, auto: bool, make_commit: bool = False) -
             )
         )
 
-    commitmsg = fetch_autoname(app, tag)
+    commitmsg = autoname_commitmsg
 
     if updating:
         name = _getappname(app)
@@ -687,10 +979,58 @@ def checkupdates_app(app: metadata.App, auto: bool, make_commit: bool = False) -
         metadata.write_metadata(app.metadatapath, app)
         if make_commit:
             logging.info("Commiting update for " + app.metadatapath)
-            gitcmd = ["git", "commit", "-m", commitmsg]
-            gitcmd.extend(["--", app.metadatapath])
-            if subprocess.call(gitcmd) != 0:
-                raise FDroidException("Git commit failed")
+            if metadata_committer:
+                metadata_committer.commit(app.metadatapath, commitmsg)
+            else:
+                gitcmd = ["git", "commit", "-m", commitmsg]
+                gitcmd.extend(["--", app.metadatapath])
+                if subprocess.call(gitcmd) != 0:
+                    raise FDroidException("Git commit failed")
+
+
+class MetadataCommitter:
+    """Commit the metadata updates of many apps in this process.
+
+    Running `git commit` for each app means a new process that reads
+    and writes the whole index again, which adds up when a run updates
+    hundreds of apps.  This keeps one index in memory for the whole
+    run, and only writes the changed entry and the new objects for
+    each commit.  Like `git commit -- <file>`, each commit only
+    contains the metadata file of that app, so this must only be used
+    when nothing else is staged.  The commits cannot be signed, so this
+    is not used when commit.gpgsign is set either.
+    """
+
+    def __init__(self, git_repo: git.Repo):
+        self.git_repo = git_repo
+        self.index = git_repo.index
+
+    @classmethod
+    def create(cls) -> Optional['MetadataCommitter']:
+        """Return a committer for the repo in the current dir, or None if `git commit` must be used."""
+        try:
+            git_repo = git.Repo('.')
+        except git.InvalidGitRepositoryError:
+            return None
+        if git_repo.head.is_valid() and git_repo.index.diff('HEAD'):
+            logging.debug('Staged changes found, committing with `git commit`')
+            return None
+        with git_repo.config_reader() as reader:
+            if reader.get_value('commit', 'gpgsign', False):
+                logging.debug('commit.gpgsign is set, committing with `git commit`')
+                return None
+        return cls(git_repo)
+
+    def commit(self, path: str, message: str) -> None:
+        """Commit the current state of the file at path."""
+        try:
+            self.index.add([path])
+            self.index.commit(message)
+        except (git.GitError, OSError) as e:
+            raise FDroidException("Git commit failed") from e
+
+
+metadata_committer = None
 
 
 def get_last_build_from_app(app: metadata.App) -> metadata.Build:
@@ -870,13 +1210,16 @@ def prune_empty_appid_branches(git_repo=None, main_branch='main'):
     remote = git_repo.remotes.origin
     remote.update(prune=True)
     merged_branches = git_repo.git().branch(remotes=True, merged=upstream_main).split()
+    remote_refs = {ref.name: ref for ref in remote.refs}
+    refspecs = []
     for remote_branch in merged_branches:
         if not remote_branch or '/' not in remote_branch:
             continue
         if remote_branch.split('/')[1] not in (main_branch, 'HEAD'):
-            for ref in git_repo.remotes.origin.refs:
-                if remote_branch == ref.name:
-                    remote.push(':%s' % ref.remote_head, force=True)  # rm remote branch
+            if remote_branch in remote_refs:
+                refspecs.append(':%s' % remote_refs[remote_branch].remote_head)
+    if refspecs:
+        remote.push(refspecs, force=True)  # rm all the remote branches at once
 
 
 def main():
@@ -893,6 +1236,8 @@ def main():
                         help=_("Commit changes, push, then make a merge request"))
     parser.add_argument("--allow-dirty", action="store_true", default=False,
                         help=_("Run on git repo that has uncommitted changes"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=_("Check this many apps at the same time"))
     metadata.add_metadata_arguments(parser)
     options = common.parse_args(parser)
     metadata.warnings_action = options.W
@@ -908,16 +1253,32 @@ def main():
         sys.exit(1)
 
     apps = common.read_app_args(options.appid)
+    if options.autoonly:
+        for appid in [k for k, v in apps.items() if v.AutoUpdateMode in ('None', 'Static')]:
+            logging.debug(_("Nothing to do for {appid}.").format(appid=appid))
+            del apps[appid]
+
+    global http_cache
+    http_cache = HttpCache(HTTP_CACHE_DIR)
+    if options.commit and not options.merge_request:
+        global metadata_committer
+        metadata_committer = MetadataCommitter.create()
+
+    # The version checks run concurrently, but the results are applied
+    # one app at a time in the usual order, so the metadata writes and
+    # commits are the same as without --jobs.
+    found = dict()
+    executor = None
+    if options.jobs > 1 and not options.merge_request:
+        executor = ThreadPoolExecutor(max_workers=options.jobs)
+        for appid, app in apps.items():
+            found[appid] = executor.submit(check_app_version, app)
 
     processed = []
     failed = {}
     exit_code = 0
     for appid, app in apps.items():
 
-        if options.autoonly and app.AutoUpdateMode in ('None', 'Static'):
-            logging.debug(_("Nothing to do for {appid}.").format(appid=appid))
-            continue
-
         msg = _("Processing {appid}").format(appid=appid)
         logging.info(msg)
 
@@ -932,7 +1293,10 @@ def main():
                     failed[appid] = msg
                     continue
 
-            checkupdates_app(app, options.auto, options.commit or options.merge_request)
+            if appid in found:
+                update_app(app, found.pop(appid).result(), options.auto, options.commit)
+            else:
+                checkupdates_app(app, options.auto, options.commit or options.merge_request)
             processed.append(appid)
         except Exception as e:
             msg = _("...checkupdate failed for {appid} : {error}").format(appid=appid, error=e)
@@ -941,6 +1305,9 @@ def main():
             failed[appid] = str(e)
             exit_code = 1
 
+    if executor:
+        executor.shutdown()
+
     if options.appid and options.merge_request:
         push_commits()
         prune_empty_appid_branches()
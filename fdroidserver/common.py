@@ -54,9 +54,12 @@ environment variable to include.
 
 import ast
 import base64
+import contextlib
 import copy
 import difflib
+import fcntl
 import filecmp
+import functools
 import glob
 import gzip
 import hashlib
@@ -149,6 +152,9 @@ ANDROID_PLUGIN_REGEX = re.compile(r'''\s*(:?apply plugin:|id)\(?\s*['"](android|
 
 MAX_VERSION_CODE = 0x7FFFFFFF  # Java's Integer.MAX_VALUE (2147483647)
 
+# how many compiled patterns compile_regex() keeps
+REGEX_CACHE_SIZE = 1024
+
 XMLNS_ANDROID = '{http://schemas.android.com/apk/res/android}'
 
 # https://docs.gitlab.com/ee/user/gitlab_com/#gitlab-pages
@@ -230,6 +236,9 @@ default_config = {
     'archive_description': _('These are the apps that have been archived from the main repo.'),  # type: ignore
     'archive_older': 0,
     'git_mirror_size_limit': 10000000000,
+    'srclib_cache_size': 10000000000,
+    'podman_warm_pool_size': 0,
+    'virustotal_requests_per_minute': 4,
     'scanner_signature_sources': ['suss'],
 }
 
@@ -928,6 +937,67 @@ def get_dir_size(path_or_str):
     return sum(f.stat().st_size for f in path_or_str.glob('**/*') if f.is_file())
 
 
+def get_repo_manifest_path(repo_section):
+    """Get the path to the manifest that `fdroid update` writes for repo_section."""
+    return os.path.join('tmp', 'manifests', repo_section.replace('/', '_') + '.json')
+
+
+def load_repo_manifest(path):
+    """Load a repo manifest, returning None if there is no valid one."""
+    try:
+        with open(path) as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def write_repo_manifest(path, manifest):
+    """Atomically write a repo manifest, so readers never see a partial one."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def make_repo_manifest(repodir, known=None):
+    """Return a manifest of all files in repodir, keyed by relative path.
+
+    Each entry has the size, SHA-256 and mtime of the file, symlinks
+    only have their target.  The SHA-256 is reused from the entry in
+    known when size and mtime are unchanged, so only new and changed
+    files are read.
+
+    """
+    known = known or dict()
+    manifest = dict()
+    for root, dirs, files in os.walk(repodir):
+        for f in dirs + files:
+            path = os.path.join(root, f)
+            relpath = os.path.relpath(path, repodir)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                manifest[relpath] = {'link': os.readlink(path)}
+                continue
+            if f in dirs:
+                continue
+            entry = known.get(relpath)
+            if (
+                not entry
+                or entry.get('size') != st.st_size
+                or entry.get('mtime') != st.st_mtime
+                or not entry.get('sha256')
+            ):
+                entry = {'sha256': sha256sum(path)}
+            manifest[relpath] = {
+                'size': st.st_size,
+                'sha256': entry['sha256'],
+                'mtime': st.st_mtime,
+            }
+    return manifest
+
+
 def assert_config_keystore(config):
     """Check weather keystore is configured correctly and raise exception if not."""
     nosigningkey = False
@@ -1671,8 +1741,12 @@ class vcs:
                 rtags.append(tag)
         return rtags
 
-    def latesttags(self):
-        """Get a list of all the known tags, sorted from newest to oldest."""
+    def latesttags(self, pattern=None, count=None):
+        """Get a list of the known tags, sorted from newest to oldest.
+
+        Only tags matching the regex pattern are included, and at most
+        count of them, if given.
+        """
         raise VCSException('latesttags not supported for this vcs type')
 
     def getref(self, revname=None):
@@ -1684,6 +1758,130 @@ class vcs:
         return self.srclib
 
 
+# the bare repos under the cachedir that checkouts borrow objects from
+GIT_SHARED_OBJECTS_DIR = 'git-objects'
+GIT_SHARED_OBJECTS_BORROWERS = 'fdroid-borrowers'
+
+
+@contextlib.contextmanager
+def lock_git_shared_objects(shared):
+    """Lock a shared git objects repo against other processes and threads.
+
+    The lock file is next to the repo and is never deleted, so it
+    stays the same file while the repo is cloned or removed.
+    """
+    shared.parent.mkdir(parents=True, exist_ok=True)
+    with open(shared.parent / (shared.name + '.lock'), 'w') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        yield
+
+
+def get_git_shared_objects_dir(remote):
+    """Get the bare repo that shares its objects with all checkouts of remote.
+
+    Returns None unless git_shared_objects is enabled in the config.
+    """
+    thisconfig = get_config()
+    if not thisconfig.get('git_shared_objects') or not thisconfig.get('cachedir'):
+        return None
+    name = hashlib.sha256(str(remote).encode()).hexdigest()[:32]
+    return Path(thisconfig['cachedir']).resolve() / GIT_SHARED_OBJECTS_DIR / name
+
+
+def get_git_alternates(local):
+    """Get the object dirs a git checkout borrows objects from."""
+    path = Path(local) / '.git' / 'objects' / 'info' / 'alternates'
+    if not path.exists():
+        return []
+    return [
+        Path(line)
+        for line in path.read_text().splitlines()
+        if line and not line.startswith('#')
+    ]
+
+
+def gc_git_shared_objects():
+    """Prune the objects in the shared repos that no checkout needs anymore.
+
+    The tips of all refs of each checkout that still borrows from a
+    shared repo are added as refs to the shared repo, then `git gc`
+    prunes everything else.  Shared repos without any checkouts left
+    are deleted.  If a tip is missing in the shared repo, it is not
+    pruned, since it cannot be known which of its objects are needed.
+    """
+    cachedir = get_config().get('cachedir')
+    if not cachedir:
+        return
+    for shared in sorted((Path(cachedir) / GIT_SHARED_OBJECTS_DIR).glob('*')):
+        if shared.suffix == '.lock':
+            continue
+        with lock_git_shared_objects(shared):
+            borrowers_file = shared / GIT_SHARED_OBJECTS_BORROWERS
+            borrowers = []
+            if borrowers_file.exists():
+                borrowers = borrowers_file.read_text().splitlines()
+            objects = (shared / 'objects').resolve()
+            borrowers = [b for b in borrowers if objects in get_git_alternates(b)]
+            if not borrowers:
+                logging.info(_('Removing unused {path}').format(path=shared))
+                shutil.rmtree(shared)
+                continue
+            borrowers_file.write_text(''.join(b + '\n' for b in borrowers))
+
+            tips = set()
+            for b in borrowers:
+                p = subprocess.run(
+                    ['git', 'for-each-ref', '--format=%(objectname)'],
+                    cwd=b,
+                    capture_output=True,
+                    text=True,
+                )
+                tips.update(p.stdout.split())
+                p = subprocess.run(
+                    ['git', 'rev-parse', '--verify', '--quiet', 'HEAD'],
+                    cwd=b,
+                    capture_output=True,
+                    text=True,
+                )
+                tips.update(p.stdout.split())
+            tips = sorted(tips)
+            p = subprocess.run(
+                ['git', 'cat-file', '--batch-check'],
+                cwd=shared,
+                capture_output=True,
+                text=True,
+                input=''.join(t + '\n' for t in tips),
+            )
+            if p.returncode != 0 or 'missing' in p.stdout:
+                logging.warning(
+                    _(
+                        'Not pruning {path}, it is missing objects of its checkouts'
+                    ).format(path=shared)
+                )
+                continue
+
+            refs = ['refs/fdroid-borrowers/%d' % i for i in range(len(tips))]
+            subprocess.run(
+                ['git', 'update-ref', '--stdin'],
+                cwd=shared,
+                check=True,
+                text=True,
+                input=''.join('create %s %s\n' % x for x in zip(refs, tips)),
+            )
+            try:
+                subprocess.run(
+                    ['git', 'gc', '--prune=now', '--quiet'], cwd=shared, check=True
+                )
+            finally:
+                subprocess.run(
+                    ['git', 'update-ref', '--stdin'],
+                    cwd=shared,
+                    check=True,
+                    text=True,
+                    input=''.join('delete %s\n' % ref for ref in refs),
+                )
+
+
 # fmt: off
 class vcs_git(vcs):
 
@@ -1746,16 +1944,63 @@ class vcs_git(vcs):
         if Path(result) != Path(self.local).resolve():
             raise VCSException(f"Repository mismatch ('{self.local}' != '{result}')")
 
+    def update_shared_objects(self, shared):
+        """Create or fetch the bare repo that checkouts of this remote borrow objects from.
+
+        Returns False if that failed, the checkout then works without it.
+        The caller must hold lock_git_shared_objects().  Automatic gc is
+        turned off in the bare repo, since it does not know about the
+        objects that the checkouts need, only gc_git_shared_objects()
+        does.
+        """
+        if not shared.exists():
+            p = self.git(['clone', '--mirror', '-c', 'gc.auto=0', '-c', 'maintenance.auto=false',
+                          '--', self.remote, str(shared)])
+        else:
+            p = self.git(['fetch', '--prune', 'origin'], cwd=shared)
+        if p.returncode != 0:
+            logging.warning(_("Updating the shared git objects failed: {output}").format(output=p.output))
+            return False
+        return True
+
     def gotorevisionx(self, rev):
+        shared = get_git_shared_objects_dir(self.remote)
+        if not shared:
+            self._gotorevisionx(rev, None)
+            return
+        # held until the checkout is registered and has fetched, so that
+        # gc_git_shared_objects() cannot remove objects it still needs
+        with lock_git_shared_objects(shared):
+            self._gotorevisionx(rev, shared)
+
+    def _gotorevisionx(self, rev, shared):
+        if os.path.exists(self.local) and not all(a.exists() for a in get_git_alternates(self.local)):
+            logging.info(_("Shared git objects of {path} are gone, cloning again").format(path=self.local))
+            shutil.rmtree(self.local)
         if not os.path.exists(self.local):
             # Brand new checkout
-            p = self.git(['clone', '--', self.remote, str(self.local)])
+            cmd = ['clone']
+            clone_filter = get_config().get('git_clone_filter')
+            if clone_filter:
+                cmd.append('--filter=' + clone_filter)
+            if shared and self.update_shared_objects(shared):
+                cmd += ['--reference', str(shared)]
+            else:
+                shared = None
+            p = self.git(cmd + ['--', self.remote, str(self.local)])
             if p.returncode != 0:
                 self.clone_failed = True
                 raise VCSException("Git clone failed", p.output)
             self.checkrepo()
+            if shared:
+                with open(shared / GIT_SHARED_OBJECTS_BORROWERS, 'a') as fp:
+                    fp.write(str(Path(self.local).resolve()) + '\n')
         else:
             self.checkrepo()
+            if shared and (shared / 'objects').resolve() in get_git_alternates(self.local) \
+               and not self.refreshed:
+                # so the new objects end up in the shared repo, not in this checkout
+                self.update_shared_objects(shared)
             # Discard any working tree changes
             p = FDroidPopen(['git', 'submodule', 'foreach', '--recursive',
                              'git', 'reset', '--hard'], cwd=self.local, output=False)
@@ -1807,6 +2052,47 @@ class vcs_git(vcs):
             raise VCSException(_("Git clean failed"), p.output)
         logging.info(f'commit: {rev} (SHA1: {get_head_commit_id(self.local)})')
 
+    def setrevision(self, rev):
+        """Point HEAD and the index at rev, without touching the worktree.
+
+        This makes a worktree that was filled from elsewhere, e.g. a
+        prepared srclib from the cache, a checkout of rev, as if it had
+        been checked out by gotorevision().  If there is no repo yet, it
+        is cloned without checking out any files.  rev must be a commit
+        ID.
+        """
+        fdpath = os.path.normpath(os.path.join(
+            self.local, '..', '.fdroidvcs-' + os.path.basename(self.local)))
+        cdata = self.repotype() + ' ' + self.remote
+        if not os.path.isdir(os.path.join(self.local, '.git')) \
+           or not os.path.exists(fdpath) or Path(fdpath).read_text().strip() != cdata:
+            if os.path.exists(self.local):
+                shutil.rmtree(self.local)
+            cmd = ['clone', '--no-checkout']
+            clone_filter = get_config().get('git_clone_filter')
+            if clone_filter:
+                cmd.append('--filter=' + clone_filter)
+            p = self.git(cmd + ['--', self.remote, str(self.local)])
+            if p.returncode != 0:
+                self.clone_failed = True
+                raise VCSException("Git clone failed", p.output)
+            self.checkrepo()
+            os.makedirs(os.path.dirname(fdpath), exist_ok=True)
+            with open(fdpath, 'w') as f:
+                f.write(cdata)
+            self.refreshed = True
+        self.checkrepo()
+        p = FDroidPopen(['git', 'cat-file', '-e', rev + '^{commit}'], cwd=self.local, output=False)
+        if p.returncode != 0:
+            p = self.git(['fetch', '--prune', '--tags', '--force', 'origin'], cwd=self.local)
+            if p.returncode != 0:
+                raise VCSException(_("Git fetch failed"), p.output)
+            self.refreshed = True
+        for cmd in (['update-ref', '--no-deref', 'HEAD', rev], ['read-tree', rev]):
+            p = FDroidPopen(['git'] + cmd, cwd=self.local, output=False)
+            if p.returncode != 0:
+                raise VCSException(_("Git checkout of '%s' failed") % rev, p.output)
+
     def initsubmodules(self):
         self.checkrepo()
         submfile = os.path.join(self.local, '.gitmodules')
@@ -1835,19 +2121,100 @@ class vcs_git(vcs):
         if p.returncode != 0:
             raise VCSException(_("Git submodule deinit failed"), p.output)
 
+    def extractfiles(self, rev, destdir, match):
+        """Write the files of a revision that match to a directory.
+
+        The files are read straight from the git objects using `git
+        ls-tree` and `git cat-file --batch`, so neither the worktree nor
+        the index are touched.  Symlinks and the contents of submodules
+        are not included.  Git only checks the paths in a tree on
+        checkout, so paths that would end up outside of destdir, like
+        `../x`, are skipped here.
+
+        Parameters
+        ----------
+        rev
+            The revision to read the files from.
+        destdir
+            The directory to write the files to.
+        match
+            Called with the path of each file relative to the top of the
+            repo, only files for which it returns True are written.
+
+        Returns
+        -------
+        The list of written paths, relative to destdir.
+        """
+        self.checkrepo()
+        p = subprocess.run(['git', 'ls-tree', '-r', '-z', '--full-tree', rev],
+                           cwd=self.local, capture_output=True)
+        if p.returncode != 0:
+            raise VCSException(_("Git ls-tree of '%s' failed") % rev,
+                               p.stderr.decode('utf-8', errors='replace'))
+        destroot = Path(destdir).resolve()
+        objects = dict()
+        for entry in p.stdout.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.split(b'\t', 1)
+            mode, objtype, sha = info.split()
+            if objtype != b'blob' or mode == b'120000':
+                continue
+            path = os.fsdecode(path)
+            if not match(path):
+                continue
+            if not (destroot / path).resolve().is_relative_to(destroot) \
+               or '..' in path.split('/'):
+                logging.warning(_("Skipping unsafe path '{path}' in {rev}").format(path=path, rev=rev))
+                continue
+            objects[path] = sha
+        if not objects:
+            return []
+
+        p = subprocess.run(['git', 'cat-file', '--batch'], cwd=self.local, capture_output=True,
+                           input=b''.join(sha + b'\n' for sha in objects.values()))
+        if p.returncode != 0:
+            raise VCSException(_("Git cat-file failed"), p.stderr.decode('utf-8', errors='replace'))
+        pos = 0
+        for path in objects:
+            end = p.stdout.index(b'\n', pos)
+            header = p.stdout[pos:end].split()
+            if header[-1] == b'missing':
+                pos = end + 1
+                continue
+            size = int(header[2])
+            dest = destroot / path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            dest.write_bytes(p.stdout[end + 1:end + 1 + size])
+            pos = end + 1 + size + 1
+        return list(objects)
+
     def _gettags(self):
         self.checkrepo()
         p = FDroidPopen(['git', 'tag'], cwd=self.local, output=False)
         return p.output.splitlines()
 
-    def latesttags(self):
-        """Return a list of latest tags."""
+    def latesttags(self, pattern=None, count=None):
+        """Return a list of latest tags.
+
+        This is a single `git for-each-ref` query, so it stays fast on
+        repos with thousands of tags.  The date of annotated tags is
+        the date of the commit they point to.
+        """
         self.checkrepo()
-        return [tag.name for tag in sorted(
-            git.Repo(self.local).tags,
-            key=lambda t: t.commit.committed_date,
-            reverse=True
-        )]
+        p = FDroidPopen(['git', 'for-each-ref', '--format=%(committerdate:unix) %(*committerdate:unix) %(refname)',
+                         'refs/tags/'], cwd=self.local, output=False)
+        if p.returncode != 0:
+            raise VCSException(_("Git for-each-ref failed"), p.output)
+        match = compile_regex(pattern).match if pattern else None
+        dates = dict()
+        for line in p.output.splitlines():
+            date, tagdate, refname = line.split(' ', 2)
+            name = refname[len('refs/tags/'):]
+            if (date or tagdate) and (not match or match(name)):
+                dates[name] = int(date or tagdate)
+        tags = sorted(dates, key=dates.get, reverse=True)
+        return tags[:count] if count else tags
 
     def getref(self, revname='HEAD'):
         self.checkrepo()
@@ -2170,6 +2537,21 @@ def ant_subprojects(root_dir):
     return subprojects
 
 
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_regex(pattern, flags=0):
+    """Compile a regex once and return the same pattern object on later calls.
+
+    Regexes from the metadata, like UpdateCheckIgnore and
+    UpdateCheckData, or those assembled from the build flavors, are
+    used in loops over many files, tags and lines.  The cache of the
+    re module is small and shared with every other regex in the
+    process, so with hundreds of apps those get compiled over and
+    over again.  This cache is keyed by pattern and flags and keeps
+    the least recently used entries.
+    """
+    return re.compile(pattern, flags)
+
+
 # fmt: off
 vcsearch_g = re.compile(r'''\b[Vv]ersionCode\s*=?\s*["'(]*([0-9][0-9_]*)["')]*''').search
 vnsearch_g = re.compile(r'''\b[Vv]ersionName\s*=?\s*\(?(["'])((?:(?=(\\?))\3.)*?)\1''').search
@@ -2198,7 +2580,7 @@ def parse_androidmanifests(paths, app):
     https://sites.google.com/a/android.com/tools/knownissues/encoding
     """
     ignoreversions = app.UpdateCheckIgnore
-    ignoresearch = re.compile(ignoreversions).search if ignoreversions else None
+    ignoresearch = compile_regex(ignoreversions).search if ignoreversions else None
 
     if not paths:
         return (None, None, None)
@@ -2297,10 +2679,10 @@ def parse_androidmanifests(paths, app):
                                     inside_required_flavor -= 1
                         elif flavors:
                             for flavor in flavors:
-                                if re.match(r'.*[\'"\s]{flavor}[\'"\s].*\{{.*'.format(flavor=flavor), line):
+                                if compile_regex(r'.*[\'"\s]{flavor}[\'"\s].*\{{.*'.format(flavor=flavor)).match(line):
                                     inside_required_flavor = 2
                                     break
-                                if re.match(r'.*[\'"\s]{flavor}[\'"\s].*'.format(flavor=flavor), line):
+                                if compile_regex(r'.*[\'"\s]{flavor}[\'"\s].*'.format(flavor=flavor)).match(line):
                                     inside_required_flavor = 1
                                     break
 
@@ -2458,6 +2840,104 @@ def parse_srclib_spec(spec):
     return (name, ref, number, subdir)
 
 
+def get_srclib_cache_dir():
+    """Get the dir of prepared srclibs, or None unless srclib_cache is enabled."""
+    thisconfig = get_config()
+    if not thisconfig.get('srclib_cache') or not thisconfig.get('cachedir'):
+        return None
+    return Path(thisconfig['cachedir']) / 'srclib'
+
+
+def _prune_srclib_cache(cachedir, keep):
+    """Remove the least recently used prepared srclibs beyond srclib_cache_size.
+
+    Each use of an entry updates its mtime.  Entries are renamed before
+    they are removed, so no build finds one that is half removed.
+    """
+    max_size = parse_human_readable_size(
+        get_config().get('srclib_cache_size', default_config['srclib_cache_size'])
+    )
+    entries = []
+    for path in cachedir.iterdir():
+        if path.name.startswith('.') or path == keep:
+            continue  # being stored or removed
+        try:
+            entries.append((path.stat().st_mtime, path, get_dir_size(path)))
+        except FileNotFoundError:
+            continue  # removed by another process
+    total = get_dir_size(keep) + sum(e[2] for e in entries)
+    for _mtime, path, size in sorted(entries):
+        if total <= max_size:
+            break
+        logging.debug('Removing prepared srclib %s' % path)
+        trash = path.with_name('.' + path.name + '.old')
+        try:
+            os.rename(path, trash)
+        except OSError:
+            continue  # removed by another process
+        shutil.rmtree(trash, ignore_errors=True)
+        total -= size
+
+
+def copy_tree_contents(src, dst, exclude=()):
+    """Copy the contents of the src dir into dst, except for the top-level names in exclude.
+
+    This uses reflinks where the filesystem supports them, so the
+    copies share their data blocks until they are changed.
+    """
+    os.makedirs(dst, exist_ok=True)
+    names = sorted(n for n in os.listdir(src) if n not in exclude)
+    if not names:
+        return
+    p = subprocess.run(
+        ['cp', '-a', '--reflink=auto', '--']
+        + [os.path.join(src, n) for n in names]
+        + [str(dst)],
+        capture_output=True,
+    )
+    if p.returncode != 0:
+        logging.debug('cp failed, copying with Python: %s' % p.stderr)
+        for n in names:
+            path = os.path.join(src, n)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.copytree(
+                    path, os.path.join(dst, n), symlinks=True, dirs_exist_ok=True
+                )
+            else:
+                shutil.copy2(path, os.path.join(dst, n), follow_symlinks=False)
+
+
+def _materialize_prepared_srclib(entry, sdir):
+    """Replace the worktree in sdir with a copy of a prepared srclib, keeping .git."""
+    if os.path.isdir(sdir):
+        for n in os.listdir(sdir):
+            path = os.path.join(sdir, n)
+            if n == '.git':
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    copy_tree_contents(entry, sdir)
+
+
+def _store_prepared_srclib(sdir, entry):
+    """Store a copy of the prepared srclib in sdir as the cache entry.
+
+    The copy is made next to the entry and then renamed, so the entry
+    never exists half-written.  Once stored, it is never changed.
+    """
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=entry.parent, prefix='.' + entry.name)
+    try:
+        copy_tree_contents(sdir, tmpdir, exclude=('.git',))
+        os.rename(tmpdir, entry)
+    except OSError:
+        # another process stored it first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    _prune_srclib_cache(entry.parent, entry)
+
+
 def getsrclib(
     spec,
     srclib_dir,
@@ -2529,15 +3009,48 @@ def getsrclib(
 
     sdir = os.path.join(srclib_dir, name)
 
+    # Prepared srclibs are cached per commit and Prepare commands, so
+    # they are only checked out and prepared once.  A ref that is a
+    # commit ID does not even need a checkout to find its cache entry.
+    cachedir = None
+    commit = None
+    if prepare and ref and not preponly and not raw and srclib["RepoType"] == 'git':
+        cachedir = get_srclib_cache_dir()
+        if cachedir and re.fullmatch(r'[0-9a-f]{40}', ref):
+            commit = ref
+
     if not preponly:
         vcs = getvcs(srclib["RepoType"], srclib["Repo"], sdir)
         vcs.srclib = (name, number, sdir)
-        if ref:
+        if ref and not commit:
             vcs.gotorevision(ref, refresh)
+            if cachedir:
+                commit = vcs.getref()
 
         if raw:
             return vcs
 
+    entry = None
+    if cachedir and commit:
+        prepare_cmd = None
+        if srclib["Prepare"]:
+            prepare_cmd = replace_config_vars("; ".join(srclib["Prepare"]), build)
+        key = json.dumps([srclib["Repo"], commit, subdir, srclib["Subdir"], prepare_cmd])
+        entry = cachedir / (name + '-' + hashlib.sha256(key.encode()).hexdigest()[:16])
+        if entry.is_dir():
+            logging.info(
+                _("Using prepared srclib {name} from {path}").format(
+                    name=name, path=entry
+                )
+            )
+            os.utime(entry)
+            if commit == ref:
+                vcs.setrevision(commit)
+            _materialize_prepared_srclib(entry, sdir)
+        else:
+            if commit == ref:
+                vcs.gotorevision(ref, refresh)
+
     libdir = None
     if subdir:
         libdir = os.path.join(sdir, subdir)
@@ -2551,7 +3064,11 @@ def getsrclib(
     if libdir is None:
         libdir = sdir
 
-    remove_signing_keys(sdir)
+    if entry is not None and entry.is_dir():
+        # already prepared
+        prepare = False
+    else:
+        remove_signing_keys(sdir)
 
     if prepare:
 
@@ -2567,6 +3084,9 @@ def getsrclib(
                     "Error running prepare command for srclib %s" % name, p.output
                 )
 
+        if entry is not None:
+            _store_prepared_srclib(sdir, entry)
+
     if basepath:
         libdir = sdir
 
@@ -5215,6 +5735,10 @@ FDROIDORG_FINGERPRINT = (
 )
 
 
+_podman_client = None
+_podman_client_pid = None
+
+
 def get_podman_client():
     """Return an instance of podman-py to work with Podman.
 
@@ -5227,9 +5751,17 @@ def get_podman_client():
     done outside of systemd so it will work where systemd is not
     installed.  The systemd socket calls the same command anyway.
 
+    The client is only created and pinged once per process, then that
+    instance and its connection pool is reused for all later calls.
+
     https://docs.podman.io/en/latest/markdown/podman-system-service.1.html
 
     """
+    global _podman_client, _podman_client_pid
+
+    if _podman_client is not None and _podman_client_pid == os.getpid():
+        return _podman_client
+
     import podman
 
     client = podman.PodmanClient()
@@ -5251,22 +5783,64 @@ def get_podman_client():
         path = f'{url.scheme}://{unquote(url.netloc)}'
         logging.error(f'No Podman service found at {path}!')
         sys.exit(1)
+    _podman_client = client
+    _podman_client_pid = os.getpid()
     return client
 
 
 PODMAN_BUILDSERVER_IMAGE = 'registry.gitlab.com/fdroid/fdroidserver:buildserver'
 
 
-def get_podman_container(appid, vercode):
-    """Singleton getter, since podman-py is just an interface to the podman daemon singleton."""
+def get_podman_container_id_path(appid, vercode):
+    """Return the path to the file caching the container ID for a given build."""
+    return Path(
+        'tmp/buildserver', get_container_name(appid, vercode), 'podman_container_id'
+    )
+
+
+def set_podman_container_id(appid, vercode, container_id):
+    """Remember which container ID belongs to a build, or forget it if None."""
+    path = get_podman_container_id_path(appid, vercode)
+    if container_id is None:
+        path.unlink(missing_ok=True)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(container_id)
+
+
+def find_podman_container(appid, vercode):
+    """Look up the container for a build directly by ID or name, or return None.
+
+    This first tries the container ID that was stored when the
+    container was created, then falls back to the unique container
+    name.  Both are direct lookups by the Podman service, there is no
+    need to list all the containers.
+
+    """
+    from podman.errors import NotFound
+
     container_name = get_container_name(appid, vercode)
     client = get_podman_client()
-    ret = None
-    for c in client.containers.list(all=True):
-        if c.name == container_name:
-            ret = c
-            break
-    client.close()
+    id_path = get_podman_container_id_path(appid, vercode)
+    keys = [container_name]
+    if id_path.exists():
+        keys.insert(0, id_path.read_text().strip())
+    for key in keys:
+        try:
+            container = client.containers.get(key)
+        except NotFound:
+            continue
+        if container.name == container_name:
+            if key != container.id:
+                set_podman_container_id(appid, vercode, container.id)
+            return container
+    set_podman_container_id(appid, vercode, None)
+    return None
+
+
+def get_podman_container(appid, vercode):
+    """Singleton getter, since podman-py is just an interface to the podman daemon singleton."""
+    ret = find_podman_container(appid, vercode)
     if ret is None:
         raise BuildException(f'Container for {appid}:{vercode} not found!')
     if PODMAN_BUILDSERVER_IMAGE not in ret.image.tags:
@@ -17,7 +17,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import configparser
+import functools
 import glob
+import hashlib
 import json
 import logging
 import os
@@ -26,8 +28,11 @@ import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
 import git
@@ -49,6 +54,19 @@ REMOTE_HOSTNAME_REGEX = re.compile(r'\W*\w+\W+(\w+).*')
 
 EMBEDDED_RCLONE_CONF = 'rclone.conf'
 
+# how many APKs to look up on androidobservatory.org at the same time
+ANDROIDOBSERVATORY_JOBS = 4
+
+# the upper limit of concurrent VirusTotal lookups, the rate limit
+# is set by virustotal_requests_per_minute
+VIRUSTOTAL_JOBS = 8
+VIRUSTOTAL_QUEUE_FILE = os.path.join('tmp', 'virustotal-queue.json')
+
+# The two phases of a deploy: first all the package files are pushed
+# to every target, then the index files are published everywhere.
+DEPLOY_PHASE_PACKAGES = 'packages'
+DEPLOY_PHASE_INDEX = 'index'
+
 
 def _get_index_file_paths(base_dir):
     """Return the list of files to be synced last, since they finalize the deploy.
@@ -119,6 +137,7 @@ def update_remote_storage_with_rclone(
     verbose=False,
     quiet=False,
     checksum=False,
+    phase=None,
 ):
     """Sync the directory `repo_section` (including subdirectories) to configed cloud services.
 
@@ -139,6 +158,9 @@ def update_remote_storage_with_rclone(
     If rclone.conf is in the root of the repo, then it will be preferred
     over the rclone default config paths.
 
+    phase can be DEPLOY_PHASE_PACKAGES or DEPLOY_PHASE_INDEX to only
+    run that half of the sync, otherwise both are run.
+
     """
     logging.debug(_('Using rclone to sync to "{name}"').format(name=awsbucket))
 
@@ -222,6 +244,8 @@ def update_remote_storage_with_rclone(
         complete_remote_path = f'{remote_config}:{awsbucket}/{upload_dir}'
         logging.info(f'rclone sync to {complete_remote_path}')
         if is_index_only:
+            if phase == DEPLOY_PHASE_PACKAGES:
+                continue
             index_only_files = common.INDEX_FILES + ['diff/*.*']
             include_pattern = _generate_rclone_include_pattern(index_only_files)
             cmd = rclone_sync_command + [
@@ -235,25 +259,125 @@ def update_remote_storage_with_rclone(
             if subprocess.call(cmd) != 0:
                 raise FDroidException()
         else:
-            cmd = (
-                rclone_sync_command
-                + _get_index_excludes(repo_section)
-                + [
+            if phase != DEPLOY_PHASE_INDEX:
+                cmd = (
+                    rclone_sync_command
+                    + _get_index_excludes(repo_section)
+                    + [
+                        repo_section,
+                        complete_remote_path,
+                    ]
+                )
+                if subprocess.call(cmd) != 0:
+                    raise FDroidException()
+            if phase != DEPLOY_PHASE_PACKAGES:
+                cmd = rclone_sync_command + [
                     repo_section,
                     complete_remote_path,
                 ]
-            )
-            if subprocess.call(cmd) != 0:
-                raise FDroidException()
-            cmd = rclone_sync_command + [
-                repo_section,
-                complete_remote_path,
-            ]
-            if subprocess.call(cmd) != 0:
-                raise FDroidException()
+                if subprocess.call(cmd) != 0:
+                    raise FDroidException()
+
+
+def _get_deployed_manifest_path(url, repo_section):
+    """Get the path to the manifest of what was last uploaded to url."""
+    name = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return os.path.join(
+        'tmp', 'manifests', 'deployed', name, repo_section.replace('/', '_') + '.json'
+    )
+
 
+# The current manifest of each repo section.  main() sets this to a
+# dict, so that it is computed only once per deploy for all targets.
+_repo_manifests = None
+_repo_manifests_lock = threading.Lock()
 
-def update_serverwebroot(serverwebroot, repo_section):
+
+def _get_current_repo_manifest(repo_section):
+    """Return the manifest of the files in repo_section as they are now.
+
+    This is the manifest written by `fdroid update`, refreshed with
+    the files that changed since, e.g. by `fdroid signindex`, or None
+    if there is none.
+
+    """
+    with _repo_manifests_lock:
+        if _repo_manifests is not None and repo_section in _repo_manifests:
+            return _repo_manifests[repo_section]
+        known = common.load_repo_manifest(common.get_repo_manifest_path(repo_section))
+        current = None
+        if known is not None:
+            current = common.make_repo_manifest(repo_section, known)
+        if _repo_manifests is not None:
+            _repo_manifests[repo_section] = current
+        return current
+
+
+def _get_manifest_dirs(manifest):
+    """Return all the dirs that contain the paths in a manifest."""
+    dirs = set()
+    for path in manifest:
+        parent = os.path.dirname(path)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    return dirs
+
+
+def _get_manifest_delta(url, repo_section):
+    """Compare the repo manifest to the one that was last uploaded to url.
+
+    The manifests only list files, so the dirs that no longer contain
+    any files are added to the removed paths, deepest first.
+
+    Returns
+    -------
+    The current manifest, the paths that were added or changed and the
+    paths that were removed, or None if either manifest is missing.
+
+    """
+    deployed = common.load_repo_manifest(_get_deployed_manifest_path(url, repo_section))
+    if deployed is None:
+        return None
+    current = _get_current_repo_manifest(repo_section)
+    if current is None:
+        return None
+
+    changed, removed = _diff_manifests(current, deployed)
+    removed += sorted(
+        _get_manifest_dirs(deployed) - _get_manifest_dirs(current), reverse=True
+    )
+    return current, changed, removed
+
+
+def _diff_manifests(current, previous):
+    """Return the sorted paths that were added or changed, and that were removed."""
+
+    def _key(entry):
+        return entry and (entry.get('size'), entry.get('sha256'), entry.get('link'))
+
+    changed = sorted(p for p, e in current.items() if _key(e) != _key(previous.get(p)))
+    removed = sorted(set(previous) - set(current))
+    return changed, removed
+
+
+def _rsync_files_from(rsyncargs, paths, repo_section, url):
+    """Run rsync with only the given paths relative to repo_section."""
+    with tempfile.NamedTemporaryFile('w', prefix='fdroid-deploy-', suffix='.txt') as fp:
+        fp.write(''.join(p + '\n' for p in paths))
+        fp.flush()
+        cmd = rsyncargs + [
+            '--files-from',
+            fp.name,
+            repo_section + '/',
+            f'{url}/{repo_section}/',
+        ]
+        logging.debug(cmd)
+        if subprocess.call(cmd) != 0:
+            raise FDroidException()
+
+
+def update_serverwebroot(serverwebroot, repo_section, phase=None):
     """Deploy the index files to the serverwebroot using rsync.
 
     Upload the first time without the index files and delay the
@@ -269,6 +393,17 @@ def update_serverwebroot(serverwebroot, repo_section):
     accurate comparisons on different filesystems, for example, FAT
     has a low resolution timestamp
 
+    If `fdroid update` wrote a manifest of the repo and this target
+    was deployed to before, then only the files that changed since
+    the last deploy are uploaded from a --files-from list, without
+    scanning and hashing the whole tree on both ends.  Removed files
+    are deleted only after the index files were uploaded.  --verify
+    forces the full rsync run.
+
+    phase can be DEPLOY_PHASE_PACKAGES to only run the first upload
+    without the index files, or DEPLOY_PHASE_INDEX to only run the
+    second one.  Otherwise, both are run.
+
     """
     config = common.get_config()
     try:
@@ -299,6 +434,8 @@ def update_serverwebroot(serverwebroot, repo_section):
     is_index_only = serverwebroot.get('index_only', False)
     logging.info('rsyncing ' + repo_section + ' to ' + url)
     if is_index_only:
+        if phase == DEPLOY_PHASE_PACKAGES:
+            return
         files_to_upload = _get_index_file_paths(repo_section)
         files_to_upload = _remove_missing_files(files_to_upload)
 
@@ -307,54 +444,98 @@ def update_serverwebroot(serverwebroot, repo_section):
         logging.info(rsyncargs)
         if subprocess.call(rsyncargs) != 0:
             raise FDroidException()
+        return
+
+    delta = None
+    if not (options and options.verify):
+        delta = _get_manifest_delta(url, repo_section)
+    if delta is not None:
+        manifest, changed, removed = delta
+        # rsync does not need to compare the files itself
+        rsyncargs = [
+            a for a in rsyncargs if a not in ('--delete-after', '--checksum')
+        ] + ['--ignore-times']
+        index_files = set(common.INDEX_FILES)
+        logging.info(
+            _('Uploading {changed} changed and deleting {removed} files').format(
+                changed=len(changed), removed=len(removed)
+            )
+        )
+        if phase != DEPLOY_PHASE_INDEX:
+            packages = [p for p in changed if p not in index_files]
+            if packages:
+                _rsync_files_from(rsyncargs, packages, repo_section, url)
+        if phase == DEPLOY_PHASE_PACKAGES:
+            return
+        indexes = [p for p in changed if p in index_files]
+        if indexes:
+            _rsync_files_from(rsyncargs, indexes, repo_section, url)
+        if removed:
+            # --force also deletes removed dirs that are not empty
+            _rsync_files_from(
+                rsyncargs + ['--delete-missing-args', '--force'],
+                removed,
+                repo_section,
+                url,
+            )
     else:
-        excludes = _get_index_excludes(repo_section)
-        if subprocess.call(rsyncargs + excludes + [repo_section, url]) != 0:
-            raise FDroidException()
+        manifest = None
+        if phase != DEPLOY_PHASE_INDEX:
+            excludes = _get_index_excludes(repo_section)
+            if subprocess.call(rsyncargs + excludes + [repo_section, url]) != 0:
+                raise FDroidException()
+        if phase == DEPLOY_PHASE_PACKAGES:
+            return
         if subprocess.call(rsyncargs + [repo_section, url]) != 0:
             raise FDroidException()
-        # upload "current version" symlinks if requested
-        if (
-            config
-            and config.get('make_current_version_link')
-            and repo_section == 'repo'
-        ):
-            links_to_upload = []
-            for f in (
-                glob.glob('*.apk') + glob.glob('*.apk.asc') + glob.glob('*.apk.sig')
-            ):
-                if os.path.islink(f):
-                    links_to_upload.append(f)
-            if len(links_to_upload) > 0:
-                if subprocess.call(rsyncargs + links_to_upload + [url]) != 0:
-                    raise FDroidException()
+    # upload "current version" symlinks if requested
+    if config and config.get('make_current_version_link') and repo_section == 'repo':
+        links_to_upload = []
+        for f in glob.glob('*.apk') + glob.glob('*.apk.asc') + glob.glob('*.apk.sig'):
+            if os.path.islink(f):
+                links_to_upload.append(f)
+        if len(links_to_upload) > 0:
+            if subprocess.call(rsyncargs + links_to_upload + [url]) != 0:
+                raise FDroidException()
+
+    if manifest is None:
+        manifest = _get_current_repo_manifest(repo_section)
+    if manifest is not None:
+        common.write_repo_manifest(
+            _get_deployed_manifest_path(url, repo_section), manifest
+        )
+
+
+def check_serverwebroot(d, standardwebroot=True):
+    """Exit with an error if the serverwebroot URL is not usable."""
+    # this supports both an ssh host:path and just a path
+    serverwebroot = d['url']
+    s = serverwebroot.rstrip('/').split(':')
+    if len(s) == 1:
+        fdroiddir = s[0]
+    elif len(s) == 2:
+        host, fdroiddir = s
+    else:
+        logging.error(_('Malformed serverwebroot line:') + ' ' + serverwebroot)
+        sys.exit(1)
+    repobase = os.path.basename(fdroiddir)
+    if standardwebroot and repobase != 'fdroid':
+        logging.error(
+            _(
+                'serverwebroot: path does not end with "fdroid", perhaps you meant one of these:'
+            )
+            + '\n\t'
+            + serverwebroot.rstrip('/')
+            + '/fdroid\n\t'
+            + serverwebroot.rstrip('/').rstrip(repobase)
+            + 'fdroid'
+        )
+        sys.exit(1)
 
 
 def update_serverwebroots(serverwebroots, repo_section, standardwebroot=True):
     for d in serverwebroots:
-        # this supports both an ssh host:path and just a path
-        serverwebroot = d['url']
-        s = serverwebroot.rstrip('/').split(':')
-        if len(s) == 1:
-            fdroiddir = s[0]
-        elif len(s) == 2:
-            host, fdroiddir = s
-        else:
-            logging.error(_('Malformed serverwebroot line:') + ' ' + serverwebroot)
-            sys.exit(1)
-        repobase = os.path.basename(fdroiddir)
-        if standardwebroot and repobase != 'fdroid':
-            logging.error(
-                _(
-                    'serverwebroot: path does not end with "fdroid", perhaps you meant one of these:'
-                )
-                + '\n\t'
-                + serverwebroot.rstrip('/')
-                + '/fdroid\n\t'
-                + serverwebroot.rstrip('/').rstrip(repobase)
-                + 'fdroid'
-            )
-            sys.exit(1)
+        check_serverwebroot(d, standardwebroot)
         update_serverwebroot(d, repo_section)
 
 
@@ -410,6 +591,64 @@ def _get_size(start_path='.'):
     return total_size
 
 
+GIT_MIRROR_STATE_FILE = 'fdroid-git-mirror.json'
+
+
+def _load_git_mirror_state(dotgit):
+    """Load what the last run knew about the git mirror.
+
+    This is stored in the .git dir, so it goes away together with the
+    history when the mirror gets too big.
+
+    """
+    return common.load_repo_manifest(os.path.join(dotgit, GIT_MIRROR_STATE_FILE)) or {}
+
+
+def _get_git_mirror_delta(repo, repo_section, state):
+    """Return the repo manifest and the paths changed since the last git mirror run.
+
+    This is None if there is no manifest from `fdroid update` or the
+    branch is not at the commit that the last run made, since then
+    the files in the git mirror are unknown.
+
+    """
+    previous = state.get('manifest')
+    if previous is None:
+        return None
+    if GIT_BRANCH not in repo.heads or repo.heads[
+        GIT_BRANCH
+    ].commit.hexsha != state.get('commit'):
+        return None
+    current = _get_current_repo_manifest(repo_section)
+    if current is None:
+        return None
+    return (current,) + _diff_manifests(current, previous)
+
+
+def _copy_to_git_mirror(repo_section, git_repodir, changed, removed):
+    """Copy the changed files into the git mirror and delete the removed ones.
+
+    Like rsync --safe-links, symlinks pointing outside of the repo are
+    skipped.
+
+    """
+    for path in removed + changed:
+        dest = os.path.join(git_repodir, path)
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.remove(dest)
+    for path in changed:
+        src = os.path.join(repo_section, path)
+        dest = os.path.join(git_repodir, path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.islink(src):
+            target = os.readlink(src)
+            if not os.path.isabs(target) and '..' not in target.split('/'):
+                os.symlink(target, dest)
+        else:
+            shutil.copy2(src, dest)
+            os.chmod(dest, 0o644)
+
+
 def update_servergitmirrors(servergitmirrors, repo_section):
     """Update repo mirrors stored in git repos.
 
@@ -428,6 +667,14 @@ def update_servergitmirrors(servergitmirrors, repo_section):
     time since usually all the files are changed.  In any case, the
     index files are small compared to the full repo.
 
+    When `fdroid update` wrote a manifest of the repo, and the last run
+    left the git mirror at a known state, only the files that changed
+    since are copied and staged, the size of the mirror is tracked
+    without walking it, and remotes that already have the current
+    commit are not pushed to again.  Mirrors in "index only" mode
+    switch branches in the same working tree, so they always get the
+    full treatment.
+
     """
     from progress.bar import IncrementalBar
 
@@ -452,7 +699,8 @@ def update_servergitmirrors(servergitmirrors, repo_section):
         # github/gitlab use bare git repos, so only count the .git folder
         # test: generate giant APKs by including AndroidManifest.xml and and large
         # file from /dev/urandom, then sign it.  Then add those to the git repo.
-        dotgit_size = _get_size(dotgit)
+        state = _load_git_mirror_state(dotgit)
+        dotgit_size = state['size'] if 'size' in state else _get_size(dotgit)
         dotgit_over_limit = dotgit_size > config['git_mirror_size_limit']
         if os.path.isdir(dotgit) and dotgit_over_limit:
             logging.warning(
@@ -461,6 +709,7 @@ def update_servergitmirrors(servergitmirrors, repo_section):
                 ).format(size=dotgit_size, limit=config['git_mirror_size_limit'])
             )
             shutil.rmtree(dotgit)
+            state = dict()
         if options.no_keep_git_mirror_archive and dotgit_over_limit:
             logging.warning(
                 _('Deleting archive, repo is too big ({size} max {limit})').format(
@@ -491,6 +740,16 @@ def update_servergitmirrors(servergitmirrors, repo_section):
 
         repo = git.Repo.init(git_mirror_path, initial_branch=GIT_BRANCH)
 
+        incremental = not any(d.get('index_only') for d in servergitmirrors)
+        pushed = state.setdefault('pushed', dict())
+        delta = None
+        if options.verify:
+            pushed.clear()
+        elif incremental:
+            delta = _get_git_mirror_delta(repo, repo_section, state)
+        has_delta = delta is not None
+        added_size = 0
+
         enabled_remotes = []
         for d in servergitmirrors:
             is_index_only = d.get('index_only', False)
@@ -505,16 +764,41 @@ def update_servergitmirrors(servergitmirrors, repo_section):
             else:
                 repo.git.switch('--orphan', local_branch_name)
 
-            # trailing slashes have a meaning in rsync which is not needed here, so
-            # make sure both paths have exactly one trailing slash
-            if is_index_only:
-                files_to_sync = _get_index_file_paths(str(workspace_dir / repo_section))
-                files_to_sync = _remove_missing_files(files_to_sync)
+            changed_paths, removed_paths, fdroid_dir_size = None, None, None
+            if delta is not None:
+                manifest, changed, removed = delta
+                logging.debug(
+                    _('Copying {changed} changed files to git mirror').format(
+                        changed=len(changed)
+                    )
+                )
+                _copy_to_git_mirror(repo_section, git_repodir, changed, removed)
+                prefix = os.path.join('fdroid', repo_section)
+                changed_paths = [os.path.join(prefix, p) for p in changed]
+                removed_paths = [os.path.join(prefix, p) for p in removed]
+                fdroid_dir_size = sum(e.get('size', 0) for e in manifest.values())
+                # the manifest only covers this section, e.g. not the archive
+                for entry in os.scandir(git_fdroiddir):
+                    if entry.name != repo_section and entry.is_dir():
+                        fdroid_dir_size += common.get_dir_size(entry.path)
+                added_size += sum(manifest[p].get('size', 0) for p in changed)
+                # the following mirrors share the same branch
+                delta = (manifest, [], [])
             else:
-                files_to_sync = [str(workspace_dir / repo_section).rstrip('/') + '/']
-            common.local_rsync(
-                common.get_options(), files_to_sync, git_repodir.rstrip('/') + '/'
-            )
+                # trailing slashes have a meaning in rsync which is not needed here, so
+                # make sure both paths have exactly one trailing slash
+                if is_index_only:
+                    files_to_sync = _get_index_file_paths(
+                        str(workspace_dir / repo_section)
+                    )
+                    files_to_sync = _remove_missing_files(files_to_sync)
+                else:
+                    files_to_sync = [
+                        str(workspace_dir / repo_section).rstrip('/') + '/'
+                    ]
+                common.local_rsync(
+                    common.get_options(), files_to_sync, git_repodir.rstrip('/') + '/'
+                )
 
             upload_to_servergitmirror(
                 mirror_config=d,
@@ -526,10 +810,35 @@ def update_servergitmirrors(servergitmirrors, repo_section):
                 git_mirror_path=str(git_mirror_path),
                 ssh_cmd=ssh_cmd,
                 progress=progress,
+                changed_paths=changed_paths,
+                removed_paths=removed_paths,
+                fdroid_dir_size=fdroid_dir_size,
+                pushed=pushed if incremental else None,
             )
         if progress:
             progressbar.finish()
 
+        # an upper bound, since git compresses the objects and removed
+        # files are not subtracted, so measure it before it hits the limit
+        state['size'] = dotgit_size + added_size
+        if not has_delta or state['size'] > config['git_mirror_size_limit']:
+            state['size'] = _get_size(dotgit)
+        state['manifest'] = None
+        if incremental:
+            if has_delta:
+                state['manifest'] = manifest
+            else:
+                state['manifest'] = _get_current_repo_manifest(repo_section)
+            state['commit'] = repo.heads[GIT_BRANCH].commit.hexsha
+        common.write_repo_manifest(os.path.join(dotgit, GIT_MIRROR_STATE_FILE), state)
+
+
+def _has_staged_changes(git_repo):
+    """Return True if committing the git index would change anything."""
+    if not git_repo.head.is_valid():
+        return True
+    return bool(git_repo.index.diff('HEAD'))
+
 
 def _get_commit_author(git_repo):
     """If the author is set locally, use it, otherwise use static info."""
@@ -555,7 +864,20 @@ def upload_to_servergitmirror(
     git_mirror_path: str,
     ssh_cmd: str,
     progress: git.RemoteProgress,
+    changed_paths: List[str] = None,
+    removed_paths: List[str] = None,
+    fdroid_dir_size: int = None,
+    pushed: Dict[str, str] = None,
 ) -> None:
+    """Commit the files in the git mirror and push them to one remote.
+
+    If changed_paths and removed_paths are given, only those get
+    staged, instead of scanning the whole working tree.  If pushed is
+    given, it maps remote URLs to the commit that was last pushed
+    there, remotes that already have the current commit are skipped,
+    and no empty commits are made.
+
+    """
     remote_branch_name = GIT_BRANCH
     local_branch_name = local_repo.active_branch.name
 
@@ -582,19 +904,41 @@ def upload_to_servergitmirror(
             "servergitmirrors: index-only in git-mirror",
             author=_get_commit_author(local_repo),
         )
+    elif changed_paths is not None:
+        logging.debug(_('Adding changed files to git mirror'))
+        changed_paths = [
+            p
+            for p in changed_paths
+            if os.path.lexists(os.path.join(local_repo.working_tree_dir, p))
+        ]
+        # keep the command lines short enough
+        for i in range(0, len(changed_paths), 1000):
+            local_repo.git.add('--', *changed_paths[i : i + 1000])
+        for i in range(0, len(removed_paths or []), 1000):
+            local_repo.git.rm(
+                '--cached',
+                '--ignore-unmatch',
+                '--quiet',
+                '--',
+                *removed_paths[i : i + 1000],
+            )
+        if _has_staged_changes(local_repo):
+            local_repo.index.commit(
+                "servergitmirrors: in git-mirror", author=_get_commit_author(local_repo)
+            )
     else:
         # sadly index.add don't allow the --all parameter
         logging.debug(_('Adding all files to git mirror'))
         local_repo.git.add(all=True)
-        local_repo.index.commit(
-            "servergitmirrors: in git-mirror", author=_get_commit_author(local_repo)
-        )
+        if pushed is None or _has_staged_changes(local_repo):
+            local_repo.index.commit(
+                "servergitmirrors: in git-mirror", author=_get_commit_author(local_repo)
+            )
 
     # only deploy to GitLab Artifacts if too big for GitLab Pages
-    if (
-        is_index_only
-        or common.get_dir_size(fdroid_dir) <= common.GITLAB_COM_PAGES_MAX_SIZE
-    ):
+    if fdroid_dir_size is None and not is_index_only:
+        fdroid_dir_size = common.get_dir_size(fdroid_dir)
+    if is_index_only or fdroid_dir_size <= common.GITLAB_COM_PAGES_MAX_SIZE:
         gitlab_ci_job_name = 'pages'
     else:
         gitlab_ci_job_name = 'GitLab Artifacts'
@@ -625,7 +969,13 @@ def upload_to_servergitmirror(
             )
 
         local_repo.index.add(['.gitlab-ci.yml'])
-        local_repo.index.commit("fdroidserver git-mirror: Deploy to GitLab Pages")
+        if pushed is None or _has_staged_changes(local_repo):
+            local_repo.index.commit("fdroidserver git-mirror: Deploy to GitLab Pages")
+
+    head = local_repo.head.commit.hexsha
+    if pushed is not None and pushed.get(remote_url) == head:
+        logging.info(_('{url} is already up to date').format(url=remote_url))
+        return
 
     logging.debug(_('Pushing to {url}').format(url=remote.url))
     with local_repo.git.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
@@ -656,6 +1006,8 @@ def upload_to_servergitmirror(
                 )
             else:
                 logging.debug(remote.url + ': ' + pushinfo.summary)
+    if pushed is not None:
+        pushed[remote_url] = head
 
 
 def upload_to_android_observatory(repo_section):
@@ -671,19 +1023,24 @@ def upload_to_android_observatory(repo_section):
         logging.getLogger("urllib3").setLevel(logging.WARNING)
 
     if repo_section == 'repo':
-        for f in sorted(glob.glob(os.path.join(repo_section, '*.apk'))):
-            upload_apk_to_android_observatory(f)
+        with ThreadPoolExecutor(max_workers=ANDROIDOBSERVATORY_JOBS) as executor:
+            list(
+                executor.map(
+                    upload_apk_to_android_observatory,
+                    sorted(glob.glob(os.path.join(repo_section, '*.apk'))),
+                )
+            )
 
 
 def upload_apk_to_android_observatory(path):
     # depend on requests and lxml only if users enable AO
-    import requests
     from lxml.html import fromstring
 
     from . import net
 
+    session = net.get_session()
     apkfilename = os.path.basename(path)
-    r = requests.post(
+    r = session.post(
         'https://androidobservatory.org/',
         data={'q': common.sha256sum(path), 'searchby': 'hash'},
         headers=net.HEADERS,
@@ -717,47 +1074,147 @@ def upload_apk_to_android_observatory(path):
             apkfilename=apkfilename
         )
     )
-    r = requests.post(
-        'https://androidobservatory.org/upload',
-        files={'apk': (apkfilename, open(path, 'rb'))},
-        headers=net.HEADERS,
-        allow_redirects=False,
-        timeout=300,
+    with open(path, 'rb') as fp:
+        session.post(
+            'https://androidobservatory.org/upload',
+            files={'apk': (apkfilename, fp)},
+            headers=net.HEADERS,
+            allow_redirects=False,
+            timeout=300,
+        )
+
+
+def _get_virustotal_report_path(packageName, versionCode, hash):
+    return os.path.join(
+        'virustotal', packageName + '_' + str(versionCode) + '_' + hash + '.json'
     )
 
 
-def upload_to_virustotal(repo_section, virustotal_apikey):
-    import requests
+def _load_virustotal_queue(repo_section):
+    """Return the APKs in the index that have no VirusTotal report yet.
 
-    requests  # stop unused import warning
+    The newest APKs come first, so they are checked before the
+    backfill of older ones.  The queue is saved between runs, then
+    index-v1 is only read again when it has changed.
 
-    if repo_section == 'repo':
-        if not os.path.exists('virustotal'):
-            os.mkdir('virustotal')
+    """
+    index_path = os.path.join(repo_section, 'index-v1.json')
+    if not os.path.exists(index_path):
+        index_path = os.path.join(repo_section, 'index-v1.jar')
+    st = os.stat(index_path)
+    index_key = [index_path, st.st_mtime_ns, st.st_size]
+    try:
+        with open(VIRUSTOTAL_QUEUE_FILE) as fp:
+            state = json.load(fp)
+        if state.get('index') == index_key:
+            return state['queue'], index_key
+    except (OSError, ValueError):
+        pass
+
+    if index_path.endswith('.json'):
+        with open(index_path) as fp:
+            data = json.load(fp)
+    else:
+        data, _ignored, _ignored = index.get_index_from_jar(index_path)
+    queue = list()
+    for packages in data['packages'].values():
+        for package in packages:
+            path = _get_virustotal_report_path(
+                package['packageName'], package['versionCode'], package['hash']
+            )
+            if not os.path.exists(path):
+                queue.append(package)
+    queue.sort(key=lambda p: p.get('added', 0), reverse=True)
+    return queue, index_key
 
-        if os.path.exists(os.path.join(repo_section, 'index-v1.json')):
-            with open(os.path.join(repo_section, 'index-v1.json')) as fp:
-                data = json.load(fp)
-        else:
-            local_jar = os.path.join(repo_section, 'index-v1.jar')
-            data, _ignored, _ignored = index.get_index_from_jar(local_jar)
 
-        for packageName, packages in data['packages'].items():
-            for package in packages:
-                upload_apk_to_virustotal(virustotal_apikey, **package)
+def _save_virustotal_queue(queue, index_key):
+    os.makedirs(os.path.dirname(VIRUSTOTAL_QUEUE_FILE), exist_ok=True)
+    with open(VIRUSTOTAL_QUEUE_FILE + '.tmp', 'w') as fp:
+        json.dump({'index': index_key, 'queue': queue}, fp)
+    os.replace(VIRUSTOTAL_QUEUE_FILE + '.tmp', VIRUSTOTAL_QUEUE_FILE)
+
+
+def upload_to_virustotal(repo_section, virustotal_apikey, requests_per_minute=None):
+    """Get VirusTotal reports for all APKs in the repo, uploading the unknown ones.
+
+    The APKs are checked concurrently, with all requests going through
+    a token bucket that is set to the API quota.  APKs stay in the
+    queue until their report is saved, so files that were just
+    uploaded are checked again on the next run.
+
+    Returns
+    -------
+    A dict of progress and rate metrics.
+
+    """
+    from . import net
+
+    if repo_section != 'repo':
+        return
+    if not os.path.exists('virustotal'):
+        os.mkdir('virustotal')
+    if not requests_per_minute:
+        requests_per_minute = common.default_config['virustotal_requests_per_minute']
+
+    queue, index_key = _load_virustotal_queue(repo_section)
+    rate_limiter = net.TokenBucket(requests_per_minute / 60, requests_per_minute)
+    total = len(queue)
+    lock = threading.Lock()
+    done = list()
+
+    def _check(package):
+        path = upload_apk_to_virustotal(
+            virustotal_apikey, rate_limiter=rate_limiter, **package
+        )
+        if not os.path.exists(path):
+            return  # uploaded, the report will be there on the next run
+        with lock:
+            done.append(package)
+            queue.remove(package)
+            if len(done) % 10 == 0:
+                _save_virustotal_queue(queue, index_key)
+                logging.info(
+                    _(
+                        'VirusTotal: {done}/{total} reports, {rate} requests/minute'
+                    ).format(
+                        done=len(done),
+                        total=total,
+                        rate=rate_limiter.requests_per_minute(),
+                    )
+                )
+
+    jobs = min(VIRUSTOTAL_JOBS, max(1, int(requests_per_minute)))
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(_check, list(queue)))
+    finally:
+        with lock:
+            _save_virustotal_queue(queue, index_key)
+
+    return {
+        'reports': len(done),
+        'pending': len(queue),
+        'requests': rate_limiter.requests,
+        'requestsPerMinute': rate_limiter.requests_per_minute(),
+    }
 
 
 def upload_apk_to_virustotal(
-    virustotal_apikey, packageName, apkName, hash, versionCode, **kwargs
+    virustotal_apikey,
+    packageName,
+    apkName,
+    hash,
+    versionCode,
+    rate_limiter=None,
+    **kwargs,
 ):
-    import requests
+    from . import net
 
     logging.getLogger("urllib3").setLevel(logging.WARNING)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    outputfilename = os.path.join(
-        'virustotal', packageName + '_' + str(versionCode) + '_' + hash + '.json'
-    )
+    outputfilename = _get_virustotal_report_path(packageName, versionCode, hash)
     if os.path.exists(outputfilename):
         logging.debug(apkName + ' results are in ' + outputfilename)
         return outputfilename
@@ -769,10 +1226,17 @@ def upload_apk_to_virustotal(
         for k, v in kwargs['headers'].items():
             headers[k] = v
 
+    session = net.get_session()
+
+    def _request(method, url, **kwargs):
+        if rate_limiter:
+            rate_limiter.acquire()
+        return session.request(method, url, headers=headers, timeout=300, **kwargs)
+
     needs_file_upload = False
     while True:
         report_url = f'https://www.virustotal.com/api/v3/files/{hash}'
-        r = requests.get(report_url, headers=headers, timeout=300)
+        r = _request('GET', report_url)
         if r.status_code == 200:
             data = r.json()['data']
             data['filename'] = apkName
@@ -801,7 +1265,11 @@ def upload_apk_to_virustotal(
             break
         if r.status_code == 429:
             logging.warning(_('virustotal.com is rate limiting, waiting to retry...'))
-            time.sleep(60)  # wait for public API rate limiting
+            # wait for public API rate limiting
+            if rate_limiter:
+                rate_limiter.pause(60)
+            else:
+                time.sleep(60)
             continue
         r.raise_for_status()
 
@@ -819,7 +1287,7 @@ def upload_apk_to_virustotal(
         elif size > 32000000:
             # VirusTotal API requires fetching a URL to upload bigger files
             query_url = 'https://www.virustotal.com/api/v3/files/upload_url'
-            r = requests.get(query_url, headers=headers, timeout=300)
+            r = _request('GET', query_url)
             if r.status_code == 200:
                 upload_url = r.json().get('data')
             elif r.status_code == 403:
@@ -838,12 +1306,8 @@ def upload_apk_to_virustotal(
         logging.info(
             _('Uploading {apkfilename} to virustotal').format(apkfilename=repofilename)
         )
-        r = requests.post(
-            upload_url,
-            headers=headers,
-            files={'file': (apkName, open(repofilename, 'rb'))},
-            timeout=300,
-        )
+        with open(repofilename, 'rb') as fp:
+            r = _request('POST', upload_url, files={'file': (apkName, fp)})
         logging.debug(
             _('If this upload fails, try manually uploading to {url}').format(
                 url=manual_url
@@ -909,6 +1373,33 @@ def push_binary_transparency(git_repo_path, git_remote):
             raise FDroidException(_("Pushing to remote server failed!"))
 
 
+_index_v2_packages_cache = dict()
+
+
+def _load_index_v2_packages(index_v2_path, package_names):
+    """Get the entries of the given packages from index-v2.json.
+
+    Only the requested packages are kept in memory.  They are cached
+    as long as the file does not change, so deploying to many GitHub
+    projects only parses the index once.
+    """
+    try:
+        st = os.stat(index_v2_path)
+        key = (os.path.realpath(index_v2_path), st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    cached = _index_v2_packages_cache.get(key)
+    if cached is not None and all(p in cached for p in package_names):
+        return cached
+    with open(index_v2_path, 'r') as f:
+        all_packages = json.load(f).get('packages', {})
+    packages = {p: all_packages.get(p, {}) for p in package_names}
+    if key:
+        _index_v2_packages_cache.clear()
+        _index_v2_packages_cache[key] = packages
+    return packages
+
+
 def find_release_infos(index_v2_path, repo_dir, package_names):
     """Find files, texts, etc. for uploading to a release page in index-v2.json.
 
@@ -922,27 +1413,26 @@ def find_release_infos(index_v2_path, repo_dir, package_names):
     All paths in the returned data-structure are of type pathlib.Path.
     """
     release_infos = {}
-    with open(index_v2_path, 'r') as f:
-        idx = json.load(f)
-        for package_name in package_names:
-            package = idx.get('packages', {}).get(package_name, {})
-            for version in package.get('versions', {}).values():
-                if package_name not in release_infos:
-                    release_infos[package_name] = {}
-                version_name = version['manifest']['versionName']
-                version_path = repo_dir / version['file']['name'].lstrip("/")
-                files = [version_path]
-                asc_path = pathlib.Path(str(version_path) + '.asc')
-                if asc_path.is_file():
-                    files.append(asc_path)
-                sig_path = pathlib.Path(str(version_path) + '.sig')
-                if sig_path.is_file():
-                    files.append(sig_path)
-                release_infos[package_name][version_name] = {
-                    'files': files,
-                    'whatsNew': version.get('whatsNew', {}).get("en-US"),
-                    'hasReleaseChannels': len(version.get('releaseChannels', [])) > 0,
-                }
+    packages = _load_index_v2_packages(index_v2_path, package_names)
+    for package_name in package_names:
+        package = packages.get(package_name, {})
+        for version in package.get('versions', {}).values():
+            if package_name not in release_infos:
+                release_infos[package_name] = {}
+            version_name = version['manifest']['versionName']
+            version_path = repo_dir / version['file']['name'].lstrip("/")
+            files = [version_path]
+            asc_path = pathlib.Path(str(version_path) + '.asc')
+            if asc_path.is_file():
+                files.append(asc_path)
+            sig_path = pathlib.Path(str(version_path) + '.sig')
+            if sig_path.is_file():
+                files.append(sig_path)
+            release_infos[package_name][version_name] = {
+                'files': files,
+                'whatsNew': version.get('whatsNew', {}).get("en-US"),
+                'hasReleaseChannels': len(version.get('releaseChannels', [])) > 0,
+            }
     return release_infos
 
 
@@ -1009,7 +1499,9 @@ def upload_to_github_releases_repo(repo_conf, release_infos, global_gh_token):
         for version in release_infos.get(package_name, {}).keys():
             all_local_versions.add(version)
 
-    gh = fdroidserver.github.GithubApi(token, projectUrl)
+    gh = fdroidserver.github.GithubApi(
+        token, projectUrl, cachedir=common.get_config().get('cachedir')
+    )
     unreleased_tags = gh.list_unreleased_tags()
 
     for version in all_local_versions:
@@ -1042,6 +1534,113 @@ def upload_to_github_releases_repo(repo_conf, release_infos, global_gh_token):
                 gh.create_release(version, files, text)
 
 
+def run_deploy_tasks(tasks, jobs=1):
+    """Run deploy tasks concurrently and return their timings and errors.
+
+    tasks is a dict of a target name to a callable that deploys to
+    it.  If it returns a dict of metrics, that is included in the
+    results as "stats".  At most jobs of them run at the same time.  This only
+    returns after all of them have finished, so it acts as a barrier
+    between the phases of the deploy.  A failing task does not stop
+    the others, instead its error is recorded in the results.
+
+    """
+
+    def _run(name, task):
+        start = time.monotonic()
+        result = dict()
+        try:
+            stats = task()
+            if isinstance(stats, dict):
+                result['stats'] = stats
+        except (Exception, SystemExit) as e:
+            logging.error(
+                _('Deploying to {name} failed: {error}').format(name=name, error=e)
+            )
+            result['error'] = str(e) or e.__class__.__name__
+        result['seconds'] = round(time.monotonic() - start, 3)
+        return name, result
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return dict(executor.map(lambda item: _run(*item), tasks.items()))
+
+
+def deploy_repo_section(repo_section, config, options):
+    """Deploy one repo section to all configured targets in two phases.
+
+    First, the package files without the index files are pushed to
+    all serverwebroots and the rclone remote concurrently.  After all
+    of them have finished, the index files are published to each
+    target whose package upload succeeded, together with the git
+    mirrors, which push everything at once, and the other services.
+    That keeps the guarantee that clients never see an index which
+    refers to files that are not there yet.
+
+    Returns the per-target results of both phases.
+
+    """
+    serverwebroots = config.get('serverwebroot') or []
+    awsbucket = config.get('awsbucket')
+    index_only = config.get('awsbucket_index_only')
+
+    def _rclone(phase):
+        return functools.partial(
+            update_remote_storage_with_rclone,
+            repo_section,
+            awsbucket,
+            index_only,
+            options.verbose,
+            options.quiet,
+            not options.no_checksum,
+            phase=phase,
+        )
+
+    tasks = dict()
+    for d in serverwebroots:
+        tasks['serverwebroot ' + d['url']] = functools.partial(
+            update_serverwebroot, d, repo_section, phase=DEPLOY_PHASE_PACKAGES
+        )
+    if awsbucket:
+        tasks['awsbucket ' + awsbucket] = _rclone(DEPLOY_PHASE_PACKAGES)
+    results = {DEPLOY_PHASE_PACKAGES: run_deploy_tasks(tasks, options.jobs)}
+    failed = [k for k, v in results[DEPLOY_PHASE_PACKAGES].items() if 'error' in v]
+
+    tasks = dict()
+    for d in serverwebroots:
+        name = 'serverwebroot ' + d['url']
+        if name not in failed:
+            tasks[name] = functools.partial(
+                update_serverwebroot, d, repo_section, phase=DEPLOY_PHASE_INDEX
+            )
+    if awsbucket and 'awsbucket ' + awsbucket not in failed:
+        tasks['awsbucket ' + awsbucket] = _rclone(DEPLOY_PHASE_INDEX)
+    if config.get('servergitmirrors'):
+        # update_servergitmirrors will take care of multiple mirrors so don't need a foreach
+        tasks['servergitmirrors'] = functools.partial(
+            update_servergitmirrors, config['servergitmirrors'], repo_section
+        )
+    if config.get('androidobservatory'):
+        tasks['androidobservatory'] = functools.partial(
+            upload_to_android_observatory, repo_section
+        )
+    if config.get('virustotal_apikey'):
+        tasks['virustotal'] = functools.partial(
+            upload_to_virustotal,
+            repo_section,
+            config.get('virustotal_apikey'),
+            config.get('virustotal_requests_per_minute'),
+        )
+    if config.get('github_releases'):
+        tasks['github_releases'] = functools.partial(
+            upload_to_github_releases,
+            repo_section,
+            config.get('github_releases'),
+            config.get('github_token'),
+        )
+    results[DEPLOY_PHASE_INDEX] = run_deploy_tasks(tasks, options.jobs)
+    return results
+
+
 def main():
     parser = ArgumentParser()
     common.setup_global_opts(parser)
@@ -1068,9 +1667,25 @@ def main():
         default=False,
         help=_("If a git mirror gets to big, allow the archive to be deleted"),
     )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        default=False,
+        help=_("Upload with a full rsync run instead of only the changed files"),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help=_("How many deploy targets to upload to at the same time"),
+    )
     options = common.parse_args(parser)
     config = common.read_config()
 
+    global _repo_manifests
+    _repo_manifests = dict()
+
     if config.get('nonstandardwebroot') is True:
         standardwebroot = False
     else:
@@ -1144,45 +1759,34 @@ def main():
     ):
         repo_sections.append('unsigned')
 
+    for d in config.get('serverwebroot') or []:
+        check_serverwebroot(d, standardwebroot)
+
+    deploy_targets = dict()
     for repo_section in repo_sections:
         if local_copy_dir is not None:
             if config['sync_from_local_copy_dir']:
                 sync_from_localcopy(repo_section, local_copy_dir)
             else:
                 update_localcopy(repo_section, local_copy_dir)
-        if config.get('serverwebroot'):
-            update_serverwebroots(
-                config['serverwebroot'], repo_section, standardwebroot
-            )
-        if config.get('servergitmirrors'):
-            # update_servergitmirrors will take care of multiple mirrors so don't need a foreach
-            update_servergitmirrors(config['servergitmirrors'], repo_section)
-        if config.get('awsbucket'):
-            awsbucket = config['awsbucket']
-            index_only = config.get('awsbucket_index_only')
-            update_remote_storage_with_rclone(
-                repo_section,
-                awsbucket,
-                index_only,
-                options.verbose,
-                options.quiet,
-                not options.no_checksum,
-            )
-        if config.get('androidobservatory'):
-            upload_to_android_observatory(repo_section)
-        if config.get('virustotal_apikey'):
-            upload_to_virustotal(repo_section, config.get('virustotal_apikey'))
-        if config.get('github_releases'):
-            upload_to_github_releases(
-                repo_section, config.get('github_releases'), config.get('github_token')
-            )
+        deploy_targets[repo_section] = deploy_repo_section(
+            repo_section, config, options
+        )
 
     binary_transparency_remote = config.get('binary_transparency_remote')
     if binary_transparency_remote:
         push_binary_transparency(BINARY_TRANSPARENCY_DIR, binary_transparency_remote)
 
-    common.write_status_json(common.setup_status_output(start_timestamp))
-    sys.exit(0)
+    status_output = common.setup_status_output(start_timestamp)
+    status_output['deployTargets'] = deploy_targets
+    common.write_status_json(status_output)
+    failed = any(
+        'error' in result
+        for section in deploy_targets.values()
+        for phase in section.values()
+        for result in phase.values()
+    )
+    sys.exit(1 if failed else 0)
 
 
 if __name__ == "__main__":
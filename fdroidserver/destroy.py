@@ -31,19 +31,41 @@ import sys
 import traceback
 from argparse import ArgumentParser
 
-from . import common
+from . import common, up
 
 # TODO should this track whether it actually removed something?
 # What do `podman rm` and `vagrant destroy` do?
 
 
 def podman_rm(appid, vercode):
-    """Remove a Podman pod and all its containers."""
+    """Remove a Podman pod and all its containers.
+
+    A container claimed from the warm pool lives in the pod it was
+    created in, so that pod is looked up via the container.  Used
+    containers are never put back into the pool, instead the pool is
+    refilled in the background with a fresh container for the same
+    CPUs and memory.
+
+    """
     pod_name = common.get_pod_name(appid, vercode)
-    for p in common.get_podman_client().pods.list():
-        if p.name == pod_name:
-            logging.debug(f'Removing {pod_name}.')
-            p.remove(force=True)
+    client = common.get_podman_client()
+    container = common.find_podman_container(appid, vercode)
+    labels = {}
+    if container is not None:
+        labels = container.labels or {}
+    if container is not None and container.attrs.get('Pod'):
+        logging.debug(f'Removing pod of {container.name}.')
+        client.pods.get(container.attrs['Pod']).remove(force=True)
+    if client.pods.exists(pod_name):
+        logging.debug(f'Removing {pod_name}.')
+        client.pods.get(pod_name).remove(force=True)
+    common.set_podman_container_id(appid, vercode, None)
+    if common.get_config().get('podman_admission_control'):
+        up.release_podman_resources(appid, vercode)
+    up.spawn_fill_podman_pool(
+        cpus=labels.get(up.PODMAN_CPUS_LABEL),
+        memory=labels.get(up.PODMAN_MEMORY_LABEL),
+    )
 
 
 def destroy_wrapper(appid, vercode, virt_container_type):
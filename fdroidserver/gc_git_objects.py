@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+#
+# gc_git_objects.py - part of the F-Droid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Prune the shared git objects in the cachedir that no checkout uses anymore."""
+
+import argparse
+import logging
+import sys
+import traceback
+
+from fdroidserver import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    common.setup_global_opts(parser)
+    options = common.parse_args(parser)
+    common.set_console_logging(options.verbose)
+
+    try:
+        common.gc_git_shared_objects()
+    except Exception as e:
+        if options.verbose:
+            logging.error(traceback.format_exc())
+        else:
+            logging.error(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,32 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+import hashlib
 import json
+import logging
+import os
 import pathlib
+import threading
+import time
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import net
+
+API_URL = 'https://api.github.com'
+UPLOADS_URL = 'https://uploads.github.com'
+
+# the maximum page size that the GitHub API allows
+PER_PAGE = 100
+
+# how many release assets to upload at the same time
+UPLOAD_JOBS = 4
+
+# never wait longer than this for the rate limit to reset, in seconds
+MAX_RATE_LIMIT_WAIT = 3600
 
 
 class GithubApi:
@@ -30,55 +52,153 @@ class GithubApi:
     transformed data that's playing well with other fdroidserver functions.
 
     With the GitHub API, the token is optional, but it has pretty
-    severe rate limiting.
+    severe rate limiting.  All requests go through the shared
+    keep-alive session from `net.get_session()`.  When the rate limit
+    is used up, requests wait until it is reset.  If a cachedir is
+    given, the lists of tags and releases are cached there together
+    with their ETags, so unchanged pages can be checked with
+    conditional requests, which do not count against the rate limit.
 
     """
 
-    def __init__(self, api_token, repo_path):
+    def __init__(self, api_token, repo_path, cachedir=None, jobs=UPLOAD_JOBS):
         self._api_token = api_token
         if repo_path.startswith("https://github.com/"):
             self._repo_path = repo_path[19:]
         else:
             self._repo_path = repo_path
+        self._cachedir = cachedir
+        self._jobs = jobs
+        self._etags = None
+        self._rate_limit_reset = 0
+        self._rate_limit_lock = threading.Lock()
 
-    def _req(self, url, data=None):
+    def _headers(self):
         h = {
             "Accept": "application/vnd.github+json",
             "X-GitHub-Api-Version": "2022-11-28",
         }
         if self._api_token:
             h["Authorization"] = f"Bearer {self._api_token}"
-        return urllib.request.Request(
-            url,
-            headers=h,
-            data=data,
-        )
+        return h
+
+    def _wait_for_rate_limit(self):
+        with self._rate_limit_lock:
+            wait = min(self._rate_limit_reset - time.time(), MAX_RATE_LIMIT_WAIT)
+        if wait > 0:
+            logging.info(f"GitHub API rate limit reached, waiting {wait:.0f}s")
+            time.sleep(wait)
+
+    def _update_rate_limit(self, r):
+        """Record when to continue if the response says the rate limit is used up.
+
+        https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+        """
+        reset = None
+        retry_after = r.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            reset = time.time() + int(retry_after)
+        elif r.headers.get('X-RateLimit-Remaining') == '0':
+            try:
+                reset = int(r.headers.get('X-RateLimit-Reset', ''))
+            except ValueError:
+                reset = time.time() + 60
+        if reset is None:
+            return False
+        with self._rate_limit_lock:
+            self._rate_limit_reset = max(self._rate_limit_reset, reset)
+        return True
+
+    def _request(self, method, url, headers=None, data=None):
+        """Send a request, retrying once if it was refused by the rate limit.
+
+        :raises: requests.exceptions.HTTPError for error responses
+        """
+        h = self._headers()
+        h.update(headers or {})
+        for attempt in range(2):
+            self._wait_for_rate_limit()
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            r = net.get_session().request(
+                method, url, headers=h, data=data, timeout=300
+            )
+            limited = self._update_rate_limit(r)
+            if not (limited and r.status_code in (403, 429)):
+                break
+        r.raise_for_status()
+        return r
+
+    def _get_etag_cache_path(self):
+        name = hashlib.sha256(self._repo_path.encode()).hexdigest()[:16]
+        return os.path.join(self._cachedir, 'github', name + '.json')
+
+    def _load_etag_cache(self):
+        if self._etags is None:
+            self._etags = dict()
+            if self._cachedir:
+                try:
+                    with open(self._get_etag_cache_path()) as fp:
+                        self._etags = json.load(fp)
+                except (OSError, ValueError):
+                    pass
+        return self._etags
+
+    def _save_etag_cache(self):
+        if not self._cachedir:
+            return
+        path = self._get_etag_cache_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(self._etags, fp)
+        os.replace(path + '.tmp', path)
+
+    def _list(self, path, key):
+        """Get the value of key from all items on all pages of a list API endpoint.
+
+        Each page is stored with its ETag, so that pages which did not
+        change are not downloaded again.
+        """
+        url = f"{API_URL}/repos/{self._repo_path}/{path}?per_page={PER_PAGE}"
+        cache = self._load_etag_cache()
+        values = []
+        while url:
+            cached = cache.get(url)
+            headers = {'If-None-Match': cached['etag']} if cached else None
+            r = self._request('GET', url, headers=headers)
+            if r.status_code == 304:
+                page, next_url = cached['values'], cached.get('next')
+            else:
+                page = [item.get(key) for item in r.json()]
+                next_url = r.links.get('next', {}).get('url')
+                if r.headers.get('ETag'):
+                    cache[url] = {
+                        'etag': r.headers['ETag'],
+                        'values': page,
+                        'next': next_url,
+                    }
+                else:
+                    cache.pop(url, None)
+            values += [v for v in page if v]
+            url = next_url
+        self._save_etag_cache()
+        return values
 
     def list_released_tags(self):
         """List of all tags that are associated with a release for this repo on GitHub."""
-        names = []
-        req = self._req(f"https://api.github.com/repos/{self._repo_path}/releases")
-        with urllib.request.urlopen(req) as resp:  # nosec CWE-22 disable bandit warning
-            releases = json.load(resp)
-            for release in releases:
-                names.append(release['tag_name'])
-        return names
+        return self._list('releases', 'tag_name')
 
     def list_unreleased_tags(self):
         all_tags = self.list_all_tags()
-        released_tags = self.list_released_tags()
+        released_tags = set(self.list_released_tags())
         return [x for x in all_tags if x not in released_tags]
 
     def get_latest_apk(self):
-        req = self._req(
-            f"https://api.github.com/repos/{self._repo_path}/releases/latest"
-        )
-        with urllib.request.urlopen(req) as resp:  # nosec CWE-22 disable bandit warning
-            assets = json.load(resp)['assets']
-            for asset in assets:
-                url = asset.get('browser_download_url')
-                if url and url.endswith('.apk'):
-                    return url
+        r = self._request('GET', f"{API_URL}/repos/{self._repo_path}/releases/latest")
+        for asset in r.json()['assets']:
+            url = asset.get('browser_download_url')
+            if url and url.endswith('.apk'):
+                return url
 
     def tag_exists(self, tag):
         """
@@ -86,26 +206,18 @@ class GithubApi:
 
         https://docs.github.com/en/rest/git/refs?apiVersion=2022-11-28#list-matching-references--fine-grained-access-tokens
         """
-        req = self._req(
-            f"https://api.github.com/repos/{self._repo_path}/git/matching-refs/tags/{tag}"
+        r = self._request(
+            'GET',
+            f"{API_URL}/repos/{self._repo_path}/git/matching-refs/tags/{tag}",
         )
-        with urllib.request.urlopen(req) as resp:  # nosec CWE-22 disable bandit warning
-            rd = json.load(resp)
-            return len(rd) == 1 and rd[0].get("ref", False) == f"refs/tags/{tag}"
-        return False
+        return any(ref.get("ref") == f"refs/tags/{tag}" for ref in r.json())
 
     def list_all_tags(self):
         """Get list of all tags for this repo on GitHub."""
         tags = []
-        req = self._req(
-            f"https://api.github.com/repos/{self._repo_path}/git/matching-refs/tags/"
-        )
-        with urllib.request.urlopen(req) as resp:  # nosec CWE-22 disable bandit warning
-            refs = json.load(resp)
-            for ref in refs:
-                r = ref.get('ref', '')
-                if r.startswith('refs/tags/'):
-                    tags.append(r[10:])
+        for ref in self._list('git/matching-refs/tags/', 'ref'):
+            if ref.startswith('refs/tags/'):
+                tags.append(ref[10:])
         return tags
 
     def create_release(self, tag, files, body=''):
@@ -115,7 +227,7 @@ class GithubApi:
         also see: https://docs.github.com/en/rest/releases/releases?apiVersion=2022-11-28#create-a-release
 
         :returns: True if release was created, False if release already exists
-        :raises: urllib exceptions in case of network or api errors, also
+        :raises: requests exceptions in case of network or api errors, also
                  raises an exception when the tag doesn't exists.
         """
         # Querying github to create a new release for a non-existent tag, will
@@ -126,30 +238,32 @@ class GithubApi:
                 f"can't create github release for {self._repo_path} {tag}, tag doesn't exists"
             )
         # create the relase on github
-        req = self._req(
-            f"https://api.github.com/repos/{self._repo_path}/releases",
-            data=json.dumps(
-                {
-                    "tag_name": tag,
-                    "body": body,
-                }
-            ).encode("utf-8"),
-        )
         try:
-            with urllib.request.urlopen(  # nosec CWE-22 disable bandit warning
-                req
-            ) as resp:
-                release_id = json.load(resp)['id']
-        except urllib.error.HTTPError as e:
-            if e.status == 422:
-                codes = [x['code'] for x in json.load(e).get('errors', [])]
-                if "already_exists" in codes:
+            r = self._request(
+                'POST',
+                f"{API_URL}/repos/{self._repo_path}/releases",
+                data=json.dumps(
+                    {
+                        "tag_name": tag,
+                        "body": body,
+                    }
+                ).encode("utf-8"),
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 422:
+                errors = e.response.json().get('errors', [])
+                if "already_exists" in [x.get('code') for x in errors]:
                     return False
             raise e
+        release_id = r.json()['id']
 
-        # attach / upload all files for the relase
-        for file in files:
-            self._create_release_asset(release_id, file)
+        # attach / upload all files for the relase, a few at a time
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            list(
+                executor.map(
+                    functools.partial(self._create_release_asset, release_id), files
+                )
+            )
 
         return True
 
@@ -162,17 +276,12 @@ class GithubApi:
         also see: https://docs.github.com/en/rest/releases/assets?apiVersion=2022-11-28#upload-a-release-asset
         """
         file = pathlib.Path(file)
+        name = urllib.parse.quote(file.name)
         with open(file, 'rb') as f:
-            req = urllib.request.Request(
-                f"https://uploads.github.com/repos/{self._repo_path}/releases/{release_id}/assets?name={file.name}",
-                headers={
-                    "Accept": "application/vnd.github+json",
-                    "Authorization": f"Bearer {self._api_token}",
-                    "X-GitHub-Api-Version": "2022-11-28",
-                    "Content-Type": "application/octet-stream",
-                },
-                data=f.read(),
+            self._request(
+                'POST',
+                f"{UPLOADS_URL}/repos/{self._repo_path}/releases/{release_id}/assets?name={name}",
+                headers={"Content-Type": "application/octet-stream"},
+                data=f,
             )
-            with urllib.request.urlopen(req):  # nosec CWE-22 disable bandit warning
-                return True
-            return False
+        return True
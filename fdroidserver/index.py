@@ -538,6 +538,29 @@ def dict_diff(source, target):
     return result
 
 
+def apply_dict_diff(source, diff):
+    """Apply a diff made by dict_diff() to source, and return the result.
+
+    This follows the JSON Merge Patch rules (RFC 7386) that the
+    index-v2 diffs are made with: null removes a key, dicts are merged
+    recursively and everything else is replaced.  source is modified
+    in place.
+
+    """
+    if not isinstance(diff, dict) or not isinstance(source, dict):
+        return diff
+
+    for key, value in diff.items():
+        if value is None:
+            source.pop(key, None)
+        elif isinstance(value, dict) and isinstance(source.get(key), dict):
+            source[key] = apply_dict_diff(source[key], value)
+        else:
+            source[key] = value
+
+    return source
+
+
 def datetime_from_millis(millis):
     """Convert epoch milliseconds to datetime instance.
 
@@ -1893,7 +1916,72 @@ def download_repo_index_v1(url_str, etag=None, verify_fingerprint=True, timeout=
         return index, new_etag
 
 
-def download_repo_index_v2(url_str, etag=None, verify_fingerprint=True, timeout=None):
+def _get_index_v2_cache_path(cachedir, url, fingerprint):
+    """Get the cache file for the index-v2 of a repo URL signed by fingerprint."""
+    key = hashlib.sha256(f'{url}\0{fingerprint}'.encode()).hexdigest()[:16]
+    return os.path.join(cachedir, 'index-v2', key + '.json')
+
+
+def _write_index_v2_cache(cachefile, data):
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    with open(cachefile + '.tmp', 'w', encoding='utf-8') as fp:
+        json.dump(data, fp, ensure_ascii=False)
+    os.replace(cachefile + '.tmp', cachefile)
+
+
+def _update_cached_index_v2(cachefile, url, entry):
+    """Bring the cached index up to date with entry, using the published diffs.
+
+    Only the diff from the timestamp of the cached index is
+    downloaded.  It is verified with the SHA-256 from the signed
+    entry, just like the full index would be.  The cache only ever
+    contains verified data, so the result is as trustworthy as a full
+    download.
+
+    Returns
+    -------
+    The current index, or None if it needs to be fully downloaded.
+
+    """
+    from . import net
+
+    try:
+        with open(cachefile, encoding='utf-8') as fp:
+            data = json.load(fp)
+        timestamp = data['repo']['timestamp']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if timestamp == entry['timestamp']:
+        logging.debug(_('Using cached index-v2 from {path}').format(path=cachefile))
+        return data
+
+    diff_entry = entry.get('diffs', {}).get(str(timestamp))
+    if not diff_entry:
+        return None
+    mirrors = common.get_mirrors(url, diff_entry['name'][1:])
+    f = net.download_using_mirrors(mirrors)
+    with open(f, 'rb') as fp:
+        diff = fp.read()
+    if diff_entry['sha256'] != hashlib.sha256(diff).hexdigest():
+        raise VerificationException(
+            _("SHA-256 of {url} does not match entry!").format(url=mirrors[0]['url'])
+        )
+    data = apply_dict_diff(data, json.loads(diff))
+    num_packages = len(data.get('packages', {}))
+    if (
+        data['repo'].get('timestamp') != entry['timestamp']
+        or entry['index'].get('numPackages', num_packages) != num_packages
+    ):
+        logging.warning(_('Applying index-v2 diff failed, downloading the full index'))
+        return None
+    _write_index_v2_cache(cachefile, data)
+    logging.debug(_('Updated cached index-v2 in {path}').format(path=cachefile))
+    return data
+
+
+def download_repo_index_v2(
+    url_str, etag=None, verify_fingerprint=True, timeout=None, cachedir=None
+):
     """Download and verifies index v2 file, then returns its data.
 
     Downloads the repository index from the given :param url_str and
@@ -1901,6 +1989,12 @@ def download_repo_index_v2(url_str, etag=None, verify_fingerprint=True, timeout=
     is not False.  In order to verify the data, the fingerprint must
     be provided as part of the URL.
 
+    If :param cachedir is given, the last verified index is kept
+    there.  Then only the signed entry is downloaded when the index
+    did not change, and only the diff when one is published for the
+    cached version.  The full index is only downloaded if neither is
+    possible.
+
     Raises
     ------
     VerificationException() if the repository could not be verified
@@ -1938,6 +2032,13 @@ def download_repo_index_v2(url_str, etag=None, verify_fingerprint=True, timeout=
     f = net.download_using_mirrors(mirrors)
     entry, public_key, fingerprint = get_index_from_jar(f, fingerprint)
 
+    cachefile = None
+    if cachedir:
+        cachefile = _get_index_v2_cache_path(cachedir, url.geturl(), fingerprint)
+        data = _update_cached_index_v2(cachefile, url, entry)
+        if data is not None:
+            return data, None
+
     sha256 = entry['index']['sha256']
     mirrors = common.get_mirrors(url, entry['index']['name'][1:])
     f = net.download_using_mirrors(mirrors)
@@ -1947,7 +2048,10 @@ def download_repo_index_v2(url_str, etag=None, verify_fingerprint=True, timeout=
         raise VerificationException(
             _("SHA-256 of {url} does not match entry!").format(url=url)
         )
-    return json.loads(index), None
+    data = json.loads(index)
+    if cachefile:
+        _write_index_v2_cache(cachefile, data)
+    return data, None
 
 
 def get_index_from_jar(jarfile, fingerprint=None, allow_deprecated=False):
@@ -23,8 +23,10 @@ import logging
 import os
 import sys
 import termios
+import time
 import tty
 from argparse import ArgumentParser, BooleanOptionalAction
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlencode, urlparse, urlunparse
 
@@ -56,6 +58,11 @@ MAVEN_CENTRAL_MIRRORS = [
     },
 ]
 
+# how often to retry `adb install` when adb fails, and the seconds to
+# wait before the first retry, which grow with each retry
+INSTALL_RETRIES = 2
+INSTALL_RETRY_DELAY = 5
+
 
 # pylint: disable=unused-argument
 def download_apk(appid='org.fdroid.fdroid', privacy_mode=False):
@@ -236,40 +243,109 @@ def devices():
     return serials
 
 
-def install_apks_to_devices(apks):
-    """Install the list of APKs to all Android devices reported by `adb devices`."""
-    for apk in apks:
-        # Get device list each time to avoid device not found errors
-        devs = devices()
-        if not devs:
-            raise FDroidException(_("No attached devices found"))
-        logging.info(_("Installing %s...") % apk)
-        for dev in devs:
-            logging.info(
-                _("Installing '{apkfilename}' on {dev}...").format(
-                    apkfilename=apk, dev=dev
+def _install_apk_to_device(apk, dev, retries):
+    """Run `adb install`, retrying when adb itself fails.
+
+    Errors from adb, like a device that went offline or a USB
+    connection that was reset, are often transient.  Failures reported
+    by the package manager on the device are not retried, since they
+    will not change by trying again.
+
+    Returns
+    -------
+    None for success, otherwise the error reported by the device.
+
+    """
+    for attempt in range(retries + 1):
+        p = common.SdkToolsPopen(['adb', "-s", dev, "install", apk])
+        for line in p.output.splitlines():
+            if line.startswith("Failure"):
+                return line[9:-1]
+        if p.returncode == 0:
+            return None
+        error = p.output.strip().splitlines()[-1:] or [str(p.returncode)]
+        if attempt < retries:
+            logging.warning(
+                _("adb failed on {dev}, retrying: {error}").format(
+                    dev=dev, error=error[0]
                 )
             )
-            p = common.SdkToolsPopen(['adb', "-s", dev, "install", apk])
-            fail = ""
-            for line in p.output.splitlines():
-                if line.startswith("Failure"):
-                    fail = line[9:-1]
-            if not fail:
-                continue
+            time.sleep(INSTALL_RETRY_DELAY * (attempt + 1))
+    raise FDroidException(error[0])
 
-            if fail == "INSTALL_FAILED_ALREADY_EXISTS":
-                logging.warning(
-                    _('"{apkfilename}" is already installed on {dev}.').format(
-                        apkfilename=apk, dev=dev
-                    )
+
+def _install_apks_to_device(apks, dev, retries):
+    """Install all APKs to one device, one after the other."""
+    result = {'installed': [], 'alreadyInstalled': [], 'failed': {}}
+    for i, apk in enumerate(apks, start=1):
+        logging.info(
+            _("Installing '{apkfilename}' on {dev} ({i}/{total})...").format(
+                apkfilename=apk, dev=dev, i=i, total=len(apks)
+            )
+        )
+        try:
+            fail = _install_apk_to_device(apk, dev, retries)
+        except FDroidException as e:
+            fail = str(e)
+        if not fail:
+            result['installed'].append(apk)
+        elif fail == "INSTALL_FAILED_ALREADY_EXISTS":
+            logging.warning(
+                _('"{apkfilename}" is already installed on {dev}.').format(
+                    apkfilename=apk, dev=dev
                 )
-            else:
-                raise FDroidException(
-                    _("Failed to install '{apkfilename}' on {dev}: {error}").format(
-                        apkfilename=apk, dev=dev, error=fail
-                    )
+            )
+            result['alreadyInstalled'].append(apk)
+        else:
+            logging.error(
+                _("Failed to install '{apkfilename}' on {dev}: {error}").format(
+                    apkfilename=apk, dev=dev, error=fail
                 )
+            )
+            result['failed'][apk] = fail
+    return result
+
+
+def install_apks_to_devices(apks, retries=INSTALL_RETRIES):
+    """Install the list of APKs to all Android devices reported by `adb devices`.
+
+    Each device gets its own worker, so all devices are installed to
+    at the same time.  A failed install does not stop the others.
+    When all are done, a summary is logged and returned as a dict of
+    device serial to the results, and an exception is raised if any
+    install failed.
+
+    """
+    apks = list(apks)
+    devs = devices()
+    if not devs:
+        raise FDroidException(_("No attached devices found"))
+    with ThreadPoolExecutor(max_workers=len(devs)) as executor:
+        futures = {
+            dev: executor.submit(_install_apks_to_device, apks, dev, retries)
+            for dev in devs
+        }
+        results = {dev: future.result() for dev, future in futures.items()}
+
+    failed = list()
+    for dev, result in results.items():
+        logging.info(
+            _(
+                "{dev}: {installed} installed, {already} already installed, {failed} failed"
+            ).format(
+                dev=dev,
+                installed=len(result['installed']),
+                already=len(result['alreadyInstalled']),
+                failed=len(result['failed']),
+            )
+        )
+        for apk, error in result['failed'].items():
+            failed.append(f'{dev} {apk}: {error}')
+    if failed:
+        raise FDroidException(
+            _("Failed to install on some devices:") + '\n' + '\n'.join(failed)
+        )
+    return results
 
 
 def read_char():
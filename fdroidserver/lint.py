@@ -1678,12 +1678,15 @@ BOOL_KEYS = (
     'androidobservatory',
     'build_server_always',
     'deploy_process_logs',
+    'git_shared_objects',
     'keep_when_not_allowed',
     'make_current_version_link',
     'nonstandardwebroot',
     'per_app_repos',
+    'podman_admission_control',
     'refresh_scanner',
     'scan_binary',
+    'srclib_cache',
     'sync_from_local_copy_dir',
 )
 
@@ -1699,9 +1702,11 @@ CHECK_CONFIG_KEYS = (
     'awsbucket',
     'awsbucket_index_only',
     'binary_transparency_remote',
+    'build_input_cache_size',
     'cachedir',
     'char_limits',
     'current_version_name_source',
+    'git_clone_filter',
     'git_mirror_size_limit',
     'github_token',
     'gpghome',
@@ -1721,6 +1726,7 @@ CHECK_CONFIG_KEYS = (
     'mvn3',
     'ndk_paths',
     'path_to_custom_rclone_config',
+    'podman_buildserver_image_digest',
     'rclone_config',
     'repo',
     'repo_description',
@@ -1737,6 +1743,7 @@ CHECK_CONFIG_KEYS = (
     'servergitmirrors',
     'serverwebroot',
     'smartcardoptions',
+    'srclib_cache_size',
     'sync_from_local_copy_dir',
     'uninstall_list',
     'virustotal_apikey',
@@ -543,6 +543,34 @@ def read_srclibs():
         srclibs[metadatapath.stem] = parse_yaml_srclib(metadatapath)
 
 
+def get_metadata_files(appid_to_vercode={}, sort_by_time=False):
+    """Return the list of metadata files that read_metadata() reads.
+
+    Parameters
+    ----------
+    appid_to_vercode
+        Dict of apps to return with appids a keys and versionCodes as values.
+    sort_by_time
+        Sort the files by time of last modification, newest first.
+    """
+    if appid_to_vercode:
+        metadatafiles = common.get_metadata_files(appid_to_vercode)
+    else:
+        metadatafiles = list(Path('metadata').glob('*.yml')) + list(
+            Path('.').glob('.fdroid.yml')
+        )
+
+    if sort_by_time:
+        entries = ((path.stat().st_mtime, path) for path in metadatafiles)
+        metadatafiles = []
+        for _ignored, path in sorted(entries, reverse=True):
+            metadatafiles.append(path)
+    else:
+        # most things want the index alpha sorted for stability
+        metadatafiles = sorted(metadatafiles)
+    return metadatafiles
+
+
 def read_metadata(appid_to_vercode={}, sort_by_time=False, enabled_only=False):
     """Return a list of App instances sorted newest first.
 
@@ -572,23 +600,7 @@ def read_metadata(appid_to_vercode={}, sort_by_time=False, enabled_only=False):
     for basedir in ('metadata', 'tmp'):
         Path(basedir).mkdir(exist_ok=True)
 
-    if appid_to_vercode:
-        metadatafiles = common.get_metadata_files(appid_to_vercode)
-    else:
-        metadatafiles = list(Path('metadata').glob('*.yml')) + list(
-            Path('.').glob('.fdroid.yml')
-        )
-
-    if sort_by_time:
-        entries = ((path.stat().st_mtime, path) for path in metadatafiles)
-        metadatafiles = []
-        for _ignored, path in sorted(entries, reverse=True):
-            metadatafiles.append(path)
-    else:
-        # most things want the index alpha sorted for stability
-        metadatafiles = sorted(metadatafiles)
-
-    for metadatapath in metadatafiles:
+    for metadatapath in get_metadata_files(appid_to_vercode, sort_by_time):
         appid = metadatapath.stem
         if appid != '.fdroid' and not common.is_valid_package_name(appid):
             _warn_or_exception(
@@ -1,45 +1,174 @@
 #!/usr/bin/env python3
 
 import ipaddress
+import json
 import logging
 import os
 import posixpath
 import socket
-import subprocess
 import sys
+import threading
 import urllib.parse
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
-from . import _, common, index, update
+import requests
 
+from . import _, common, index, net, update
+from .exception import FDroidException
 
-def _run_wget(path, urls, verbose=False):
-    if verbose:
-        verbose = '--verbose'
-    else:
-        verbose = '--no-verbose'
-
-    if not urls:
-        return
-    logging.debug(_('Running wget in {path}').format(path=path))
-    cwd = os.getcwd()
-    os.makedirs(path, exist_ok=True)
-    os.chdir(path)
-    urls_file = '.fdroid-mirror-wget-input-file'
-    with open(urls_file, 'w') as fp:
-        for url in urls:
-            fp.write(url.split('?')[0] + '\n')  # wget puts query string in the filename
-    subprocess.call(
-        [
-            'wget',
-            verbose,
-            '--continue',
-            '--user-agent="fdroid mirror"',
-            '--input-file=' + urls_file,
-        ]
-    )
-    os.remove(urls_file)
-    os.chdir(cwd)  # leave the working env the way we found it
+
+MIRROR_STATE_FILE = '.fdroid-mirror-state.json'
+
+
+class MirrorDownloader:
+    """Download lots of files concurrently, verifying and remembering them.
+
+    Each file is downloaded into a .part file next to it.  Files with a
+    known SHA-256 are verified before they are moved into place, and
+    only those are resumed with an HTTP Range request when the mirror
+    run was interrupted.  Files without one, like index-v1.jar, icons
+    and screenshots, are always downloaded from the start.  All
+    complete files are recorded in a state file in basedir, so that a
+    rerun does not have to check them again.
+
+    """
+
+    def __init__(self, basedir, jobs=4, session=None):
+        self.basedir = basedir
+        self.jobs = jobs
+        self.session = session or net.get_session(https_only=False)
+        self.state_path = os.path.join(basedir, MIRROR_STATE_FILE)
+        os.makedirs(basedir, exist_ok=True)
+        self.state = dict()
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as fp:
+                self.state = json.load(fp)
+        self.queue = []
+        self.failed = []
+        self._lock = threading.Lock()
+        self._host_semaphores = dict()
+        self._unsaved = 0
+
+    def add(self, url, path, sha256=None, size=None, always=False, optional=False):
+        """Queue url to be downloaded to path, unless that is already complete.
+
+        Parameters
+        ----------
+        sha256
+          The expected SHA-256 of the file, e.g. the `hash` from the index.
+        size
+          The expected size, to avoid hashing files that cannot match.
+        always
+          Always download, e.g. for index files that change in place.
+        optional
+          It is not an error if the file is missing on the server.
+
+        """
+        relpath = os.path.relpath(path, self.basedir)
+        if not always and self._is_complete(relpath, path, sha256, size):
+            return
+        self.queue.append((url.split('?')[0], path, relpath, sha256, optional))
+
+    def _is_complete(self, relpath, path, sha256, size):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        entry = self.state.get(relpath)
+        if (
+            entry
+            and entry['size'] == st.st_size
+            and entry['mtime'] == st.st_mtime
+            and (sha256 is None or entry.get('sha256') == sha256)
+        ):
+            return True
+        if sha256 is None:
+            # nothing to check against, same as `wget --continue`
+            self._record(relpath, path, None)
+            return True
+        if size is not None and st.st_size != size:
+            return False
+        if common.sha256sum(path) != sha256:
+            return False
+        self._record(relpath, path, sha256)
+        return True
+
+    def _record(self, relpath, path, sha256):
+        st = os.stat(path)
+        with self._lock:
+            self.state[relpath] = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'sha256': sha256,
+            }
+            self._unsaved += 1
+            if self._unsaved >= 100:
+                self._save_state()
+
+    def _save_state(self):
+        """Atomically write the state file, the caller must hold the lock."""
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.state, fp)
+        os.replace(tmp, self.state_path)
+        self._unsaved = 0
+
+    def _download(self, url, path, relpath, sha256, optional):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._host_semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.jobs)
+            )
+        part = path + '.part'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with semaphore:
+                logging.debug(_('Downloading {url}').format(url=url))
+                hashes = {'sha256': None}
+                net.download_file(
+                    url,
+                    part,
+                    session=self.session,
+                    resume=bool(sha256),
+                    hashes=hashes,
+                )
+            if sha256 and hashes['sha256'] != sha256:
+                os.remove(part)
+                raise FDroidException(
+                    _('{path} does not match the SHA-256 from the index!').format(
+                        path=relpath
+                    )
+                )
+            os.replace(part, path)
+            self._record(relpath, path, sha256)
+        except requests.exceptions.HTTPError as e:
+            if optional and e.response is not None and e.response.status_code == 404:
+                logging.debug(_('{url} does not exist').format(url=url))
+                return
+            logging.error(
+                _('Downloading {url} failed: {error}').format(url=url, error=e)
+            )
+            self.failed.append(relpath)
+        except Exception as e:
+            logging.error(
+                _('Downloading {url} failed: {error}').format(url=url, error=e)
+            )
+            self.failed.append(relpath)
+
+    def run(self):
+        """Download everything in the queue, returning the paths that failed."""
+        queue, self.queue = self.queue, []
+        hosts = {urllib.parse.urlsplit(item[0]).netloc for item in queue}
+        logging.info(_('Downloading {count} files').format(count=len(queue)))
+        try:
+            if queue:
+                with ThreadPoolExecutor(max_workers=self.jobs * len(hosts)) as executor:
+                    list(executor.map(lambda item: self._download(*item), queue))
+        finally:
+            with self._lock:
+                self._save_state()
+        return self.failed
 
 
 def main():
@@ -86,6 +215,13 @@ def main():
     parser.add_argument(
         "--output-dir", default=None, help=_("The directory to write the mirror to")
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help=_("How many files to download from each host at the same time"),
+    )
     options = common.parse_args(parser)
 
     common.set_console_logging(options.verbose, options.color)
@@ -179,75 +315,83 @@ def main():
     else:
         sections = ('repo',)
 
+    downloader = MirrorDownloader(basedir, jobs=options.jobs)
     for section in sections:
         sectiondir = os.path.join(basedir, section)
 
-        urls = []
         data, etag, index_url = _get_index(section)
         if index_url:
-            urls.append(index_url)
+            downloader.add(
+                index_url, os.path.join(sectiondir, 'index-v1.jar'), always=True
+            )
 
         os.makedirs(sectiondir, exist_ok=True)
-        os.chdir(sectiondir)
         for icondir in update.get_icon_dirs(section):
             os.makedirs(os.path.join(sectiondir, icondir), exist_ok=True)
 
         for packageName, packageList in data['packages'].items():
             for package in packageList:
-                to_fetch = []
-                keys = ['apkName']
-                if options.src_tarballs:
-                    keys.append('srcname')
-                for k in keys:
-                    if k in package:
-                        to_fetch.append(package[k])
-                    elif k == 'apkName':
-                        logging.error(
-                            _('{appid} is missing {name}').format(
-                                appid=package['packageName'], name=k
-                            )
+                if 'apkName' not in package:
+                    logging.error(
+                        _('{appid} is missing {name}').format(
+                            appid=package['packageName'], name='apkName'
+                        )
+                    )
+                    continue
+                f = package['apkName']
+                sha256 = None
+                if package.get('hashType', 'sha256') == 'sha256':
+                    sha256 = package.get('hash')
+                downloader.add(
+                    _append_to_url_path(section, f),
+                    os.path.join(sectiondir, f),
+                    sha256=sha256,
+                    size=package.get('size'),
+                )
+                if options.pgp_signatures:
+                    downloader.add(
+                        _append_to_url_path(section, f + '.asc'),
+                        os.path.join(sectiondir, f + '.asc'),
+                        optional=True,
+                    )
+                if options.build_logs and f.endswith('.apk'):
+                    downloader.add(
+                        _append_to_url_path(section, f[:-4] + '.log.gz'),
+                        os.path.join(sectiondir, f[:-4] + '.log.gz'),
+                        optional=True,
+                    )
+                if options.src_tarballs and 'srcname' in package:
+                    srcname = package['srcname']
+                    downloader.add(
+                        _append_to_url_path(section, srcname),
+                        os.path.join(sectiondir, srcname),
+                    )
+                    if options.pgp_signatures:
+                        downloader.add(
+                            _append_to_url_path(section, srcname + '.asc'),
+                            os.path.join(sectiondir, srcname + '.asc'),
+                            optional=True,
                         )
-                for f in to_fetch:
-                    if not os.path.exists(f) or (
-                        f.endswith('.apk') and os.path.getsize(f) != package['size']
-                    ):
-                        urls.append(_append_to_url_path(section, f))
-                        if options.pgp_signatures:
-                            urls.append(_append_to_url_path(section, f + '.asc'))
-                        if options.build_logs and f.endswith('.apk'):
-                            urls.append(
-                                _append_to_url_path(section, f[:-4] + '.log.gz')
-                            )
-
-        _run_wget(sectiondir, urls, options.verbose)
 
         for app in data['apps']:
             localized = app.get('localized')
             if localized:
                 for locale, d in localized.items():
-                    urls = []
                     components = (section, app['packageName'], locale)
                     for k in update.GRAPHIC_NAMES:
                         f = d.get(k)
                         if f:
-                            filepath_tuple = components + (f,)
-                            urls.append(_append_to_url_path(*filepath_tuple))
-                    _run_wget(os.path.join(basedir, *components), urls, options.verbose)
+                            downloader.add(
+                                _append_to_url_path(*components, f),
+                                os.path.join(basedir, *components, f),
+                            )
                     for k in update.SCREENSHOT_DIRS:
-                        urls = []
-                        filelist = d.get(k)
-                        if filelist:
-                            components = (section, app['packageName'], locale, k)
-                            for f in filelist:
-                                filepath_tuple = components + (f,)
-                                urls.append(_append_to_url_path(*filepath_tuple))
-                            _run_wget(
-                                os.path.join(basedir, *components),
-                                urls,
-                                options.verbose,
+                        for f in d.get(k) or []:
+                            downloader.add(
+                                _append_to_url_path(*components, k, f),
+                                os.path.join(basedir, *components, k, f),
                             )
 
-        urls = dict()
         for app in data['apps']:
             if 'icon' not in app:
                 logging.error(
@@ -256,20 +400,18 @@ def main():
                 continue
             icon = app['icon']
             for icondir in update.get_icon_dirs(section):
-                url = _append_to_url_path(icondir, icon)
-                if icondir not in urls:
-                    urls[icondir] = []
-                urls[icondir].append(url)
-
-        for icondir in update.get_icon_dirs(section):
-            print(icondir, 'icondir in urls', icondir in urls, sep='\t')
-            if icondir in urls:
-                _run_wget(
-                    os.path.join(basedir, icondir),
-                    urls[icondir],
-                    options.verbose,
+                downloader.add(
+                    _append_to_url_path(icondir, icon),
+                    os.path.join(basedir, icondir, icon),
                 )
 
+    failed = downloader.run()
+    if failed:
+        logging.error(
+            _('{count} files could not be mirrored').format(count=len(failed))
+        )
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -18,10 +18,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import copy
+import hashlib
 import logging
 import os
 import random
 import tempfile
+import threading
 import time
 import urllib
 
@@ -36,6 +38,143 @@ logger = logging.getLogger(__name__)
 HEADERS = {'User-Agent': 'F-Droid'}
 
 
+# big enough to not need a syscall for every little piece of a big APK
+CHUNK_SIZE = 1024 * 1024
+
+# how many keep-alive connections each shared session keeps per host
+POOL_SIZE = 16
+
+_sessions = dict()
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_session(https_only=True, retries=3, backoff_factor=0.1):
+    """Get a shared requests session with a pool of keep-alive connections.
+
+    There is one session per combination of the arguments and per
+    process, so forked processes do not share the sockets.  The
+    requests retry logic applies to failed DNS lookups, socket
+    connections and connection timeouts, never to requests where data
+    has made it to the server.
+
+    """
+    global _sessions_pid
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        key = (https_only, retries, backoff_factor)
+        if key not in _sessions:
+            if retries:
+                max_retries = Retry(total=retries, backoff_factor=backoff_factor)
+                adapter = HTTPAdapter(pool_maxsize=POOL_SIZE, max_retries=max_retries)
+            else:
+                adapter = HTTPAdapter(pool_maxsize=POOL_SIZE)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            if https_only:
+                for k in list(session.adapters):
+                    if k != 'https://':
+                        del session.adapters[k]
+            else:
+                session.mount('http://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+class TokenBucket:
+    """Limit the rate of requests to an API quota, shared between threads.
+
+    The bucket holds up to capacity tokens and is refilled with rate
+    tokens per second.  Every request takes one token, waiting until
+    one is available.  When the server says the quota is used up
+    anyway, pause() makes everyone wait.
+
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.requests = 0
+        self.started = self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Give out no tokens for the next seconds."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def requests_per_minute(self):
+        """Return the average rate of requests since the start."""
+        minutes = max(time.monotonic() - self.started, 1) / 60
+        return round(self.requests / minutes, 2)
+
+
+def _write_response(r, local_filename, mode='wb', hashes=None):
+    """Stream the body of the response into a file, hashing it on the way.
+
+    When appending, the existing part of the file is hashed first.  If
+    r is None, only the existing file is hashed.
+
+    """
+    hashers = {name: hashlib.new(name) for name in hashes or ()}
+    if hashers and (mode == 'ab' or r is None):
+        with open(local_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                for h in hashers.values():
+                    h.update(chunk)
+    if r is not None:
+        with open(local_filename, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    f.write(chunk)
+                    for h in hashers.values():
+                        h.update(chunk)
+    for name, h in hashers.items():
+        hashes[name] = h.hexdigest()
+
+
+def _get_if_range(r):
+    """Get the validator to send in If-Range when resuming this response.
+
+    Weak ETags cannot be used in If-Range, so Last-Modified is the
+    fallback.  None means the download cannot safely be resumed.
+
+    """
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('Last-Modified')
+
+
+def _get_content_range_size(r):
+    """Get the complete size from a Content-Range header, or None."""
+    try:
+        return int(r.headers.get('Content-Range', '').rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
 def download_file(
     url,
     local_filename=None,
@@ -43,6 +182,9 @@ def download_file(
     retries=3,
     backoff_factor=0.1,
     https_only=True,
+    session=None,
+    resume=False,
+    hashes=None,
 ):
     """Try hard to download the file, including retrying on failures.
 
@@ -54,45 +196,87 @@ def download_file(
     loop.  This can result in more retries than are specified in the
     retries parameter.
 
+    Unless a session is given, the shared session from get_session()
+    is used, so connections are reused.  A given session's own
+    settings apply, including https_only.
+
+    If resume is True and local_filename already exists, then only
+    the rest of the file is requested with an HTTP Range header, and
+    appended if the server supports that.  The ETag or Last-Modified
+    of the response is kept in local_filename + '.validator' until the
+    download is complete, and sent in an If-Range header, so that a
+    file which changed on the server is downloaded again from the
+    start.  Without a validator, the download always starts from
+    zero.  Only resume files that are verified against an expected
+    hash afterwards.
+
+    hashes can be a dict with hashlib algorithm names as keys, e.g.
+    {'sha256': None}.  The values are set to the hex digests of the
+    downloaded file, calculated while it is streamed to disk.
+
     """
     filename = urllib.parse.urlparse(url).path.split('/')[-1]
     if local_filename is None:
         local_filename = os.path.join(dldir, filename)
-    for i in range(retries + 1):
-        if retries:
-            max_retries = Retry(total=retries - i, backoff_factor=backoff_factor)
-            adapter = HTTPAdapter(max_retries=max_retries)
-        else:
-            adapter = HTTPAdapter()
-        session = requests.Session()
-        session.mount('https://', adapter)
-        if https_only:
-            for k in session.adapters:
-                if k != 'https://':
-                    del session.adapters[k]
-        else:
-            session.mount('http://', adapter)
+    if session is None:
+        session = get_session(https_only, retries, backoff_factor)
+    validator_file = local_filename + '.validator'
+    i = 0
+    while i <= retries:
+        headers = HEADERS
+        offset = 0
+        if resume and os.path.exists(local_filename):
+            try:
+                with open(validator_file) as fp:
+                    if_range = fp.read().strip()
+            except FileNotFoundError:
+                if_range = None
+            if if_range:
+                offset = os.path.getsize(local_filename)
+                headers = dict(
+                    HEADERS, Range='bytes=%d-' % offset, **{'If-Range': if_range}
+                )
         # the stream=True parameter keeps memory usage low
         r = session.get(
-            url, stream=True, allow_redirects=True, headers=HEADERS, timeout=300
+            url, stream=True, allow_redirects=True, headers=headers, timeout=300
         )
+        if offset and r.status_code == 416:
+            r.close()
+            if _get_content_range_size(r) == offset:
+                # the file is already complete
+                _write_response(None, local_filename, hashes=hashes)
+                os.remove(validator_file)
+                return local_filename
+            # the file changed on the server, start again from zero
+            os.remove(validator_file)
+            continue
         r.raise_for_status()
+        if offset and r.status_code == 206:
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            if resume:
+                if_range = _get_if_range(r)
+                if if_range:
+                    with open(validator_file, 'w') as fp:
+                        fp.write(if_range)
+                elif os.path.exists(validator_file):
+                    os.remove(validator_file)
         try:
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        f.flush()
+            _write_response(r, local_filename, mode, hashes)
+            if resume and os.path.exists(validator_file):
+                os.remove(validator_file)
             return local_filename
         except requests.exceptions.ChunkedEncodingError as err:
             if i == retries:
                 raise err
             logger.warning('Download interrupted, retrying...')
             time.sleep(backoff_factor * 2**i)
+            i += 1
     raise ValueError("retries must be >= 0")
 
 
-def download_using_mirrors(mirrors, local_filename=None):
+def download_using_mirrors(mirrors, local_filename=None, hashes=None):
     """Try to download the file from any working mirror.
 
     Download the file that all URLs in the mirrors list point to,
@@ -104,6 +288,8 @@ def download_using_mirrors(mirrors, local_filename=None):
     try.  If a mirror is marked with worksWithoutSNI: True, then this
     logic will try it twice: first without SNI, then again with SNI.
 
+    hashes works the same as in download_file().
+
     """
     mirrors = common.parse_list_of_dicts(mirrors)
     mirror_configs_to_try = []
@@ -130,9 +316,15 @@ def download_using_mirrors(mirrors, local_filename=None):
         for mirror in mirror_configs_to_try:
             last_exception = None
             urllib3.util.ssl_.HAS_SNI = not mirror.get('worksWithoutSNI')
+            if mirror.get('worksWithoutSNI'):
+                # HAS_SNI only applies to new connections, so this must
+                # not reuse a pooled connection that was opened with SNI
+                session = requests.Session()
+            else:
+                session = get_session(https_only=False, retries=0)
             try:
                 # the stream=True parameter keeps memory usage low
-                r = requests.get(
+                r = session.get(
                     mirror['url'],
                     stream=True,
                     allow_redirects=False,
@@ -142,11 +334,7 @@ def download_using_mirrors(mirrors, local_filename=None):
                 )
                 if r.status_code != 200:
                     raise requests.exceptions.HTTPError(r.status_code, response=r)
-                with open(local_filename, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:  # filter out keep-alive new chunks
-                            f.write(chunk)
-                            f.flush()
+                _write_response(r, local_filename, hashes=hashes)
                 return local_filename
             except (
                 ConnectionError,
@@ -161,6 +349,9 @@ def download_using_mirrors(mirrors, local_filename=None):
             ) as e:
                 last_exception = e
                 logger.debug(_('Retrying failed download: %s') % str(e))
+            finally:
+                if mirror.get('worksWithoutSNI'):
+                    session.close()
     # if it hasn't succeeded by now, then give up and raise last exception
     if last_exception:
         raise last_exception
@@ -186,13 +377,14 @@ def http_get(url, etag=None, timeout=600):
     """
     # TODO disable TLS Session IDs and TLS Session Tickets
     #      (plain text cookie visible to anyone who can see the network traffic)
+    session = get_session(https_only=False, retries=0)
     if etag:
-        r = requests.head(url, headers=HEADERS, timeout=timeout)
+        r = session.head(url, headers=HEADERS, timeout=timeout)
         r.raise_for_status()
         if 'ETag' in r.headers and etag == r.headers['ETag']:
             return None, etag
 
-    r = requests.get(url, headers=HEADERS, timeout=timeout)
+    r = session.get(url, headers=HEADERS, timeout=timeout)
     r.raise_for_status()
 
     new_etag = None
@@ -30,12 +30,18 @@ Since this is an internal command, the strings are not localized.
 
 """
 
+import contextlib
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import shutil
 import subprocess
 import sys
 import tarfile
 import tempfile
+import time
 import traceback
 from argparse import ArgumentParser
 from pathlib import Path
@@ -43,6 +49,173 @@ from pathlib import Path
 from . import common, metadata
 from .exception import BuildException
 
+# Where the build input cache is mounted read-only inside of containers.
+BUILD_INPUT_CACHE_MOUNT = '/srv/fdroid-build-inputs'
+
+
+class BuildInputCache:
+    """Content-addressed store of build inputs shared by all builds on a host.
+
+    Each file or directory tree that goes into a build is hashed based
+    on its contents, then copied once into a directory named after that
+    hash.  The whole cache is bind mounted read-only into
+    each build container, so that unchanged inputs like srclibs and
+    fdroidserver itself can be copied from there inside the container
+    instead of being streamed in as a tar file on every build.
+
+    When the cache grows beyond max_size, the least recently used
+    entries are removed, except those that are still being copied
+    from, which hold a shared lock on their lock file.
+
+    """
+
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = '.lock'
+    LOCKS_DIR = '.locks'
+
+    def __init__(self, root, max_size):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def hash_tree(path):
+        """Return the SHA-256 of the contents, names and modes of a file or tree."""
+        path = Path(path)
+        h = hashlib.sha256()
+        if path.is_dir() and not path.is_symlink():
+            entries = sorted(
+                p
+                for p in path.rglob('*')
+                if '__pycache__' not in p.relative_to(path).parts
+            )
+        else:
+            entries = [path]
+        for entry in entries:
+            name = '.' if entry == path else str(entry.relative_to(path))
+            h.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+            if entry.is_symlink():
+                h.update(b'l' + os.readlink(entry).encode() + b'\0')
+            elif entry.is_dir():
+                h.update(b'd\0')
+            else:
+                h.update(b'x' if os.access(entry, os.X_OK) else b'f')
+                h.update(common.sha256sum(str(entry)).encode() + b'\0')
+        return h.hexdigest()
+
+    def get_entry_path(self, digest):
+        """Return the path to the cached copy of the input with this digest."""
+        return self.root / digest / 'tree'
+
+    def _read_index(self):
+        try:
+            with (self.root / self.INDEX_FILE).open() as fp:
+                return json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return dict()
+
+    def _write_index(self, index):
+        with tempfile.NamedTemporaryFile(
+            'w', dir=self.root, prefix='.index', delete=False
+        ) as fp:
+            json.dump(index, fp, indent=2, sort_keys=True)
+        os.replace(fp.name, self.root / self.INDEX_FILE)
+
+    def _open_entry_lock(self, digest):
+        # never deleted, so that all processes always lock the same file
+        locks = self.root / self.LOCKS_DIR
+        locks.mkdir(exist_ok=True)
+        return (locks / digest).open('w')
+
+    def add(self, path):
+        """Add path to the cache if its contents are not already there.
+
+        Returns the content hash which names the cache entry.
+
+        """
+        digest = self.hash_tree(path)
+        self._add(path, digest)
+        return digest
+
+    @contextlib.contextmanager
+    def pinned(self, path):
+        """Add path to the cache and keep its entry until the block exits.
+
+        This yields the content hash which names the cache entry.  The
+        entry is locked before it is added, so no other build can evict
+        it while it is being copied.
+
+        """
+        digest = self.hash_tree(path)
+        with self._open_entry_lock(digest) as entry_lock:
+            fcntl.flock(entry_lock, fcntl.LOCK_SH)
+            self._add(path, digest)
+            yield digest
+
+    def _add(self, path, digest):
+        with (self.root / self.LOCK_FILE).open('w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            entry = self.get_entry_path(digest)
+            if digest not in index or not os.path.lexists(entry):
+                logging.debug(f'Adding {path} to build input cache as {digest}')
+                tmpdir = Path(tempfile.mkdtemp(dir=self.root, prefix='.new'))
+                if Path(path).is_dir() and not Path(path).is_symlink():
+                    shutil.copytree(
+                        path,
+                        tmpdir / 'tree',
+                        symlinks=True,
+                        ignore=shutil.ignore_patterns('__pycache__'),
+                    )
+                else:
+                    shutil.copy2(path, tmpdir / 'tree', follow_symlinks=False)
+                shutil.rmtree(entry.parent, ignore_errors=True)
+                os.rename(tmpdir, entry.parent)
+                index[digest] = {'size': self._get_size(entry)}
+            index[digest]['lastUsed'] = time.time()
+            self._evict(index, keep=digest)
+            self._write_index(index)
+
+    @staticmethod
+    def _get_size(path):
+        if path.is_dir() and not path.is_symlink():
+            return common.get_dir_size(path)
+        return path.lstat().st_size
+
+    def _evict(self, index, keep=None):
+        """Remove least recently used entries until the cache fits max_size.
+
+        Entries that are pinned by a build are skipped.
+
+        """
+        total = sum(v['size'] for v in index.values())
+        for digest in sorted(index, key=lambda k: index[k]['lastUsed']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            with self._open_entry_lock(digest) as entry_lock:
+                try:
+                    fcntl.flock(entry_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logging.debug(f'Not evicting {digest}, it is in use')
+                    continue
+                logging.debug(f'Evicting {digest} from build input cache')
+                shutil.rmtree(self.root / digest, ignore_errors=True)
+            total -= index.pop(digest)['size']
+
+
+def get_build_input_cache():
+    """Return the configured BuildInputCache, or None if it is disabled."""
+    config = common.get_config()
+    max_size = config.get('build_input_cache_size')
+    if not max_size:
+        return None
+    return BuildInputCache(
+        Path(config['cachedir']) / 'buildinputs',
+        common.parse_human_readable_size(max_size),
+    )
+
 
 def podman_push(paths, appid, vercode, as_root=False):
     """Push relative paths into the podman container using the tar method.
@@ -98,6 +271,52 @@ def podman_push(paths, appid, vercode, as_root=False):
         container.put_archive(common.BUILD_HOME, tf.read())
 
 
+def podman_push_cached(paths, appid, vercode, cache, as_root=False):
+    """Push relative paths into the podman container via the build input cache.
+
+    Each path is added to the content-addressed cache on the host,
+    which only copies it when its contents changed since it was last
+    used.  Then the cached copy is copied into place from the
+    read-only mount inside of the container, and owned by the build
+    user, or by root if as_root is set, like podman_push() does.
+
+    """
+    if isinstance(paths, (Path, str)):
+        paths = [str(paths)]
+
+    for f in paths:
+        if Path(f).is_absolute():
+            raise BuildException(f'{f} must be relative to {Path.cwd()}')
+        # throw ValueError on bad path
+        f = (Path.cwd() / f).resolve().relative_to(Path.cwd())
+        owner = '0:0' if as_root else '1000:1000'
+        with cache.pinned(f) as digest:
+            dest = f'{common.BUILD_HOME}/{f}'
+            src = f'{BUILD_INPUT_CACHE_MOUNT}/{digest}/tree'
+            common.inside_exec(
+                appid,
+                vercode,
+                [
+                    'sh',
+                    '-c',
+                    'rm -rf "$2" && mkdir -p "${2%/*}" && cp -a "$1" "$2"'
+                    ' && chmod -R u+w "$2" && chown -R "$3" "$2"',
+                ]
+                + ['sh', src, dest, owner],
+                'podman',
+                as_root=True,
+            )
+
+
+def podman_container_has_build_input_cache(appid, vercode):
+    """Check whether the container was created with the build input cache mounted."""
+    container = common.get_podman_container(appid, vercode)
+    for mount in container.attrs.get('Mounts', []):
+        if mount.get('Destination') == BUILD_INPUT_CACHE_MOUNT:
+            return True
+    return False
+
+
 def vagrant_push(paths, appid, vercode):
     """Push files into a build specific vagrant VM."""
     vagrantbin = common.get_vagrant_bin_path()
@@ -128,7 +347,11 @@ def push_wrapper(paths, appid, vercode, virt_container_type):
     if virt_container_type == 'vagrant':
         vagrant_push(paths, appid, vercode)
     elif virt_container_type == 'podman':
-        podman_push(paths, appid, vercode)
+        cache = get_build_input_cache()
+        if cache and podman_container_has_build_input_cache(appid, vercode):
+            podman_push_cached(paths, appid, vercode, cache)
+        else:
+            podman_push(paths, appid, vercode)
 
 
 def make_file_list(appid, vercode):
@@ -17,11 +17,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import io
+import json
 import logging
-import shutil
+import os
 import tempfile
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import sys
 
@@ -29,6 +32,9 @@ from . import _, common, metadata
 
 config = None
 
+# the digests of the files that were already properly formatted
+CACHE_FILE = Path('tmp') / 'rewritemeta-cache.json'
+
 
 def proper_format(app):
     s = io.StringIO()
@@ -42,6 +48,64 @@ def proper_format(app):
     return content == cur_content
 
 
+def rewrite_file(metadatapath, dry_run=False, warnings_action='error'):
+    """Rewrite a metadata file, if it is not properly formatted already.
+
+    This runs in worker processes, so it gets everything it needs as
+    arguments.
+
+    Returns
+    -------
+    changed
+        Whether the file needed to be rewritten.
+    """
+    metadata.warnings_action = warnings_action
+    path = Path(metadatapath)
+    app = metadata.parse_metadata(path)
+    metadata.check_metadata(app)
+    s = io.StringIO()
+    metadata.write_yaml(s, app)
+    content = s.getvalue()
+    if content == path.read_text(encoding='utf-8'):
+        return False
+    if not dry_run:
+        logging.info(_("Rewriting '{appid}'").format(appid=app.id))
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.' + path.name)
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            fp.write(content)
+        os.replace(tmp_path, path)
+    return True
+
+
+def _get_file_digest(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def _get_formatter_digest(warnings_action):
+    """Identify the code that formats the files, so a new version invalidates the cache."""
+    h = hashlib.sha256(Path(metadata.__file__).read_bytes())
+    h.update(warnings_action.encode())
+    return h.hexdigest()
+
+
+def _load_cache(formatter):
+    try:
+        with open(CACHE_FILE) as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+    if data.get('formatter') != formatter:
+        return dict()
+    return data.get('files', dict())
+
+
+def _save_cache(formatter, files):
+    CACHE_FILE.parent.mkdir(exist_ok=True)
+    with open(str(CACHE_FILE) + '.tmp', 'w') as fp:
+        json.dump({'formatter': formatter, 'files': files}, fp, sort_keys=True)
+    os.replace(str(CACHE_FILE) + '.tmp', CACHE_FILE)
+
+
 def main():
     global config
 
@@ -61,6 +125,13 @@ def main():
         default=False,
         help=_("Format file from stdin and output the result to stdout"),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help=_("Number of processes to use, defaults to the number of CPUs"),
+    )
     parser.add_argument(
         "appid", nargs='*', help=_("application ID of file to operate on")
     )
@@ -77,27 +148,37 @@ def main():
         logging.debug(_("Finished"))
         return
 
-    apps = common.read_app_args(options.appid)
-
-    for appid, app in apps.items():
-        path = Path(app.metadatapath)
+    paths = []
+    for path in metadata.get_metadata_files(common.read_pkg_args(options.appid)):
         if path.suffix == '.yml':
-            logging.info(_("Rewriting '{appid}'").format(appid=appid))
+            paths.append(path)
         else:
             logging.warning(_('Cannot rewrite "{path}"').format(path=path))
-            continue
-
-        if options.list:
-            if not proper_format(app):
-                print(path)
-            continue
-
-        # rewrite to temporary file before overwriting existing
-        # file in case there's a bug in write_metadata
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmp_path = Path(tmpdir) / path.name
-            metadata.write_metadata(tmp_path, app)
-            shutil.move(tmp_path, path)
+
+    # files that were properly formatted by this same code are skipped
+    formatter = _get_formatter_digest(options.W)
+    cache = _load_cache(formatter)
+    todo = [p for p in paths if cache.get(p.as_posix()) != _get_file_digest(p)]
+    logging.debug(
+        _("{count} files unchanged since the last run").format(
+            count=len(paths) - len(todo)
+        )
+    )
+
+    args = (todo, [options.list] * len(todo), [options.W] * len(todo))
+    if options.jobs == 1 or len(todo) < 2:
+        results = list(map(rewrite_file, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+            chunksize = max(1, len(todo) // ((options.jobs or os.cpu_count() or 1) * 4))
+            results = list(executor.map(rewrite_file, *args, chunksize=chunksize))
+
+    for path, changed in zip(todo, results):
+        if options.list and changed:
+            print(path)
+        else:
+            cache[path.as_posix()] = _get_file_digest(path)
+    _save_cache(formatter, cache)
 
     logging.debug(_("Finished"))
 
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+#
+# run_buildcycle.py - part of the FDroid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run a build cycle locally, without a BuildBot instance.
+
+This reads the same JSON schedule as `fdroid send_buildcycle`, which is
+generated by `fdroid schedule_buildcycle`.  Then it runs each build
+through the same atomic steps that BuildBot runs: up, push,
+build_local_run, pull, destroy.  Multiple builds are run concurrently
+from a work queue, each in its own container/VM.  Progress is written
+to stdout as a stream of JSON objects, one per line.
+
+Since this is an internal command, the strings are not localized.
+
+"""
+
+
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from fdroidserver import common, schedule_buildcycle
+
+start_timestamp = time.gmtime()
+
+# how long `fdroid destroy` may take, independent of the build timeout
+DESTROY_TIMEOUT = 600
+
+
+class SubprocessBackend:
+    """Run each build step as a separate `fdroid` subcommand.
+
+    The steps change the working directory and global state, so they
+    cannot safely run in threads of the same process.  Their output
+    goes to stderr, since stdout is the stream of JSON progress events.
+
+    """
+
+    def __init__(self, virt_container_type):
+        self.virt_container_type = virt_container_type
+
+    def _run(self, subcommand, appid, vercode, timeout, extra=()):
+        appid_vercode = f'{appid}:{vercode}'
+        cmd = [sys.executable, '-m', 'fdroidserver', subcommand]
+        cmd += ['--virt-container-type', self.virt_container_type, appid_vercode]
+        cmd += list(extra)
+        logging.debug(' '.join(cmd))
+        subprocess.run(  # nosec B603 the command is assembled from fixed parts
+            cmd,
+            check=True,
+            stdin=subprocess.DEVNULL,
+            stdout=sys.stderr,
+            timeout=timeout,
+        )
+
+    def up(self, appid, vercode, timeout):
+        self._run('up', appid, vercode, timeout, ['--timeout', str(int(timeout))])
+
+    def push(self, appid, vercode, timeout):
+        self._run('push', appid, vercode, timeout)
+
+    def build(self, appid, vercode, timeout):
+        self._run(
+            'exec',
+            appid,
+            vercode,
+            timeout,
+            ['fdroidserver/fdroid', 'build_local_run', f'{appid}:{vercode}'],
+        )
+
+    def pull(self, appid, vercode, timeout):
+        self._run('pull', appid, vercode, timeout)
+
+    def destroy(self, appid, vercode, timeout):
+        self._run('destroy', appid, vercode, timeout)
+
+
+class BuildCycleRunner:
+    """Run a schedule of builds concurrently through a backend.
+
+    Each build gets the whole sequence of steps, with its timeout from
+    the schedule covering all of them except destroy, which always
+    runs.  Failed builds are retried with exponential backoff, but
+    timed out builds are not, since they would most likely time out
+    again.
+
+    """
+
+    STEPS = ('up', 'push', 'build', 'pull')
+
+    def __init__(self, backend, jobs=1, retries=0, backoff=60, stream=None):
+        self.backend = backend
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.stream = stream or sys.stdout
+        self.results = dict()
+        self._lock = threading.Lock()
+
+    def emit(self, event, appid, vercode, **kwargs):
+        """Write one progress event as a line of JSON."""
+        data = {
+            'event': event,
+            'applicationId': appid,
+            'versionCode': vercode,
+            'timestamp': common.epoch_millis_now(),
+        }
+        data.update(kwargs)
+        with self._lock:
+            self.stream.write(json.dumps(data) + '\n')
+            self.stream.flush()
+
+    def run_build(self, appid, vercode, timeout):
+        """Run all steps of one build, retrying on failure, and return its result."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            deadline = time.monotonic() + timeout
+            step = None
+            try:
+                for step in self.STEPS:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(step, timeout)
+                    self.emit('step', appid, vercode, step=step, attempt=attempt)
+                    getattr(self.backend, step)(appid, vercode, remaining)
+                status, error = 'success', None
+            except subprocess.TimeoutExpired:
+                status, error = 'timeout', f'{step} timed out after {timeout}s'
+            except Exception as e:
+                status, error = 'failure', f'{step}: {e}'
+            finally:
+                try:
+                    self.backend.destroy(appid, vercode, DESTROY_TIMEOUT)
+                except Exception as e:
+                    logging.warning(f'Destroying {appid}:{vercode} failed: {e}')
+
+            if status != 'failure' or attempt > self.retries:
+                break
+            delay = self.backoff * 2 ** (attempt - 1)
+            self.emit(
+                'retry', appid, vercode, attempt=attempt, error=error, delay=delay
+            )
+            time.sleep(delay)
+
+        result = {
+            'status': status,
+            'attempts': attempt,
+            'duration': round(time.monotonic() - started, 3),
+        }
+        if error:
+            result['error'] = error
+        self.emit(status, appid, vercode, **result)
+        with self._lock:
+            self.results[f'{appid}:{vercode}'] = result
+        return result
+
+    def run(self, schedule):
+        """Run all entries in the schedule, with at most self.jobs at once."""
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = []
+            for entry in schedule:
+                appid = entry['applicationId']
+                vercode = entry['versionCode']
+                timeout = (
+                    entry.get('timeout') or schedule_buildcycle.DEFAULT_BUILD_TIMEOUT
+                )
+                self.emit('queued', appid, vercode, timeout=timeout)
+                futures.append(executor.submit(self.run_build, appid, vercode, timeout))
+            for future in futures:
+                future.result()
+        return self.results
+
+
+def main():
+    """CLI entry point."""
+    parser = argparse.ArgumentParser(
+        description="run a build cycle locally from a JSON schedule, without buildbot",
+    )
+    common.setup_global_opts(parser)
+    common.setup_virt_container_type_opts(parser)
+    parser.add_argument(
+        '--stdin',
+        "-i",
+        default=False,
+        action="store_true",
+        help="read JSON schedule data from stdin. "
+        "(typically created by `fdroid schedule_buildcycle`)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="how many builds to run at the same time",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="how often to retry a failed build",
+    )
+    parser.add_argument(
+        "--timeout",
+        "-t",
+        type=int,
+        default=schedule_buildcycle.DEFAULT_BUILD_TIMEOUT,
+        help="builds will get aborted when this time interval expires "
+        "(in seconds, defaults to 2 hours; will be ignored when --stdin is specified)",
+    )
+    parser.add_argument(
+        "APPID:VERCODE",
+        nargs="*",
+        help="app id and version code tuple 'APPID:VERCODE'",
+    )
+    options = common.parse_args(parser)
+    common.set_console_logging(options.verbose)
+    status_output = common.setup_status_output(start_timestamp)
+
+    error = False
+    try:
+        if options.stdin:
+            schedule = json.loads(sys.stdin.read())
+        else:
+            schedule = [
+                {
+                    'applicationId': appid,
+                    'versionCode': vercode,
+                    'timeout': options.timeout,
+                }
+                for appid, vercode in (
+                    common.split_pkg_arg(x) for x in options.__dict__['APPID:VERCODE']
+                )
+            ]
+        if not schedule:
+            raise Exception("no builds given, use APPID:VERCODE or --stdin")
+        runner = BuildCycleRunner(
+            SubprocessBackend(common.get_virt_container_type(options)),
+            jobs=options.jobs,
+            retries=options.retries,
+        )
+        results = runner.run(schedule)
+        status_output['builds'] = results
+        error = any(r['status'] != 'success' for r in results.values())
+    except Exception as e:
+        if options.verbose:
+            logging.error(traceback.format_exc())
+        else:
+            logging.error(e)
+        error = True
+        status_output['errors'] = [traceback.format_exc()]
+
+    common.write_status_json(status_output)
+    sys.exit(error)
+
+
+if __name__ == "__main__":
+    main()
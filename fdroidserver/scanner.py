@@ -277,14 +277,16 @@ def get_gradle_compile_commands(build):
 
 def get_gradle_compile_commands_without_catalog(build):
     return [
-        re.compile(rf'''\s*['"]?{c}.*\s*\(?['"].*['"]''', re.IGNORECASE)
+        common.compile_regex(rf'''\s*['"]?{c}.*\s*\(?['"].*['"]''', re.IGNORECASE)
         for c in get_gradle_compile_commands(build)
     ]
 
 
 def get_gradle_compile_commands_with_catalog(build, prefix):
     return [
-        re.compile(rf'''\s*['"]?{c}.*\s*\(?{prefix}\.([a-z0-9.]+)''', re.IGNORECASE)
+        common.compile_regex(
+            rf'''\s*['"]?{c}.*\s*\(?{prefix}\.([a-z0-9.]+)''', re.IGNORECASE
+        )
         for c in get_gradle_compile_commands(build)
     ]
 
@@ -939,16 +941,20 @@ def scan_source(build_dir, build=metadata.Build(), json_per_build=None):
                 return True
         return False
 
+    # these are checked for every line of every gradle file
+    gradle_commands_without_catalog = get_gradle_compile_commands_without_catalog(build)
+    gradle_commands_with_catalog = dict()
+
     def is_used_by_gradle_without_catalog(line):
-        return any(
-            command.match(line)
-            for command in get_gradle_compile_commands_without_catalog(build)
-        )
+        return any(command.match(line) for command in gradle_commands_without_catalog)
 
     def is_used_by_gradle_with_catalog(line, prefix):
+        if prefix not in gradle_commands_with_catalog:
+            gradle_commands_with_catalog[prefix] = (
+                get_gradle_compile_commands_with_catalog(build, prefix)
+            )
         for m in (
-            command.match(line)
-            for command in get_gradle_compile_commands_with_catalog(build, prefix)
+            command.match(line) for command in gradle_commands_with_catalog[prefix]
         ):
             if m:
                 return m
@@ -21,12 +21,11 @@ import os
 import sys
 import json
 import time
-import urllib
 import logging
 import argparse
 import traceback
 
-from fdroidserver import common, metadata
+from fdroidserver import common, index, metadata
 
 start_timestamp = time.gmtime()
 
@@ -36,11 +35,14 @@ start_timestamp = time.gmtime()
 DEFAULT_BUILD_TIMEOUT = 7200
 
 
-def get_web_index(index_v2_url="https://f-droid.org/repo/index-v2.json"):
+def get_web_index(
+    repo=f'https://f-droid.org/repo?fingerprint={common.FDROIDORG_FINGERPRINT}',
+):
     # this is only used for filtering scheduler output
-    with urllib.request.urlopen(index_v2_url) as response:  # nosec B310
-        raw = response.read().decode('utf-8')
-        return json.loads(raw)
+    data, _ignored = index.download_repo_index_v2(
+        repo, cachedir=common.get_config().get('cachedir')
+    )
+    return data
 
 
 def published_apps(index_v2={}):
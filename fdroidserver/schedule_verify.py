@@ -52,7 +52,9 @@ def get_versions(
     rebuild matches one signature, that is enough.
 
     """
-    data, _ignored = index.download_repo_index_v2(repo)
+    data, _ignored = index.download_repo_index_v2(
+        repo, cachedir=common.get_config().get('cachedir')
+    )
     to_schedule = collections.defaultdict(list)
     for appid, package in data['packages'].items():
         for version in package['versions'].values():
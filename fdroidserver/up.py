@@ -29,54 +29,256 @@ Since this is an internal command, the strings are not localized.
 
 """
 
+import contextlib
+import fcntl
+import json
 import logging
 import os
 import re
+import statistics
+import subprocess
 import sys
 import textwrap
+import time
 import traceback
+import uuid
 from argparse import ArgumentParser
+from pathlib import Path
 
-from . import common
+from . import common, metadata, push, schedule_buildcycle
 from .exception import BuildException
 
 
-def run_podman(appid, vercode, cpus=None, memory=None):
-    """Create a Podman container env isolated for a single app build.
+# Label used to mark containers that were created for the warm pool.
+# Labels cannot be changed, so claimed containers keep it.
+PODMAN_POOL_LABEL = 'org.f-droid.fdroidserver.pool'
+# Name prefix of the containers that are still waiting in the warm pool,
+# claiming a container renames it.
+PODMAN_POOL_NAME_PREFIX = 'fdroid_pool_'
+# Labels recording the memory limit and CPUs a container was created
+# with, a pooled container is only claimed by builds that request both.
+PODMAN_MEMORY_LABEL = 'org.f-droid.fdroidserver.memory'
+PODMAN_CPUS_LABEL = 'org.f-droid.fdroidserver.cpus'
 
-    This creates a Podman "pod", which is like an isolated box to
-    create containers in.  Then it creates a container in that pod to
-    run the actual processes.  Using the "pod" seems to be a
-    requirement of Podman.  It also further isolates each app build,
-    so seems fine to use.  It is confusing because these containers
-    won't show up by default when listing containers using defaults.
+# The default CFS scheduler period, the CPU quota is a multiple of this.
+PODMAN_CPU_PERIOD = 100000
 
-    The container is set up with an interactive bash process to keep
-    the container running.
 
-    The CPU configuration assumes a Linux kernel.
+class PodmanResourceLedger:
+    """Host-wide bookkeeping of the CPUs and memory reserved by builds.
+
+    This is a JSON file in the cachedir that all `fdroid up` and
+    `fdroid destroy` processes on the host share, protected by a lock
+    file.  It is used as a context manager, which holds the lock while
+    it is open.  Reservations expire after the build's timeout, so a
+    crashed build that never ran `fdroid destroy` does not leak its
+    resources forever.  When a reservation is released, the build's
+    duration is recorded per app, which is then used to estimate how
+    long a queued build has to wait.
 
     """
-    container_name = common.get_container_name(appid, vercode)
-    pod_name = common.get_pod_name(appid, vercode)
-    client = common.get_podman_client()
 
-    logging.debug(f'Pulling {common.PODMAN_BUILDSERVER_IMAGE}...')
-    image = client.images.pull(common.PODMAN_BUILDSERVER_IMAGE)
+    HISTORY_LENGTH = 5
+
+    def __init__(self, path=None, total_cpus=None, total_memory=None):
+        if path is None:
+            path = Path(common.get_config()['cachedir']) / 'podman_resources.json'
+        self.path = Path(path)
+        self.total_cpus = total_cpus or os.cpu_count()
+        if total_memory is None:
+            total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        self.total_memory = total_memory
+        self.data = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = self.path.with_suffix('.lock').open('w')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            self.data = json.loads(self.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.data = dict()
+        self.data.setdefault('reservations', dict())
+        self.data.setdefault('history', dict())
+        now = time.time()
+        for name, r in list(self.data['reservations'].items()):
+            if r['expires'] < now:
+                logging.warning(f'Reservation for {name} expired, releasing.')
+                del self.data['reservations'][name]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(self.data, indent=2, sort_keys=True))
+            os.replace(tmp, self.path)
+        self._lock.close()
+
+    @property
+    def reservations(self):
+        return self.data['reservations']
+
+    def get_free_cpus(self):
+        return self.total_cpus - sum(r['cpus'] for r in self.reservations.values())
+
+    def get_free_memory(self):
+        return self.total_memory - sum(r['memory'] for r in self.reservations.values())
+
+    def fits(self, cpus, memory):
+        return cpus <= self.get_free_cpus() and memory <= self.get_free_memory()
+
+    def pick_cpuset(self, cpus):
+        """Return the lowest numbered CPUs that are not pinned by other builds."""
+        used = set()
+        for r in self.reservations.values():
+            used.update(int(i) for i in r['cpuset'].split(',') if i)
+        free = [i for i in range(self.total_cpus) if i not in used]
+        return ','.join(str(i) for i in free[:cpus])
+
+    def reserve(self, appid, vercode, cpus, memory, timeout):
+        """Reserve the resources for a build and return its CPU set."""
+        cpuset = self.pick_cpuset(cpus)
+        now = time.time()
+        self.reservations[common.get_container_name(appid, vercode)] = {
+            'appid': appid,
+            'cpus': cpus,
+            'cpuset': cpuset,
+            'memory': memory,
+            'started': now,
+            'expires': now + timeout,
+        }
+        return cpuset
+
+    def release(self, appid, vercode):
+        r = self.reservations.pop(common.get_container_name(appid, vercode), None)
+        if r is not None:
+            history = self.data['history'].setdefault(appid, [])
+            history.append(int(time.time() - r['started']))
+            del history[: -self.HISTORY_LENGTH]
+
+    def estimate_wait(self):
+        """Estimate seconds until the next running build finishes.
+
+        This uses the median duration of the previous builds of each
+        app, falling back to the build timeout when there is no history.
+
+        """
+        now = time.time()
+        ends = []
+        for r in self.reservations.values():
+            history = self.data['history'].get(r['appid'])
+            if history:
+                ends.append(
+                    min(r['started'] + statistics.median(history), r['expires'])
+                )
+            else:
+                ends.append(r['expires'])
+        return max(0, int(min(ends) - now)) if ends else 0
+
+
+def reserve_podman_resources(appid, vercode, cpus, memory, timeout, wait=True):
+    """Wait until enough CPUs and memory are free, then reserve them for the build.
+
+    If wait is False, or the resources do not become free within the
+    build timeout, a BuildException is raised instead of queuing.
+
+    Returns the CPU set that the container should be pinned to.
 
-    for c in client.containers.list():
-        if c.name == container_name:
-            logging.warning(f'Container {container_name} exists, removing!')
-            c.remove(force=True)
+    """
+    deadline = time.time() + timeout
+    while True:
+        with PodmanResourceLedger() as ledger:
+            if cpus > ledger.total_cpus or memory > ledger.total_memory:
+                raise BuildException(
+                    f'Requested {cpus} CPUs and {memory} bytes of memory, but the'
+                    f' host only has {ledger.total_cpus} and {ledger.total_memory}!'
+                )
+            if ledger.fits(cpus, memory):
+                return ledger.reserve(appid, vercode, cpus, memory, timeout)
+            msg = (
+                f'Not enough free resources for {appid}:{vercode}: requested'
+                f' {cpus} CPUs and {memory} bytes, free are'
+                f' {ledger.get_free_cpus()} and {ledger.get_free_memory()}.'
+            )
+            estimate = ledger.estimate_wait()
+        if not wait or time.time() > deadline:
+            raise BuildException(msg)
+        logging.info(f'{msg} Waiting, estimated {estimate} seconds.')
+        time.sleep(min(max(estimate, 10), 60))
+
+
+def release_podman_resources(appid, vercode):
+    """Release the resources reserved for the build, if any."""
+    with PodmanResourceLedger() as ledger:
+        ledger.release(appid, vercode)
+
+
+def get_podman_cpu_kwargs(cpus, cpuset=None):
+    """Return podman-py container kwargs to limit it to the given CPUs.
+
+    The quota caps the CPU time at the requested number of CPUs, the
+    shares weight concurrent builds by their size when the host is
+    overcommitted, and the optional cpuset pins it to specific CPUs.
 
-    for p in client.pods.list():
-        if p.name == pod_name:
-            logging.warning(f'Pod {pod_name} exists, removing!')
-            p.remove(force=True)
+    """
+    kwargs = {
+        'cpu_period': PODMAN_CPU_PERIOD,
+        'cpu_quota': int(cpus * PODMAN_CPU_PERIOD),
+        'cpu_shares': int(cpus * 1024),
+    }
+    if cpuset:
+        kwargs['cpuset_cpus'] = cpuset
+    return kwargs
+
+
+def get_podman_buildserver_image(client):
+    """Return the buildserver image, only pulling it when needed.
+
+    If podman_buildserver_image_digest is set in the config, then the
+    image is pinned to that digest.  When the local image already has
+    that digest, there is no registry round trip at all.  Otherwise,
+    the pinned digest is pulled and tagged locally, so that the
+    PODMAN_BUILDSERVER_IMAGE tag check still works.  Without a pinned
+    digest, the image is pulled every time to get the latest.
 
-    if cpus:
-        # TODO implement some kind of CPU weighting
-        logging.warning('--cpus is currently ignored by the Podman setup')
+    """
+    from podman.errors import ImageNotFound
+
+    digest = common.get_config().get('podman_buildserver_image_digest')
+    if digest:
+        repository, tag = common.PODMAN_BUILDSERVER_IMAGE.rsplit(':', 1)
+        pinned = f'{repository}@{digest}'
+        try:
+            image = client.images.get(common.PODMAN_BUILDSERVER_IMAGE)
+            if pinned in image.attrs.get('RepoDigests', []):
+                logging.debug(f'Using local {common.PODMAN_BUILDSERVER_IMAGE}')
+                return image
+        except ImageNotFound:
+            pass
+        logging.debug(f'Pulling {pinned}...')
+        image = client.images.pull(pinned)
+        image.tag(repository, tag)
+        return image
+
+    logging.debug(f'Pulling {common.PODMAN_BUILDSERVER_IMAGE}...')
+    return client.images.pull(common.PODMAN_BUILDSERVER_IMAGE)
+
+
+def create_podman_container(
+    client, image, container_name, pod_name, memory, labels=None, cpu_kwargs=None
+):
+    """Create and start a pod with a single buildserver container in it."""
+    mounts = []
+    cache = push.get_build_input_cache()
+    if cache:
+        mounts.append(
+            {
+                'type': 'bind',
+                'source': str(cache.root),
+                'target': push.BUILD_INPUT_CACHE_MOUNT,
+                'read_only': True,
+            }
+        )
 
     pod = client.pods.create(pod_name)
     container = client.containers.create(
@@ -88,13 +290,242 @@ def run_podman(appid, vercode, cpus=None, memory=None):
         remove=True,
         stdin_open=True,
         mem_limit=memory,
+        mounts=mounts,
+        labels=labels or {},
+        **(cpu_kwargs or {}),
     )
     pod.start()
     pod.reload()
-    if container.status != 'created':
-        raise BuildException(
-            f'Container {container_name} failed to start ({container.status})!'
+    return container
+
+
+@contextlib.contextmanager
+def _podman_pool_lock():
+    """Hold the lock file that serializes all changes to the warm pool."""
+    lockfile = Path(common.get_config()['cachedir']) / 'podman_pool.lock'
+    lockfile.parent.mkdir(parents=True, exist_ok=True)
+    with lockfile.open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def get_podman_resource_labels(cpus, memory):
+    """Return the labels that record the resources a container was made for."""
+    return {PODMAN_CPUS_LABEL: str(cpus), PODMAN_MEMORY_LABEL: str(memory)}
+
+
+def get_podman_pool_containers(client):
+    """Return the containers that are waiting in the warm pool.
+
+    Containers that were already claimed still have the pool label,
+    but they were renamed for their build.
+
+    """
+    return [
+        c
+        for c in client.containers.list(
+            all=True, filters={'label': f'{PODMAN_POOL_LABEL}=warm'}
+        )
+        if c.name.startswith(PODMAN_POOL_NAME_PREFIX)
+    ]
+
+
+def claim_podman_pool_container(client, image, appid, vercode, cpus, memory):
+    """Take a ready container from the warm pool and rename it for this build.
+
+    Only containers made from the current buildserver image for the
+    same CPUs and memory limit are used.  Pooled containers are not
+    pinned to any CPUs, run_podman() does that for the claimed one.  A
+    lock file in the cachedir makes sure that concurrent `fdroid up`
+    processes never claim the same container.  Returns the container,
+    or None if the pool is empty.
+
+    """
+    container_name = common.get_container_name(appid, vercode)
+    labels = get_podman_resource_labels(cpus, memory)
+    with _podman_pool_lock():
+        pooled = get_podman_pool_containers(client)
+        for container in sorted(pooled, key=lambda c: c.name):
+            if container.image.id != image.id:
+                continue
+            if any(container.labels.get(k) != v for k, v in labels.items()):
+                continue
+            if container.status != 'running':
+                continue
+            logging.info(f'Claiming {container.name} from pool as {container_name}')
+            container.rename(container_name)
+            container.reload()
+            return container
+    return None
+
+
+def fill_podman_pool(size=None, cpus=None, memory=None):
+    """Create pooled containers until the warm pool has the configured size.
+
+    The containers are made for the given CPUs and memory, with the
+    same defaults as `fdroid up`.  Pooled containers made from an
+    outdated image are removed first.  If the pool is full, but has no
+    container for these CPUs and memory, one for others is replaced,
+    so the pool follows what the builds request.  This holds
+    the same lock as claim_podman_pool_container(), so concurrent fills
+    cannot overfill the pool.
+
+    """
+    if size is None:
+        size = common.get_config().get('podman_warm_pool_size', 0)
+    cpus = get_virt_cpus_opt(cpus)
+    memory = get_virt_memory_opt(memory)
+    labels = get_podman_resource_labels(cpus, memory)
+    client = common.get_podman_client()
+    image = get_podman_buildserver_image(client)
+    with _podman_pool_lock():
+        pooled = []
+        others = []
+        for container in get_podman_pool_containers(client):
+            if container.image.id != image.id:
+                logging.info(f'Removing outdated {container.name} from pool')
+                client.pods.get(container.attrs['Pod']).remove(force=True)
+            elif all(container.labels.get(k) == v for k, v in labels.items()):
+                pooled.append(container)
+            else:
+                others.append(container)
+        missing = size - len(pooled) - len(others)
+        if missing <= 0 and not pooled and others and size:
+            container = sorted(others, key=lambda c: c.name)[0]
+            logging.info(f'Removing {container.name} from pool to make room')
+            client.pods.get(container.attrs['Pod']).remove(force=True)
+            missing = 1
+        for _i in range(missing):
+            container_name = PODMAN_POOL_NAME_PREFIX + uuid.uuid4().hex[:12]
+            logging.info(f'Adding {container_name} to pool')
+            create_podman_container(
+                client,
+                image,
+                container_name,
+                f'{container_name}_pod',
+                memory,
+                labels={PODMAN_POOL_LABEL: 'warm', **labels},
+                cpu_kwargs=get_podman_cpu_kwargs(cpus),
+            )
+
+
+def spawn_fill_podman_pool(cpus=None, memory=None):
+    """Refill the warm pool in the background, if it is enabled.
+
+    cpus and memory should be what the build that used up a pooled
+    container requested, so its next build can claim one again.
+
+    """
+    if not common.get_config().get('podman_warm_pool_size'):
+        return
+    cmd = [sys.executable, '-m', 'fdroidserver', 'up', '--fill-pool']
+    if cpus:
+        cmd += ['--cpus', str(cpus)]
+    if memory:
+        cmd += ['--memory', str(memory)]
+    subprocess.Popen(  # nosec B603 the command is fixed
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def run_podman(appid, vercode, cpus=None, memory=None, timeout=None, wait=True):
+    """Create a Podman container env isolated for a single app build.
+
+    This creates a Podman "pod", which is like an isolated box to
+    create containers in.  Then it creates a container in that pod to
+    run the actual processes.  Using the "pod" seems to be a
+    requirement of Podman.  It also further isolates each app build,
+    so seems fine to use.  It is confusing because these containers
+    won't show up by default when listing containers using defaults.
+
+    The container is set up with an interactive bash process to keep
+    the container running.
+
+    If podman_warm_pool_size is set, a ready container from the warm
+    pool is claimed instead of creating one from scratch.  Since pods
+    cannot be renamed, a claimed container keeps its pool pod name.
+    The pooled containers are not pinned to the reserved CPUs yet, so
+    the CPU limits are applied here with an update of the claimed
+    container.  All containers are labeled with the CPUs and memory
+    they were made for, so `fdroid destroy` can refill the pool with
+    the same.
+
+    If podman_admission_control is set, the CPUs and memory are first
+    reserved in the host-wide PodmanResourceLedger, waiting until they
+    are free, and the container is pinned to the reserved CPUs.
+
+    The CPU configuration assumes a Linux kernel.
+
+    """
+    container_name = common.get_container_name(appid, vercode)
+    pod_name = common.get_pod_name(appid, vercode)
+    client = common.get_podman_client()
+
+    image = get_podman_buildserver_image(client)
+
+    if client.containers.exists(container_name):
+        logging.warning(f'Container {container_name} exists, removing!')
+        client.containers.get(container_name).remove(force=True)
+    common.set_podman_container_id(appid, vercode, None)
+
+    if client.pods.exists(pod_name):
+        logging.warning(f'Pod {pod_name} exists, removing!')
+        client.pods.get(pod_name).remove(force=True)
+
+    cpuset = None
+    admission_control = common.get_config().get('podman_admission_control')
+    if admission_control:
+        cpuset = reserve_podman_resources(
+            appid,
+            vercode,
+            cpus,
+            memory,
+            timeout or schedule_buildcycle.DEFAULT_BUILD_TIMEOUT,
+            wait=wait,
         )
+    cpu_kwargs = get_podman_cpu_kwargs(cpus, cpuset) if cpus else None
+
+    try:
+        container = None
+        if common.get_config().get('podman_warm_pool_size'):
+            container = claim_podman_pool_container(
+                client, image, appid, vercode, cpus, memory
+            )
+        if container is None:
+            container = create_podman_container(
+                client,
+                image,
+                container_name,
+                pod_name,
+                memory,
+                labels=get_podman_resource_labels(cpus, memory),
+                cpu_kwargs=cpu_kwargs,
+            )
+            expected_status = 'created'
+        else:
+            expected_status = 'running'
+            if cpu_kwargs:
+                container.update(
+                    cpu={
+                        'period': cpu_kwargs['cpu_period'],
+                        'quota': cpu_kwargs['cpu_quota'],
+                        'shares': cpu_kwargs['cpu_shares'],
+                        'cpus': cpu_kwargs.get('cpuset_cpus', ''),
+                    }
+                )
+        common.set_podman_container_id(appid, vercode, container.id)
+        if container.status != expected_status:
+            raise BuildException(
+                f'Container {container_name} failed to start ({container.status})!'
+            )
+    except Exception:
+        if admission_control:
+            release_podman_resources(appid, vercode)
+        raise
 
 
 def run_vagrant(appid, vercode, cpus, memory):
@@ -176,13 +607,28 @@ def get_virt_memory_opt(memory):
     )
 
 
-def up_wrapper(appid, vercode, virt_container_type, cpus=None, memory=None):
+def get_build_timeout(appid, vercode):
+    """Return the timeout in seconds from the build metadata, or the default."""
+    try:
+        _app, build = metadata.get_single_build(appid, vercode)
+        if build.timeout:
+            return int(build.timeout)
+    except Exception as e:
+        logging.debug(f'Could not read timeout for {appid}:{vercode}: {e}')
+    return schedule_buildcycle.DEFAULT_BUILD_TIMEOUT
+
+
+def up_wrapper(
+    appid, vercode, virt_container_type, cpus=None, memory=None, timeout=None, wait=True
+):
     cpus = get_virt_cpus_opt(cpus)
     memory = get_virt_memory_opt(memory)
     if virt_container_type == 'vagrant':
         run_vagrant(appid, vercode, cpus, memory)
     elif virt_container_type == 'podman':
-        run_podman(appid, vercode, cpus, memory)
+        if timeout is None:
+            timeout = get_build_timeout(appid, vercode)
+        run_podman(appid, vercode, cpus, memory, timeout=timeout, wait=wait)
 
 
 def main():
@@ -193,8 +639,14 @@ def main():
     common.setup_virt_container_type_opts(parser)
     parser.add_argument(
         "APPID:VERCODE",
+        nargs='?',
         help="Application ID with Version Code in the form APPID:VERCODE",
     )
+    parser.add_argument(
+        "--fill-pool",
+        action="store_true",
+        help="Fill up the warm pool of Podman containers, then exit.",
+    )
     parser.add_argument(
         "--cpus",
         type=int,
@@ -205,10 +657,25 @@ def main():
         type=common.parse_human_readable_size,
         help="How many MB of RAM the Vagrant VM should be allocated.",
     )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        help="Build timeout in seconds, defaults to the timeout in the build metadata.",
+    )
+    parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Fail instead of waiting when not enough CPUs or memory are free.",
+    )
     options = common.parse_args(parser)
     common.set_console_logging(options.verbose)
 
     try:
+        if options.fill_pool:
+            fill_podman_pool(cpus=options.cpus, memory=options.memory)
+            return
+        if not options.__dict__['APPID:VERCODE']:
+            parser.error('APPID:VERCODE is required')
         appid, vercode = common.split_pkg_arg(options.__dict__['APPID:VERCODE'])
         up_wrapper(
             appid,
@@ -216,6 +683,8 @@ def main():
             common.get_virt_container_type(options),
             cpus=options.cpus,
             memory=options.memory,
+            timeout=options.timeout,
+            wait=not options.no_wait,
         )
     except Exception as e:
         if options.verbose:
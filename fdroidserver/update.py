@@ -467,6 +467,27 @@ def write_cache(apkcache):
         json.dump(apkcache, fp, cls=Encoder, indent=2)
 
 
+def write_repo_manifest(repodir, apks):
+    """Write the manifest of all files in repodir for `fdroid deploy`.
+
+    The SHA-256 of all scanned packages is already known, so only the
+    other new or changed files like icons and index files get hashed.
+
+    """
+    path = common.get_repo_manifest_path(repodir)
+    known = common.load_repo_manifest(path) or dict()
+    for apk in apks:
+        f = apk.get('file', {})
+        apkfile = os.path.join(repodir, f.get('name', ''))
+        if f.get('sha256') and os.path.isfile(apkfile):
+            known[f['name']] = {
+                'size': f['size'],
+                'sha256': f['sha256'],
+                'mtime': os.stat(apkfile).st_mtime,
+            }
+    common.write_repo_manifest(path, common.make_repo_manifest(repodir, known))
+
+
 def get_icon_bytes(apkzip, iconsrc):
     """ZIP has no official encoding, UTF-* and CP437 are defacto."""
     try:
@@ -3073,6 +3094,7 @@ def main():
         archived_apps = prepare_apps(apps, archapks, repodirs[1])
         output_status_stage(status_output, 'index.make archive')
         fdroidserver.index.make(archived_apps, archapks, repodirs[1], True)
+        write_repo_manifest(repodirs[1], archapks)
 
     output_status_stage(status_output, 'prepare_apps repo')
     repoapps = prepare_apps(apps, apks, repodirs[0])
@@ -3097,6 +3119,7 @@ def main():
 
     # Make the index for the main repo...
     fdroidserver.index.make(repoapps, apks, repodirs[0], False)
+    write_repo_manifest(repodirs[0], apks)
 
     git_remote = config.get('binary_transparency_remote')
     if git_remote or os.path.isdir(os.path.join('binary_transparency', '.git')):
@@ -103,7 +103,9 @@ def get_verified_json(path):
     return data
 
 
-def write_json_report(url, remote_apk, unsigned_apk, compare_result):
+def write_json_report(
+    url, remote_apk, unsigned_apk, compare_result, remote_sha256=None
+):
     """Write out the results of the verify run to JSON.
 
     This builds up reports on the repeated runs of `fdroid verify` on
@@ -114,6 +116,9 @@ def write_json_report(url, remote_apk, unsigned_apk, compare_result):
     The output is run through JSON to normalize things like tuples vs
     lists.
 
+    remote_sha256 can be given if it was already calculated while
+    downloading remote_apk.
+
     """
     jsonfile = unsigned_apk + '.json'
     if os.path.exists(jsonfile):
@@ -124,11 +129,14 @@ def write_json_report(url, remote_apk, unsigned_apk, compare_result):
     output = dict()
     _add_diffoscope_info(output)
     output['url'] = url
-    for key, filename in (('local', unsigned_apk), ('remote', remote_apk)):
+    for key, filename, sha256 in (
+        ('local', unsigned_apk, None),
+        ('remote', remote_apk, remote_sha256),
+    ):
         d = dict()
         output[key] = d
         d['file'] = filename
-        d['sha256'] = common.sha256sum(filename)
+        d['sha256'] = sha256 or common.sha256sum(filename)
         d['timestamp'] = os.stat(filename).st_ctime
         d['packageName'], d['versionCode'], d['versionName'] = common.get_apk_id(
             filename
@@ -250,16 +258,19 @@ def main():
             logging.info("Processing {apkfilename}".format(apkfilename=apkfilename))
 
             remote_apk = os.path.join(tmp_dir, apkfilename)
+            hashes = {'sha256': None}
             if not options.reuse_remote_apk or not os.path.exists(remote_apk):
                 if os.path.exists(remote_apk):
                     os.remove(remote_apk)
                 logging.info("...retrieving " + url)
                 try:
-                    net.download_file(url, dldir=tmp_dir)
+                    net.download_file(url, dldir=tmp_dir, hashes=hashes)
                 except requests.exceptions.HTTPError:
                     try:
                         net.download_file(
-                            url.replace('/repo', '/archive'), dldir=tmp_dir
+                            url.replace('/repo', '/archive'),
+                            dldir=tmp_dir,
+                            hashes=hashes,
                         )
                     except requests.exceptions.HTTPError as e:
                         raise FDroidException(
@@ -276,7 +287,9 @@ def main():
                 clean_up_verified=options.clean_up_verified,
             )
             if options.output_json:
-                write_json_report(url, remote_apk, unsigned_apk, compare_result)
+                write_json_report(
+                    url, remote_apk, unsigned_apk, compare_result, hashes['sha256']
+                )
             if compare_result:
                 raise FDroidException(compare_result)
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Measure how long it takes to check one line of a gradle file against
+# the regexes for the gradle compile commands, the way `fdroid scanner`
+# does for every line.  "before" builds and compiles the list of
+# regexes for every line, like scan_source() used to, "after" uses the
+# list that scan_source() now builds once per build.
+#
+#   ./tests/gradle-scan-benchmark.py
+#   ./tests/gradle-scan-benchmark.py --flavors 3 --lines 20000
+
+import os
+import re
+import sys
+import timeit
+from argparse import ArgumentParser
+
+localmodule = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+)
+if localmodule not in sys.path:
+    sys.path.insert(0, localmodule)
+
+from fdroidserver import metadata, scanner  # noqa: E402
+
+LINES = [
+    "    implementation 'androidx.appcompat:appcompat:1.6.1'",
+    '    testImplementation("junit:junit:4.13.2")',
+    '    implementation(libs.androidx.core.ktx)',
+    '        minSdk = 21',
+    '    // a comment',
+]
+
+
+def before(build, line):
+    return any(
+        re.compile(rf'''\s*['"]?{c}.*\s*\(?['"].*['"]''', re.IGNORECASE).match(line)
+        for c in scanner.get_gradle_compile_commands(build)
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--flavors', type=int, default=1, help='number of gradle flavors'
+    )
+    parser.add_argument(
+        '--lines', type=int, default=10000, help='lines to scan per run'
+    )
+    options = parser.parse_args()
+
+    build = metadata.Build()
+    if options.flavors:
+        build.gradle = ['flavor%d' % i for i in range(options.flavors)]
+    lines = (LINES * (options.lines // len(LINES) + 1))[: options.lines]
+
+    commands = scanner.get_gradle_compile_commands_without_catalog(build)
+
+    def after(line):
+        return any(command.match(line) for command in commands)
+
+    for name, func in (
+        ('before', lambda: [before(build, line) for line in lines]),
+        ('after', lambda: [after(line) for line in lines]),
+    ):
+        seconds = min(timeit.repeat(func, number=1, repeat=5))
+        print(
+            '%-6s %8.2f µs per line (%d regexes)'
+            % (name, seconds / len(lines) * 1000000, len(commands))
+        )
+
+
+if __name__ == '__main__':
+    main()
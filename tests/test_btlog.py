@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import defusedxml.minidom
+import defusedxml.sax
+
+from fdroidserver import btlog, common
+
+from .shared_test_code import mkdtemp
+
+basedir = Path(__file__).parent
+
+
+class BtlogTest(unittest.TestCase):
+    def setUp(self):
+        self._td = mkdtemp()
+        self.testdir = self._td.name
+        os.chdir(self.testdir)
+
+    def tearDown(self):
+        os.chdir(basedir)
+        self._td.cleanup()
+
+    def test_pretty_xml_writer(self):
+        for data in (
+            (basedir / 'repo/index.xml').read_bytes(),
+            b'<a b="&amp;&quot;"><c>&lt;"d"&gt;</c><e/><f></f>\n  <g>h<i>j</i>k</g></a>',
+        ):
+            fp = io.BytesIO()
+            defusedxml.sax.parseString(data, btlog._PrettyXMLWriter(fp))
+            self.assertEqual(
+                defusedxml.minidom.parseString(data).toprettyxml(encoding='utf-8'),
+                fp.getvalue(),
+            )
+
+    def test_make_binary_transparency_log(self):
+        os.makedirs('repo/icons')
+        Path('repo/a.apk').write_text('a')
+        Path('repo/icons/a.png').write_text('icon')
+        Path('repo/index-v1.json').write_text('{"repo": {"name": "test"}}')
+
+        def _update_manifest():
+            common.write_repo_manifest(
+                common.get_repo_manifest_path('repo'), common.make_repo_manifest('repo')
+            )
+
+        _update_manifest()
+        btlog.make_binary_transparency_log(['repo'], url='https://example.com/repo')
+        fslogfile = Path('binary_transparency/repo/filesystemlog.json')
+        fslog = json.loads(fslogfile.read_text())
+        self.assertEqual(['a.apk', 'icons/a.png', 'index-v1.json'], list(fslog))
+        self.assertEqual(
+            {'repo': {'name': 'test'}},
+            json.loads(Path('binary_transparency/repo/index-v1.json').read_text()),
+        )
+
+        os.remove('repo/icons/a.png')
+        Path('repo/b.apk').write_text('bb')
+        _update_manifest()
+        with mock.patch('fdroidserver.btlog._stat_file', wraps=btlog._stat_file) as s:
+            btlog.make_binary_transparency_log(['repo'])
+        s.assert_called_once_with(os.path.join('repo', 'b.apk'))
+        fslog = json.loads(fslogfile.read_text())
+        self.assertEqual(['a.apk', 'b.apk', 'index-v1.json'], list(fslog))
+        self.assertEqual(2, fslog['b.apk'][0])
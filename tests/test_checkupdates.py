@@ -9,6 +9,7 @@ from pathlib import Path
 from unittest import mock
 
 import git
+import requests
 
 import fdroidserver
 from fdroidserver import checkupdates
@@ -16,6 +17,14 @@ from fdroidserver import checkupdates
 basedir = Path(__file__).parent
 
 
+def make_response(status=200, body='', headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = body.encode()
+    r.headers.update(headers or {})
+    return r
+
+
 @unittest.skipUnless(
     os.path.exists('/usr/bin/dpkg'),  # easy test for "Debian-ish"
     'checkupdates is only ever run in production on Debian.',
@@ -206,13 +215,35 @@ class CheckupdatesTest(unittest.TestCase):
         app.UpdateCheckData = r'https://a.net/b.txt|c(.*)|https://d.net/e.txt|v(.*)'
         app.UpdateCheckIgnore = 'beta'
 
-        respmock = mock.Mock()
-        respmock.read = lambda: 'v1.1.9\nc10109'.encode('utf-8')
-        with mock.patch('urllib.request.urlopen', lambda a, b, c: respmock):
+        session = mock.Mock()
+        session.get.return_value = make_response(body='v1.1.9\nc10109')
+        with mock.patch('fdroidserver.net.get_session', return_value=session):
             vername, vercode = checkupdates.check_http(app)
         self.assertEqual(vername, '1.1.9')
         self.assertEqual(vercode, 10109)
 
+    def test_http_cache(self):
+        session = mock.Mock()
+        session.get.return_value = make_response(body='v1', headers={'ETag': '"1"'})
+        with mock.patch('fdroidserver.net.get_session', return_value=session):
+            cache = checkupdates.HttpCache(Path(self.testdir.name))
+            self.assertEqual('v1', cache.get('https://a.net/b.txt'))
+            self.assertEqual('v1', cache.get('https://a.net/b.txt'))
+            session.get.assert_called_once()
+            self.assertNotIn('If-None-Match', session.get.call_args[1]['headers'])
+
+            # the next run revalidates the cached page
+            session.get.return_value = make_response(status=304)
+            cache = checkupdates.HttpCache(Path(self.testdir.name))
+            self.assertEqual('v1', cache.get('https://a.net/b.txt'))
+            self.assertEqual(
+                '"1"', session.get.call_args[1]['headers']['If-None-Match']
+            )
+
+            session.get.return_value = make_response(status=404)
+            with self.assertRaises(requests.HTTPError):
+                checkupdates.HttpCache().get('https://a.net/c.txt')
+
     def test_check_http_blocks_unknown_schemes(self):
         app = fdroidserver.metadata.App()
         for scheme in ('file', 'ssh', 'http', ';pwn'):
@@ -232,9 +263,9 @@ class CheckupdatesTest(unittest.TestCase):
         app.UpdateCheckData = r'https://a.net/b.txt|c(.*)|https://d.net/e.txt|v(.*)'
         app.UpdateCheckIgnore = 'beta'
 
-        respmock = mock.Mock()
-        respmock.read = lambda: 'v1.1.9-beta\nc10109'.encode('utf-8')
-        with mock.patch('urllib.request.urlopen', lambda a, b, c: respmock):
+        session = mock.Mock()
+        session.get.return_value = make_response(body='v1.1.9-beta\nc10109')
+        with mock.patch('fdroidserver.net.get_session', return_value=session):
             vername, vercode = checkupdates.check_http(app)
         self.assertEqual(vername, None)
 
@@ -319,6 +350,78 @@ class CheckupdatesTest(unittest.TestCase):
         self.assertEqual(vername, '2')
         self.assertEqual(vercode, 2)
 
+    def test_check_tags_without_checkout(self):
+        os.chdir(self.testdir.name)
+        upstream = git.Repo.init('upstream')
+        gradle = Path('upstream/app/build.gradle')
+        gradle.parent.mkdir()
+        date = 10**9
+        for vercode in (1, 2, 3):
+            date += 1
+            gradle.write_text(
+                "apply plugin: 'com.android.application'\n"
+                "android {\n  defaultConfig {\n"
+                "    applicationId 'com.example'\n"
+                f"    versionCode {vercode}\n    versionName '1.{vercode}'\n"
+                "  }\n}\n"
+            )
+            upstream.index.add(['app/build.gradle'])
+            upstream.index.commit(str(vercode), commit_date=f'{date} +0000')
+            if vercode < 3:
+                upstream.create_tag(f'v1.{vercode}')
+
+        app = fdroidserver.metadata.App()
+        app.id = 'com.example'
+        app.RepoType = 'git'
+        app.Repo = str(Path('upstream').resolve())
+        app.UpdateCheckMode = 'Tags'
+        with mock.patch.object(
+            fdroidserver.common.vcs_git,
+            'gotorevisionx',
+            autospec=True,
+            side_effect=fdroidserver.common.vcs_git.gotorevisionx,
+        ) as gotorevisionx:
+            vername, vercode, tag = checkupdates.check_tags(app, None)
+        self.assertEqual(('1.2', 2, 'v1.2'), (vername, vercode, tag))
+        # only the initial clone, the tags were read from the git objects
+        self.assertEqual([None], [c[0][1] for c in gotorevisionx.call_args_list])
+        self.assertIn(
+            'versionCode 3', Path('build/com.example/app/build.gradle').read_text()
+        )
+
+    @mock.patch('fdroidserver.checkupdates.fetch_autoname', return_value=None)
+    @mock.patch('fdroidserver.checkupdates.check_tags')
+    def test_check_app_version_unchanged_refs(self, check_tags, fetch_autoname):
+        os.chdir(self.testdir.name)
+        upstream = git.Repo.init('upstream')
+        Path('upstream/README').write_text('first')
+        upstream.index.add(['README'])
+        upstream.index.commit('first')
+
+        app = fdroidserver.metadata.App()
+        app.id = 'com.example'
+        app.RepoType = 'git'
+        app.Repo = str(Path('upstream').resolve())
+        app.UpdateCheckMode = 'Tags'
+        check_tags.return_value = ('1.2', 2, 'v1.2')
+        found = ('1.2', 2, 'v1.2', None)
+        self.assertEqual(found, checkupdates.check_app_version(app))
+        self.assertEqual(found, checkupdates.check_app_version(app))
+        check_tags.assert_called_once()
+
+        # a new tag upstream
+        upstream.create_tag('v1.3')
+        check_tags.return_value = ('1.3', 3, 'v1.3')
+        self.assertEqual('1.3', checkupdates.check_app_version(app)[0])
+        self.assertEqual(2, check_tags.call_count)
+
+        # changed metadata
+        app.UpdateCheckMode = 'Tags v.*'
+        checkupdates.check_app_version(app)
+        self.assertEqual(3, check_tags.call_count)
+        checkupdates.check_app_version(app)
+        self.assertEqual(3, check_tags.call_count)
+
     def _get_test_git_repos(self):
         testdir = self.testdir.name
         os.chdir(testdir)
@@ -461,6 +564,54 @@ class CheckupdatesTest(unittest.TestCase):
         self.assertNotIn(appid, git_repo.remotes.origin.refs)
         self.assertNotIn(appid, git_repo.remotes.upstream.refs)
 
+    def test_prune_empty_appid_branches_one_push(self):
+        git_repo, origin_repo, upstream_repo = self._get_test_git_repos()
+        for remote in git_repo.remotes:
+            remote.push(git_repo.active_branch)
+        appids = ['org.adaway', 'com.example']
+        for appid in appids:
+            git_repo.create_head(appid, force=True)
+            git_repo.remotes.origin.push(appid, force=True)
+        with mock.patch(
+            'git.Remote.push', side_effect=git.Remote.push, autospec=True
+        ) as push:
+            checkupdates.prune_empty_appid_branches(git_repo)
+        push.assert_called_once()
+        self.assertCountEqual([':' + a for a in appids], push.call_args[0][1])
+        for appid in appids:
+            self.assertNotIn(appid, origin_repo.branches)
+
+    def test_metadata_committer(self):
+        git_repo, origin_repo, upstream_repo = self._get_test_git_repos()
+        first = git_repo.head.commit
+        committer = checkupdates.MetadataCommitter.create()
+        appids = ['org.adaway', 'com.example']
+        for appid in appids:
+            metadatapath = f'metadata/{appid}.yml'
+            app = fdroidserver.metadata.App()
+            app.CurrentVersion = 'fake'
+            fdroidserver.metadata.write_metadata(metadatapath, app)
+            committer.commit(metadatapath, 'Update ' + appid)
+        commits = list(git_repo.iter_commits(f'{first}..HEAD'))
+        self.assertEqual(
+            ['Update ' + a for a in reversed(appids)], [c.summary for c in commits]
+        )
+        for appid, commit in zip(reversed(appids), commits):
+            self.assertEqual([f'metadata/{appid}.yml'], list(commit.stats.files))
+        self.assertFalse(git_repo.is_dirty())
+
+        # other staged changes must not end up in these commits
+        Path('metadata/org.adaway.yml').write_text('Staged: true\n')
+        git_repo.index.add(['metadata/org.adaway.yml'])
+        self.assertIsNone(checkupdates.MetadataCommitter.create())
+
+        # these commits could not be signed
+        git_repo.index.reset()
+        self.assertIsNotNone(checkupdates.MetadataCommitter.create())
+        with git_repo.config_writer() as cw:
+            cw.set_value('commit', 'gpgsign', 'true')
+        self.assertIsNone(checkupdates.MetadataCommitter.create())
+
     @mock.patch('sys.exit')
     @mock.patch('fdroidserver.metadata.read_metadata')
     def test_merge_requests_flag(self, read_metadata, sys_exit):
@@ -704,3 +855,34 @@ class CheckupdatesTest(unittest.TestCase):
         self.assertEqual(origin_repo.head, upstream_repo.head)
         # pretend that checkupdates ran but didn't create any new commits
         checkupdates.push_commits('')
+
+    @mock.patch('sys.exit')
+    @mock.patch('fdroidserver.common.read_app_args')
+    @mock.patch('fdroidserver.checkupdates.update_app')
+    @mock.patch('fdroidserver.checkupdates.check_app_version')
+    def test_main_jobs(self, check_app_version, update_app, read_app_args, sys_exit):
+        appids = ['com.example.a', 'com.example.b', 'com.example.c']
+        apps = dict()
+        for appid in appids:
+            apps[appid] = fdroidserver.metadata.App()
+            apps[appid].id = appid
+        read_app_args.return_value = apps
+
+        def _check_app_version(app):
+            # the first app is checked last
+            time.sleep(0.1 * (len(appids) - appids.index(app.id)))
+            return (app.id, 1, None, None)
+
+        check_app_version.side_effect = _check_app_version
+
+        with mock.patch(
+            'sys.argv', ['fdroid checkupdates', '--allow-dirty', '--jobs', '3']
+        ):
+            checkupdates.main()
+        self.assertEqual(3, check_app_version.call_count)
+        # the results are still applied in order
+        self.assertEqual(
+            [(apps[appid], (appid, 1, None, None), False, False) for appid in appids],
+            [c[0] for c in update_app.call_args_list],
+        )
+        sys_exit.assert_called_once_with(0)
@@ -205,6 +205,32 @@ class CommonTest(SetUpTearDownMixin, unittest.TestCase):
         )
         self.assertEqual(text, config_dump(config))
 
+    def test_make_repo_manifest(self):
+        os.chdir(self.testdir)
+        os.makedirs('repo/icons')
+        Path('repo/a.apk').write_text('a')
+        Path('repo/icons/b.png').write_text('bb')
+        os.symlink('a.apk', 'repo/c.apk')
+        manifest = fdroidserver.common.make_repo_manifest('repo')
+        self.assertEqual(['a.apk', 'c.apk', 'icons/b.png'], sorted(manifest))
+        self.assertEqual(2, manifest['icons/b.png']['size'])
+        self.assertEqual({'link': 'a.apk'}, manifest['c.apk'])
+        self.assertEqual(
+            fdroidserver.common.sha256sum('repo/a.apk'), manifest['a.apk']['sha256']
+        )
+
+        # unchanged files are not read again
+        manifest['a.apk']['sha256'] = 'known'
+        with mock.patch('fdroidserver.common.sha256sum') as sha256sum:
+            new = fdroidserver.common.make_repo_manifest('repo', manifest)
+        sha256sum.assert_not_called()
+        self.assertEqual('known', new['a.apk']['sha256'])
+
+        path = fdroidserver.common.get_repo_manifest_path('repo')
+        fdroidserver.common.write_repo_manifest(path, new)
+        self.assertEqual(new, fdroidserver.common.load_repo_manifest(path))
+        self.assertIsNone(fdroidserver.common.load_repo_manifest('nonexistent'))
+
     def test_parse_human_readable_size(self):
         for k, v in (
             (9827, 9827),
@@ -1932,6 +1958,82 @@ class CommonTest(SetUpTearDownMixin, unittest.TestCase):
                     skm.assert_called_once_with('srclib/ACRA')
                     self.assertEqual(ret, ('ACRA', None, 'srclib/ACRA'))
 
+    def test_compile_regex(self):
+        pattern = fdroidserver.common.compile_regex(r'^v([0-9.]+)$')
+        self.assertIs(pattern, fdroidserver.common.compile_regex(r'^v([0-9.]+)$'))
+        self.assertEqual('1.2', pattern.match('v1.2').group(1))
+        ignorecase = fdroidserver.common.compile_regex(r'^v([0-9.]+)$', re.IGNORECASE)
+        self.assertIsNot(pattern, ignorecase)
+        self.assertTrue(ignorecase.match('V1.2'))
+
+    def test_getsrclib_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir, TmpCwd(tmpdir):
+            upstream = git.Repo.init('upstream')
+            Path('upstream/lib.txt').write_text('lib')
+            upstream.index.add(['lib.txt'])
+            upstream.index.commit('first')
+            commit = upstream.head.commit.hexsha
+            fdroidserver.common.config = {'sdk_path': '', 'java_paths': {}, 'ndk_paths': {},
+                                          'cachedir': os.path.join(tmpdir, 'cache'),
+                                          'srclib_cache': True}
+            fdroidserver.metadata.srclibs = {'Lib': {'RepoType': 'git',
+                                                     'Repo': os.path.join(tmpdir, 'upstream'),
+                                                     'Subdir': None,
+                                                     'Prepare': ['echo prepared >> lib.txt',
+                                                                 'echo >> ../../prepared']}}
+
+            build = fdroidserver.metadata.Build({'commit': 'v1', 'versionCode': 1})
+            ret = fdroidserver.common.getsrclib('Lib@' + commit, 'srclib', build=build,
+                                                prepare=True)
+            self.assertEqual(('Lib', None, 'srclib/Lib'), ret)
+            self.assertEqual('libprepared\n', Path('srclib/Lib/lib.txt').read_text())
+            entries = os.listdir(os.path.join(tmpdir, 'cache', 'srclib'))
+            self.assertEqual(1, len(entries))
+            self.assertTrue(entries[0].startswith('Lib-'))
+
+            # a commit ID is found in the cache without checkout or Prepare
+            shutil.rmtree('srclib')
+            with mock.patch('fdroidserver.common.vcs_git.gotorevision') as gotorevision:
+                fdroidserver.common.getsrclib('Lib@' + commit, 'srclib', build=build,
+                                              prepare=True)
+            gotorevision.assert_not_called()
+            self.assertEqual('libprepared\n', Path('srclib/Lib/lib.txt').read_text())
+            # it is still a valid checkout of that commit
+            self.assertTrue(Path('srclib/.fdroidvcs-Lib').exists())
+            repo = git.Repo('srclib/Lib')
+            self.assertEqual(commit, repo.head.commit.hexsha)
+            self.assertEqual(['lib.txt'], [d.a_path for d in repo.index.diff(None)])
+
+            # a branch is checked out, but not prepared again
+            fdroidserver.common.getsrclib('Lib@' + upstream.active_branch.name,
+                                          'srclib', build=build, prepare=True)
+            self.assertEqual('libprepared\n', Path('srclib/Lib/lib.txt').read_text())
+            self.assertEqual('\n', Path('prepared').read_text())
+
+            # HEAD follows the cached commit, even if the checkout was elsewhere
+            Path('upstream/lib.txt').write_text('lib2')
+            upstream.index.add(['lib.txt'])
+            upstream.index.commit('second')
+            upstream.create_tag('v2')
+            fdroidserver.common.getsrclib('Lib@v2', 'srclib', build=build, prepare=True)
+            self.assertEqual('lib2prepared\n', Path('srclib/Lib/lib.txt').read_text())
+            fdroidserver.common.getsrclib('Lib@' + commit, 'srclib', build=build,
+                                          prepare=True)
+            self.assertEqual('libprepared\n', Path('srclib/Lib/lib.txt').read_text())
+            self.assertEqual(commit, git.Repo('srclib/Lib').head.commit.hexsha)
+
+    def test_prune_srclib_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir, TmpCwd(tmpdir):
+            fdroidserver.common.config = {'srclib_cache_size': '2kB'}
+            cachedir = Path('cache/srclib')
+            for i, name in enumerate(('Old-1', 'Used-2', 'New-3')):
+                (cachedir / name).mkdir(parents=True)
+                (cachedir / name / 'f').write_bytes(b'0' * 900)
+                os.utime(cachedir / name, (i, i))
+            os.utime(cachedir / 'Used-2')
+            fdroidserver.common._prune_srclib_cache(cachedir, cachedir / 'New-3')
+            self.assertEqual(['New-3', 'Used-2'], sorted(os.listdir(cachedir)))
+
     def test_run_yamllint_wellformed(self):
         try:
             import yamllint.config
@@ -2838,6 +2940,116 @@ class CommonTest(SetUpTearDownMixin, unittest.TestCase):
 
             vcs = fdroidserver.common.vcs_git(None, Path.cwd())
             self.assertEqual(vcs.latesttags(), tags[::-1])
+            self.assertEqual(vcs.latesttags(r'[0-9.]+$', 2), ['0.0.4', '2.2.2'])
+            self.assertEqual(vcs.latesttags('nomatch'), [])
+
+            # annotated tags are sorted by the date of their commit
+            with repo.config_writer() as cw:
+                cw.set_value('user', 'name', 'Foo Bar')
+                cw.set_value('user', 'email', 'foo@bar.com')
+            repo.create_tag('annotated', ref='1.1.1', message='old commit')
+            self.assertEqual(vcs.latesttags()[-2:], ['1.1.1', 'annotated'])
+
+    def test_vcs_git_extractfiles(self):
+        with tempfile.TemporaryDirectory() as tmpdir, TmpCwd(tmpdir):
+            repo = git.Repo.init('src')
+            Path('src/app/src/main/res/values').mkdir(parents=True)
+            Path('src/app/build.gradle').write_text('versionCode 1')
+            Path('src/app/src/main/res/values/strings.xml').write_text('<resources/>')
+            Path('src/README').write_text('readme')
+            repo.index.add(['app/build.gradle', 'app/src/main/res/values/strings.xml', 'README'])
+            repo.index.commit('first')
+            repo.create_tag('v1')
+            Path('src/app/build.gradle').write_text('versionCode 2')
+            repo.index.add(['app/build.gradle'])
+            repo.index.commit('second')
+
+            vcs = fdroidserver.common.vcs_git(None, Path('src'))
+            written = vcs.extractfiles('v1', 'out', lambda path: path != 'README')
+            self.assertEqual(
+                ['app/build.gradle', 'app/src/main/res/values/strings.xml'], sorted(written)
+            )
+            self.assertEqual('versionCode 1', Path('out/app/build.gradle').read_text())
+            self.assertEqual('<resources/>', Path('out/app/src/main/res/values/strings.xml').read_text())
+            self.assertFalse(Path('out/README').exists())
+            # the worktree is left as it is
+            self.assertEqual('versionCode 2', Path('src/app/build.gradle').read_text())
+
+    def test_vcs_git_extractfiles_outside_destdir(self):
+        with tempfile.TemporaryDirectory() as tmpdir, TmpCwd(tmpdir):
+            repo = git.Repo.init('src')
+            with repo.config_writer() as cw:
+                cw.set_value('user', 'name', 'Foo Bar')
+                cw.set_value('user', 'email', 'foo@bar.com')
+
+            def git_stdin(*args, stdin):
+                return subprocess.run(['git'] + list(args), cwd='src', check=True, text=True,
+                                      input=stdin, capture_output=True).stdout.strip()
+
+            # a hostile tree, git itself would refuse to check it out
+            blob = git_stdin('hash-object', '-w', '--stdin', stdin='evil')
+            tree = git_stdin('mktree', stdin=f'100644 blob {blob}\tAndroidManifest.xml\n')
+            tree = git_stdin('mktree', stdin=f'040000 tree {tree}\tx\n')
+            for _i in range(2):
+                tree = git_stdin('mktree', stdin=f'040000 tree {tree}\t..\n')
+            commit = git_stdin('commit-tree', tree, '-m', 'evil', stdin='')
+
+            Path('tmp/out').mkdir(parents=True)
+            vcs = fdroidserver.common.vcs_git(None, Path('src'))
+            with self.assertLogs(level='WARNING'):
+                written = vcs.extractfiles(commit, 'tmp/out', lambda path: True)
+            self.assertEqual([], written)
+            self.assertFalse(Path('x/AndroidManifest.xml').exists())
+
+    def test_vcs_git_shared_objects(self):
+        os.chdir(self.testdir)
+        upstream = git.Repo.init('upstream')
+        Path('upstream/README').write_text('readme')
+        upstream.index.add(['README'])
+        upstream.index.commit('first')
+        fdroidserver.common.config = {
+            'cachedir': 'cache',
+            'git_shared_objects': True,
+            'git_clone_filter': 'blob:none',
+        }
+
+        shared = fdroidserver.common.get_git_shared_objects_dir(str(Path('upstream').resolve()))
+        for name in ('a', 'b'):
+            vcs = fdroidserver.common.vcs_git(str(Path('upstream').resolve()), Path('build') / name)
+            vcs.gotorevision(None)
+            self.assertEqual('readme', Path('build', name, 'README').read_text())
+            self.assertEqual([shared / 'objects'], fdroidserver.common.get_git_alternates(vcs.local))
+        self.assertEqual(
+            [str(Path('build', n).resolve()) for n in ('a', 'b')],
+            (shared / fdroidserver.common.GIT_SHARED_OBJECTS_BORROWERS).read_text().splitlines(),
+        )
+        shared_config = git.Repo(shared).config_reader()
+        self.assertEqual(0, shared_config.get_value('gc', 'auto'))
+        self.assertFalse(shared_config.get_value('maintenance', 'auto'))
+        self.assertTrue(shared.with_name(shared.name + '.lock').exists())
+
+        # a clone that is not registered yet blocks the gc
+        with fdroidserver.common.lock_git_shared_objects(shared):
+            p = subprocess.run(
+                [sys.executable, '-c', 'import fcntl, sys; fcntl.flock(open(sys.argv[1]), fcntl.LOCK_EX | fcntl.LOCK_NB)',
+                 str(shared.with_name(shared.name + '.lock'))],
+                capture_output=True,
+            )
+            self.assertNotEqual(0, p.returncode)
+
+        shutil.rmtree('build/a')
+        fdroidserver.common.gc_git_shared_objects()
+        self.assertTrue(shared.exists())
+        self.assertEqual('readme', git.Repo('build/b').git.show('HEAD:README'))
+
+        shutil.rmtree(shared)
+        vcs = fdroidserver.common.vcs_git(str(Path('upstream').resolve()), Path('build/b'))
+        vcs.gotorevision(None)  # cloned again, since its objects were gone
+        self.assertEqual('readme', Path('build/b/README').read_text())
+
+        shutil.rmtree('build/b')
+        fdroidserver.common.gc_git_shared_objects()
+        self.assertFalse(shared.exists())
 
     def test_vcs_git_getref(self):
 
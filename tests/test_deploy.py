@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
 import configparser
+import json
 import logging
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 from pathlib import Path
 from unittest import mock
 
 import git
+import requests
 
 import fdroidserver
 
@@ -100,6 +103,49 @@ class DeployTest(unittest.TestCase):
         with self.assertRaises(SystemExit), self.assertLogs(level=logging.ERROR):
             fdroidserver.deploy.update_serverwebroots([{'url': 'ssh://nope'}], 'repo')
 
+    def test_run_deploy_tasks(self):
+        def fail():
+            raise fdroidserver.exception.FDroidException('nope')
+
+        with self.assertLogs(level=logging.ERROR):
+            results = fdroidserver.deploy.run_deploy_tasks(
+                {'a': lambda: None, 'b': fail, 'c': lambda: sys.exit(1)}, jobs=2
+            )
+        self.assertEqual(['a', 'b', 'c'], sorted(results))
+        self.assertNotIn('error', results['a'])
+        self.assertEqual('nope', results['b']['error'])
+        self.assertIn('error', results['c'])
+        self.assertIn('seconds', results['a'])
+
+    @mock.patch('fdroidserver.deploy.update_servergitmirrors')
+    @mock.patch('fdroidserver.deploy.update_serverwebroot')
+    def test_deploy_repo_section_index_last(self, update_serverwebroot, gitmirrors):
+        calls = []
+
+        def _update_serverwebroot(d, repo_section, phase=None):
+            calls.append((d['url'], phase))
+            if d['url'] == 'bad/fdroid' and phase == 'packages':
+                raise fdroidserver.exception.FDroidException()
+
+        update_serverwebroot.side_effect = _update_serverwebroot
+        gitmirrors.side_effect = lambda *args: calls.append(('git', 'index'))
+        config = {
+            'serverwebroot': [{'url': 'a/fdroid'}, {'url': 'bad/fdroid'}],
+            'servergitmirrors': [{'url': 'https://example.com/git'}],
+        }
+        with self.assertLogs(level=logging.ERROR):
+            results = fdroidserver.deploy.deploy_repo_section(
+                'repo', config, mock.Mock(jobs=4)
+            )
+        phases = [phase for url, phase in calls]
+        self.assertEqual(['packages', 'packages'], phases[:2])
+        self.assertEqual(['index', 'index'], phases[2:])
+        self.assertNotIn(('bad/fdroid', 'index'), calls)
+        self.assertIn('error', results['packages']['serverwebroot bad/fdroid'])
+        self.assertEqual(
+            ['serverwebroot a/fdroid', 'servergitmirrors'], list(results['index'])
+        )
+
     @unittest.skipUnless(shutil.which('rclone'), 'requires rclone')
     def test_update_remote_storage_with_rclone(self):
         os.chdir(self.testdir)
@@ -353,6 +399,81 @@ class DeployTest(unittest.TestCase):
         self.assertTrue(dest_apk.is_file())
         self.assertTrue(dest_index.is_file())
 
+    def test_get_current_repo_manifest_once_per_deploy(self):
+        os.chdir(self.testdir)
+        Path('repo').mkdir()
+        Path('repo/a.apk').write_text('a')
+        fdroidserver.common.write_repo_manifest(
+            fdroidserver.common.get_repo_manifest_path('repo'), {}
+        )
+        with mock.patch(
+            'fdroidserver.common.make_repo_manifest',
+            wraps=fdroidserver.common.make_repo_manifest,
+        ) as make_repo_manifest:
+            with mock.patch('fdroidserver.deploy._repo_manifests', dict()):
+                for _i in range(3):
+                    self.assertIn(
+                        'a.apk', fdroidserver.deploy._get_current_repo_manifest('repo')
+                    )
+        make_repo_manifest.assert_called_once_with('repo', {})
+
+    @mock.patch('subprocess.run', mock.Mock())
+    @mock.patch('subprocess.call')
+    def test_update_serverwebroot_manifest_delta(self, call):
+        os.chdir(self.testdir)
+        repo = Path('repo')
+        (repo / 'icons').mkdir(parents=True)
+        for f in ('old.apk', 'new.apk', 'icons/new.png', 'index-v2.json'):
+            (repo / f).write_text(f)
+        fdroidserver.common.write_repo_manifest(
+            fdroidserver.common.get_repo_manifest_path('repo'),
+            fdroidserver.common.make_repo_manifest('repo'),
+        )
+        url = 'example.com:/var/www/fdroid'
+        deployed = fdroidserver.common.make_repo_manifest('repo')
+        del deployed['new.apk']
+        del deployed['icons/new.png']
+        deployed['removed.apk'] = deployed['old.apk']
+        deployed['old/dir/removed.png'] = deployed['old.apk']
+        deployed['index-v2.json'] = {'size': 1, 'sha256': 'changed'}
+        deployed_path = fdroidserver.deploy._get_deployed_manifest_path(url, 'repo')
+        fdroidserver.common.write_repo_manifest(deployed_path, deployed)
+
+        files_from = []
+
+        def _call(cmd):
+            with open(cmd[cmd.index('--files-from') + 1]) as fp:
+                files_from.append(fp.read().split())
+            self.assertNotIn('--checksum', cmd)
+            self.assertNotIn('--delete-after', cmd)
+            self.assertEqual(['repo/', url + '/repo/'], cmd[-2:])
+            return 0
+
+        call.side_effect = _call
+        fdroidserver.common.options = mock.Mock(
+            verify=False, identity_file=None, verbose=False, quiet=False
+        )
+        fdroidserver.deploy.update_serverwebroot({'url': url}, 'repo')
+        self.assertEqual(
+            [
+                ['icons/new.png', 'new.apk'],
+                ['index-v2.json'],
+                ['old/dir/removed.png', 'removed.apk', 'old/dir', 'old'],
+            ],
+            files_from,
+        )
+        self.assertIn('--delete-missing-args', call.call_args[0][0])
+        self.assertIn('--force', call.call_args[0][0])
+        self.assertEqual(
+            fdroidserver.common.make_repo_manifest('repo'),
+            fdroidserver.common.load_repo_manifest(deployed_path),
+        )
+
+        # nothing changed since the last deploy
+        call.reset_mock()
+        fdroidserver.deploy.update_serverwebroot({'url': url}, 'repo')
+        call.assert_not_called()
+
     def test_update_serverwebroot_in_index_only_mode(self):
         os.chdir(self.testdir)
         repo = Path('repo')
@@ -774,6 +895,53 @@ class DeployTest(unittest.TestCase):
         virustotal_apikey = os.getenv('VIRUSTOTAL_API_KEY')
         fdroidserver.deploy.upload_to_virustotal('repo', virustotal_apikey)
 
+    @mock.patch('fdroidserver.net.get_session')
+    def test_upload_to_virustotal_queue(self, get_session):
+        os.chdir(self.testdir)
+        os.mkdir('repo')
+        packages = dict()
+        for i, name in enumerate(('old.reported', 'new.unknown', 'known')):
+            apkName = f'{name}_1.apk'
+            Path('repo', apkName).write_text(name)
+            packages[name] = [
+                {
+                    'packageName': name,
+                    'apkName': apkName,
+                    'hash': name.replace('.', '') + '0' * 10,
+                    'versionCode': 1,
+                    'added': i,
+                }
+            ]
+        Path('repo/index-v1.json').write_text(json.dumps({'packages': packages}))
+        os.mkdir('virustotal')
+        Path('virustotal/old.reported_1_oldreported0000000000.json').write_text('{}')
+
+        queue, _ignored = fdroidserver.deploy._load_virustotal_queue('repo')
+        self.assertEqual(['known', 'new.unknown'], [p['packageName'] for p in queue])
+
+        def _request(method, url, **kwargs):
+            r = requests.Response()
+            r.status_code = 404
+            if url.endswith('/known0000000000'):
+                r.status_code = 200
+                r._content = b'{"data": {"last_analysis_stats": {}}}'
+            elif method == 'POST':
+                r.status_code = 200
+            return r
+
+        get_session.return_value.request.side_effect = _request
+        stats = fdroidserver.deploy.upload_to_virustotal('repo', 'key', 6000)
+        self.assertEqual(1, stats['reports'])
+        self.assertEqual(1, stats['pending'])
+        self.assertEqual(3, stats['requests'])
+        self.assertTrue(Path('virustotal/known_1_known0000000000.json').exists())
+
+        # the index did not change, so only the uploaded APK is checked again
+        with mock.patch('json.load', wraps=json.load) as json_load:
+            queue, _ignored = fdroidserver.deploy._load_virustotal_queue('repo')
+        json_load.assert_called_once()
+        self.assertEqual(['new.unknown'], [p['packageName'] for p in queue])
+
     def test_remote_hostname_regex(self):
         for remote_url, name in (
             ('git@github.com:guardianproject/fdroid-repo', 'github'),
@@ -908,6 +1076,95 @@ class TestServerGitMirrors(unittest.TestCase):
             remote_file = f"fdroid/{self.repo_section}/{filename}"
             self.assertTrue((Path(verify_repo.working_tree_dir) / remote_file).exists())
 
+    def test_update_servergitmirrors_incremental(self):
+        fdroidserver.common.options.verify = False
+        manifest_path = fdroidserver.common.get_repo_manifest_path(self.repo_section)
+        fdroidserver.common.write_repo_manifest(
+            manifest_path, fdroidserver.common.make_repo_manifest(self.repo_section)
+        )
+        # the state a previous run would have left behind
+        git_mirror = git.Repo.init(
+            'git-mirror', initial_branch=fdroidserver.deploy.GIT_BRANCH
+        )
+        git_mirror.index.commit('empty')
+        fdroidserver.common.write_repo_manifest(
+            os.path.join(git_mirror.git_dir, fdroidserver.deploy.GIT_MIRROR_STATE_FILE),
+            {'manifest': {}, 'commit': git_mirror.head.commit.hexsha, 'size': 0},
+        )
+        servergitmirrors = fdroidserver.common.config["servergitmirrors"]
+
+        with (
+            mock.patch('fdroidserver.common.local_rsync') as local_rsync,
+            mock.patch('fdroidserver.deploy._get_size') as get_size,
+        ):
+            fdroidserver.deploy.update_servergitmirrors(
+                servergitmirrors, self.repo_section
+            )
+            os.remove(os.path.join(self.repo_section, self.fake_apk))
+            fdroidserver.common.write_repo_manifest(
+                manifest_path, fdroidserver.common.make_repo_manifest(self.repo_section)
+            )
+            fdroidserver.deploy.update_servergitmirrors(
+                servergitmirrors, self.repo_section
+            )
+            head = self.remote_git_repo.head.commit.hexsha
+            with mock.patch('git.remote.Remote.push') as push:
+                fdroidserver.deploy.update_servergitmirrors(
+                    servergitmirrors, self.repo_section
+                )
+            push.assert_not_called()
+        local_rsync.assert_not_called()
+        get_size.assert_not_called()
+        self.assertEqual(head, git_mirror.head.commit.hexsha)
+
+        verify_repo = self.remote_git_repo.clone(Path(self.testdir) / 'verify')
+        for filename in fdroidserver.common.INDEX_FILES:
+            remote_file = f"fdroid/{self.repo_section}/{filename}"
+            self.assertTrue((Path(verify_repo.working_tree_dir) / remote_file).exists())
+        remote_file = f"fdroid/{self.repo_section}/{self.fake_apk}"
+        self.assertFalse((Path(verify_repo.working_tree_dir) / remote_file).exists())
+
+    def test_update_servergitmirrors_incremental_sizes(self):
+        fdroidserver.common.options.verify = False
+        fdroidserver.common.config['git_mirror_size_limit'] = 1000
+        manifest_path = fdroidserver.common.get_repo_manifest_path(self.repo_section)
+        fdroidserver.common.write_repo_manifest(
+            manifest_path, fdroidserver.common.make_repo_manifest(self.repo_section)
+        )
+        git_mirror = git.Repo.init(
+            'git-mirror', initial_branch=fdroidserver.deploy.GIT_BRANCH
+        )
+        git_mirror.index.commit('empty')
+        Path('git-mirror/fdroid/archive').mkdir(parents=True)
+        Path('git-mirror/fdroid/archive/old.apk').write_bytes(b'0' * 100)
+        state_file = os.path.join(
+            git_mirror.git_dir, fdroidserver.deploy.GIT_MIRROR_STATE_FILE
+        )
+        fdroidserver.common.write_repo_manifest(
+            state_file,
+            {'manifest': {}, 'commit': git_mirror.head.commit.hexsha, 'size': 990},
+        )
+        manifest = fdroidserver.common.load_repo_manifest(manifest_path)
+
+        with (
+            mock.patch('fdroidserver.common.local_rsync'),
+            mock.patch('fdroidserver.deploy.upload_to_servergitmirror') as upload,
+            mock.patch('fdroidserver.deploy._get_size', return_value=500) as get_size,
+        ):
+            fdroidserver.deploy.update_servergitmirrors(
+                fdroidserver.common.config["servergitmirrors"], self.repo_section
+            )
+        # the archive counts towards the GitLab Pages limit
+        self.assertEqual(
+            100 + sum(e['size'] for e in manifest.values()),
+            upload.call_args[1]['fdroid_dir_size'],
+        )
+        # the upper bound went over the limit, so it was measured
+        get_size.assert_called_once()
+        self.assertEqual(
+            500, fdroidserver.common.load_repo_manifest(state_file)['size']
+        )
+
     def test_update_servergitmirrors_in_index_only_mode(self):
         fdroidserver.common.config["servergitmirrors"][0]["index_only"] = True
 
@@ -1178,7 +1435,7 @@ class Test_UploadToGithubReleasesRepo(unittest.TestCase):
             )
 
         self.api_constructor.assert_called_once_with(
-            "global_token", "https://github.com/example/app"
+            "global_token", "https://github.com/example/app", cachedir=unittest.mock.ANY
         )
 
         self.assertListEqual(
@@ -1207,7 +1464,7 @@ class Test_UploadToGithubReleasesRepo(unittest.TestCase):
             )
 
         self.api_constructor.assert_called_once_with(
-            "local_token", "https://github.com/example/app"
+            "local_token", "https://github.com/example/app", cachedir=unittest.mock.ANY
         )
 
         self.assertListEqual(
@@ -1,42 +1,104 @@
 #!/usr/bin/env python3
 
+import json
+import os
 import unittest
 import unittest.mock
 
+import requests
+
 import fdroidserver
 
-from .shared_test_code import mock_urlopen
+from .shared_test_code import mkdtemp
+
+
+def make_response(status=200, body=None, headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = body.encode() if isinstance(body, str) else body
+    r.headers.update(headers or {})
+    return r
 
 
 class GithubApiTest(unittest.TestCase):
+    def setUp(self):
+        self.session = unittest.mock.Mock()
+        patcher = unittest.mock.patch(
+            'fdroidserver.net.get_session', return_value=self.session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test__init(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
         self.assertEqual(api._api_token, 'faketoken')
         self.assertEqual(api._repo_path, 'fakerepopath')
 
-    def test__req(self):
+    def test__headers(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-        r = api._req('https://fakeurl', data='fakedata')
-        self.assertEqual(r.full_url, 'https://fakeurl')
-        self.assertEqual(r.data, "fakedata")
         self.assertDictEqual(
-            r.headers,
+            api._headers(),
             {
                 'Accept': 'application/vnd.github+json',
                 'Authorization': 'Bearer faketoken',
-                'X-github-api-version': '2022-11-28',
+                'X-GitHub-Api-Version': '2022-11-28',
             },
         )
 
     def test_list_released_tags(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-        uomock = mock_urlopen(
+        self.session.request.return_value = make_response(
             body='[{"tag_name": "fake"}, {"tag_name": "double_fake"}]'
         )
-        with unittest.mock.patch("urllib.request.urlopen", uomock):
-            result = api.list_released_tags()
+        result = api.list_released_tags()
         self.assertListEqual(result, ['fake', 'double_fake'])
 
+    def test_list_released_tags_paginated(self):
+        api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
+        next_url = 'https://api.github.com/repositories/1/releases?per_page=100&page=2'
+        self.session.request.side_effect = [
+            make_response(
+                body='[{"tag_name": "2"}]',
+                headers={'Link': f'<{next_url}>; rel="next"'},
+            ),
+            make_response(body='[{"tag_name": "1"}]'),
+        ]
+        self.assertListEqual(['2', '1'], api.list_released_tags())
+        self.assertEqual(next_url, self.session.request.call_args_list[1][0][1])
+
+    def test_list_released_tags_etag_cache(self):
+        testdir = mkdtemp()
+        self.addCleanup(testdir.cleanup)
+        self.session.request.return_value = make_response(
+            body='[{"tag_name": "fake"}]', headers={'ETag': '"abc"'}
+        )
+        api = fdroidserver.github.GithubApi('t', 'fakerepopath', testdir.name)
+        self.assertListEqual(['fake'], api.list_released_tags())
+        self.assertIsNone(
+            self.session.request.call_args[1]['headers'].get('If-None-Match')
+        )
+        self.assertTrue(os.path.exists(api._get_etag_cache_path()))
+
+        # unchanged on the server, so the list comes from the cache
+        self.session.request.return_value = make_response(status=304)
+        api = fdroidserver.github.GithubApi('t', 'fakerepopath', testdir.name)
+        self.assertListEqual(['fake'], api.list_released_tags())
+        self.assertEqual(
+            '"abc"', self.session.request.call_args[1]['headers']['If-None-Match']
+        )
+
+    @unittest.mock.patch('time.sleep')
+    def test_rate_limit(self, sleep):
+        api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
+        self.session.request.side_effect = [
+            make_response(status=429, headers={'Retry-After': '30'}),
+            make_response(body='[{"tag_name": "fake"}]'),
+        ]
+        self.assertListEqual(['fake'], api.list_released_tags())
+        self.assertEqual(2, self.session.request.call_count)
+        sleep.assert_called_once()
+        self.assertAlmostEqual(30, sleep.call_args[0][0], delta=2)
+
     def test_list_unreleased_tags(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
 
@@ -49,54 +111,42 @@ class GithubApiTest(unittest.TestCase):
 
     def test_tag_exists(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-        uomock = mock_urlopen(body='[{"ref": "refs/tags/fake_tag"}]')
-        with unittest.mock.patch("urllib.request.urlopen", uomock):
-            result = api.tag_exists('fake_tag')
+        self.session.request.return_value = make_response(
+            body='[{"ref": "refs/tags/fake_tag"}]'
+        )
+        result = api.tag_exists('fake_tag')
         self.assertTrue(result)
 
     def test_tag_exists_failure(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-
-        uomock = mock_urlopen(body='[{"error": "failure"}]')
-
-        with unittest.mock.patch("urllib.request.urlopen", uomock):
-            success = api.tag_exists('fake_tag')
-
+        self.session.request.return_value = make_response(body='[{"error": "failure"}]')
+        success = api.tag_exists('fake_tag')
         self.assertFalse(success)
 
     def test_list_all_tags(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-
-        uomock = mock_urlopen(
+        self.session.request.return_value = make_response(
             body='[{"ref": "refs/tags/fake"}, {"ref": "refs/tags/double_fake"}]'
         )
-
-        with unittest.mock.patch("urllib.request.urlopen", uomock):
-            result = api.list_all_tags()
-
+        result = api.list_all_tags()
         self.assertListEqual(result, ['fake', 'double_fake'])
 
     def test_create_release(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-
-        uomock = mock_urlopen(body='{"id": "fakeid"}')
+        self.session.request.return_value = make_response(body='{"id": "fakeid"}')
         api.tag_exists = lambda x: True
         api._create_release_asset = unittest.mock.Mock()
 
-        with unittest.mock.patch("urllib.request.urlopen", uomock):
-            success = api.create_release('faketag', ['file_a', 'file_b'], body="bdy")
+        success = api.create_release('faketag', ['file_a', 'file_b'], body="bdy")
         self.assertTrue(success)
 
-        req = uomock.call_args_list[0][0][0]
-        self.assertEqual(1, len(uomock.call_args_list))
-        self.assertEqual(2, len(uomock.call_args_list[0]))
-        self.assertEqual(1, len(uomock.call_args_list[0][0]))
+        self.assertEqual(1, self.session.request.call_count)
+        args, kwargs = self.session.request.call_args
         self.assertEqual(
-            req.full_url,
-            'https://api.github.com/repos/fakerepopath/releases',
+            ('POST', 'https://api.github.com/repos/fakerepopath/releases'), args
         )
-        self.assertEqual(req.data, b'{"tag_name": "faketag", "body": "bdy"}')
-        self.assertListEqual(
+        self.assertEqual(kwargs['data'], b'{"tag_name": "faketag", "body": "bdy"}')
+        self.assertCountEqual(
             api._create_release_asset.call_args_list,
             [
                 unittest.mock.call('fakeid', 'file_a'),
@@ -104,36 +154,44 @@ class GithubApiTest(unittest.TestCase):
             ],
         )
 
+    def test_create_release_already_exists(self):
+        api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
+        self.session.request.return_value = make_response(
+            status=422, body=json.dumps({'errors': [{'code': 'already_exists'}]})
+        )
+        api.tag_exists = lambda x: True
+        api._create_release_asset = unittest.mock.Mock()
+        self.assertFalse(api.create_release('faketag', ['file_a']))
+        api._create_release_asset.assert_not_called()
+
     def test__create_release_asset(self):
         api = fdroidserver.github.GithubApi('faketoken', 'fakerepopath')
-        uomock = mock_urlopen()
+        self.session.request.return_value = make_response(status=201)
 
-        with (
-            unittest.mock.patch(
-                'fdroidserver.github.open',
-                unittest.mock.mock_open(read_data=b"fake_content"),
-            ),
-            unittest.mock.patch("urllib.request.urlopen", uomock),
-        ):
-            success = api._create_release_asset('fake_id', 'fake_file')
+        with unittest.mock.patch(
+            'fdroidserver.github.open',
+            unittest.mock.mock_open(read_data=b"fake_content"),
+        ) as open_mock:
+            success = api._create_release_asset('fake_id', 'fake file')
 
         self.assertTrue(success)
 
-        req = uomock.call_args_list[0][0][0]
-        self.assertEqual(1, len(uomock.call_args_list))
-        self.assertEqual(2, len(uomock.call_args_list[0]))
-        self.assertEqual(1, len(uomock.call_args_list[0][0]))
+        self.assertEqual(1, self.session.request.call_count)
+        args, kwargs = self.session.request.call_args
         self.assertEqual(
-            req.full_url,
-            'https://uploads.github.com/repos/fakerepopath/releases/fake_id/assets?name=fake_file',
+            (
+                'POST',
+                'https://uploads.github.com/repos/fakerepopath/releases/fake_id/assets?name=fake%20file',
+            ),
+            args,
         )
         self.assertDictEqual(
-            req.headers,
+            kwargs['headers'],
             {
                 "Accept": "application/vnd.github+json",
                 'Authorization': 'Bearer faketoken',
-                'Content-type': 'application/octet-stream',
-                'X-github-api-version': '2022-11-28',
+                'Content-Type': 'application/octet-stream',
+                'X-GitHub-Api-Version': '2022-11-28',
             },
         )
-        self.assertEqual(req.data, b'fake_content')
+        self.assertIs(open_mock.return_value, kwargs['data'])
@@ -127,7 +127,7 @@ class IndexTest(SetUpTearDownMixin, unittest.TestCase):
             'repo/index-v1.jar', fingerprint, allow_deprecated=True
         )
 
-    @patch('requests.head')
+    @patch('requests.Session.head')
     def test_download_repo_index_same_etag(self, head):
         url = 'http://example.org?fingerprint=test'
         etag = '"4de5-54d840ce95cb9"'
@@ -138,8 +138,8 @@ class IndexTest(SetUpTearDownMixin, unittest.TestCase):
         self.assertIsNone(data)
         self.assertEqual(etag, new_etag)
 
-    @patch('requests.get')
-    @patch('requests.head')
+    @patch('requests.Session.get')
+    @patch('requests.Session.head')
     def test_download_repo_index_new_etag(self, head, get):
         url = 'http://example.org?fingerprint=' + GP_FINGERPRINT
         etag = '"4de5-54d840ce95cb9"'
@@ -1188,6 +1188,105 @@ class AltstoreIndexTest(unittest.TestCase):
                 )
 
 
+class DownloadRepoIndexV2CacheTest(SetUpTearDownMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        os.chdir(self.testdir)
+        os.makedirs('repo/diff')
+        self.cachedir = os.path.join(self.testdir, 'cache')
+        self.url = 'https://fake.url/fdroid/repo?fingerprint=' + GP_FINGERPRINT
+        self.downloaded = []
+        patchers = (
+            patch(
+                'fdroidserver.net.download_using_mirrors',
+                side_effect=self._download_using_mirrors,
+            ),
+            patch(
+                'fdroidserver.index.get_index_from_jar',
+                side_effect=lambda f, fp: (self.entry, b'', GP_FINGERPRINT),
+            ),
+        )
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _download_using_mirrors(self, mirrors):
+        name = mirrors[0]['url'].split('/fdroid/repo/', 1)[1]
+        self.downloaded.append(name)
+        return os.path.join(self.testdir, 'repo', name)
+
+    def _file_entry(self, name, data):
+        path = Path('repo', name)
+        path.write_text(json.dumps(data))
+        return {
+            'name': '/' + name,
+            'sha256': common.sha256sum(path),
+            'size': path.stat().st_size,
+            'numPackages': len(data.get('packages', [])),
+        }
+
+    def _publish(self, data, diffs=()):
+        self.entry = {
+            'timestamp': data['repo']['timestamp'],
+            'version': 30000,
+            'index': self._file_entry('index-v2.json', data),
+            'diffs': {},
+        }
+        for old in diffs:
+            timestamp = str(old['repo']['timestamp'])
+            diff = index.dict_diff(old, data)
+            self.entry['diffs'][timestamp] = self._file_entry(
+                f'diff/{timestamp}.json', diff
+            )
+
+    def _download(self):
+        self.downloaded = []
+        data, _ignored = index.download_repo_index_v2(self.url, cachedir=self.cachedir)
+        return data
+
+    def test_apply_dict_diff(self):
+        old = {'a': 1, 'b': {'c': [1, 2], 'd': 'e'}, 'f': None}
+        new = {'a': 2, 'b': {'c': [1], 'g': {}}, 'h': 'i'}
+        self.assertEqual(new, index.apply_dict_diff(old, index.dict_diff(old, new)))
+
+    def test_cached_and_diffed(self):
+        old = json.loads((basedir / 'repo' / 'index-v2.json').read_text())
+        self._publish(old)
+        self.assertEqual(old, self._download())
+        self.assertEqual(['entry.jar', 'index-v2.json'], self.downloaded)
+
+        # the index did not change, only the entry is downloaded
+        self.assertEqual(old, self._download())
+        self.assertEqual(['entry.jar'], self.downloaded)
+
+        new = copy.deepcopy(old)
+        new['repo']['timestamp'] += 1000
+        del new['packages']['com.politedroid']
+        new['packages']['souch.smsbypass']['metadata']['license'] = 'MIT'
+        self._publish(new, diffs=[old])
+        self.assertEqual(new, self._download())
+        timestamp = old['repo']['timestamp']
+        self.assertEqual(['entry.jar', f'diff/{timestamp}.json'], self.downloaded)
+
+        # no diff from the cached version, so the full index is downloaded
+        newer = copy.deepcopy(new)
+        newer['repo']['timestamp'] += 1000
+        self._publish(newer, diffs=[old])
+        self.assertEqual(newer, self._download())
+        self.assertEqual(['entry.jar', 'index-v2.json'], self.downloaded)
+
+    def test_bad_diff(self):
+        old = json.loads((basedir / 'repo' / 'index-v2.json').read_text())
+        self._publish(old)
+        self._download()
+        new = copy.deepcopy(old)
+        new['repo']['timestamp'] += 1000
+        self._publish(new, diffs=[old])
+        Path('repo/diff', f"{old['repo']['timestamp']}.json").write_text('{}')
+        with self.assertRaises(fdroidserver.exception.VerificationException):
+            self._download()
+
+
 class DnsCacheTest(SetUpTearDownMixin, unittest.TestCase):
 
     url = 'https://f-droid.org/repo/entry.jar'
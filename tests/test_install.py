@@ -163,6 +163,38 @@ class InstallTest(unittest.TestCase):
         common.fill_config_defaults(common.config)
         self.assertEqual([], fdroidserver.install.devices())
 
+    @patch('time.sleep')
+    @patch('fdroidserver.install.devices', Mock(return_value=['dev1', 'dev2']))
+    @patch('fdroidserver.common.SdkToolsPopen')
+    def test_install_apks_to_devices(self, mock_SdkToolsPopen, sleep):
+        attempts = {'dev2': 0}
+
+        def _adb(cmd):
+            dev, apk = cmd[2], cmd[4]
+            p = Mock(returncode=0, output='Success\n')
+            if dev == 'dev2' and apk == 'a.apk' and attempts['dev2'] == 0:
+                # a transient adb error, which gets retried
+                attempts['dev2'] += 1
+                p.returncode, p.output = 1, 'adb: device offline\n'
+            elif dev == 'dev1' and apk == 'b.apk':
+                p.output = 'Failure [INSTALL_FAILED_ALREADY_EXISTS]\n'
+            elif dev == 'dev2' and apk == 'c.apk':
+                p.returncode, p.output = 1, 'Failure [INSTALL_FAILED_OLDER_SDK]\n'
+            return p
+
+        mock_SdkToolsPopen.side_effect = _adb
+        with self.assertRaises(FDroidException) as cm, self.assertLogs() as logs:
+            install.install_apks_to_devices(['a.apk', 'b.apk', 'c.apk'])
+        self.assertIn('dev2 c.apk: INSTALL_FAILED_OLDER_SDK', str(cm.exception))
+        self.assertEqual(7, mock_SdkToolsPopen.call_count)
+        sleep.assert_called_once()
+        self.assertIn(
+            'INFO:root:dev1: 2 installed, 1 already installed, 0 failed', logs.output
+        )
+        self.assertIn(
+            'INFO:root:dev2: 2 installed, 0 already installed, 1 failed', logs.output
+        )
+
     @staticmethod
     def _download_raise(privacy_mode):
         raise Exception('fake failed download')
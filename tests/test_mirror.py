@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+from fdroidserver import mirror
+
+from .shared_test_code import mkdtemp
+
+FILES = {
+    'repo/a.apk': b'first APK',
+    'repo/b.apk': b'second APK',
+    'repo/a.apk.asc': b'signature',
+}
+
+
+def _fake_download_file(url, local_filename, **kwargs):
+    path = url.split('/fdroid/', 1)[1]
+    if path not in FILES:
+        response = requests.Response()
+        response.status_code = 404
+        raise requests.exceptions.HTTPError(response=response)
+    with open(local_filename, 'ab' if kwargs.get('resume') else 'wb') as fp:
+        fp.write(FILES[path][fp.tell() :])
+    kwargs['hashes']['sha256'] = hashlib.sha256(FILES[path]).hexdigest()
+    return local_filename
+
+
+class MirrorDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self._td = mkdtemp()
+        self.basedir = self._td.name
+
+    def tearDown(self):
+        self._td.cleanup()
+
+    def _add_all(self, downloader, **hashes):
+        for name in ('a.apk', 'b.apk'):
+            content = FILES['repo/' + name]
+            downloader.add(
+                'https://example.com/fdroid/repo/' + name + '?fingerprint=abc',
+                os.path.join(self.basedir, 'repo', name),
+                sha256=hashes.get(name, hashlib.sha256(content).hexdigest()),
+                size=len(content),
+            )
+        downloader.add(
+            'https://example.com/fdroid/repo/b.apk.asc',
+            os.path.join(self.basedir, 'repo', 'b.apk.asc'),
+            optional=True,
+        )
+
+    @mock.patch('fdroidserver.net.download_file', side_effect=_fake_download_file)
+    def test_download_and_resume(self, download_file):
+        downloader = mirror.MirrorDownloader(self.basedir, jobs=2)
+        # a partial download from an interrupted run
+        os.makedirs(os.path.join(self.basedir, 'repo'))
+        Path(self.basedir, 'repo', 'a.apk.part').write_bytes(b'first')
+        self._add_all(downloader)
+        self.assertEqual([], downloader.run())
+        self.assertEqual(3, download_file.call_count)
+        self.assertIn(
+            'https://example.com/fdroid/repo/a.apk',
+            [c[0][0] for c in download_file.call_args_list],
+        )
+        self.assertEqual(b'first APK', Path(self.basedir, 'repo', 'a.apk').read_bytes())
+        # only files with a hash to verify against are resumed
+        self.assertEqual(
+            {'a.apk': True, 'b.apk': True, 'b.apk.asc': False},
+            {
+                c[0][0].rsplit('/', 1)[1]: c[1]['resume']
+                for c in download_file.call_args_list
+            },
+        )
+        self.assertFalse(Path(self.basedir, 'repo', 'a.apk.part').exists())
+        with open(os.path.join(self.basedir, mirror.MIRROR_STATE_FILE)) as fp:
+            self.assertEqual({'repo/a.apk', 'repo/b.apk'}, set(json.load(fp)))
+
+        # complete files are neither downloaded nor hashed again
+        download_file.reset_mock()
+        downloader = mirror.MirrorDownloader(self.basedir)
+        with mock.patch('fdroidserver.common.sha256sum') as sha256sum:
+            self._add_all(downloader)
+        sha256sum.assert_not_called()
+        self.assertEqual(1, len(downloader.queue))  # the missing optional file
+        self.assertEqual([], downloader.run())
+
+    @mock.patch('fdroidserver.net.download_file', side_effect=_fake_download_file)
+    def test_hash_mismatch(self, download_file):
+        downloader = mirror.MirrorDownloader(self.basedir)
+        self._add_all(downloader, **{'b.apk': '0' * 64})
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(['repo/b.apk'], downloader.run())
+        self.assertTrue(Path(self.basedir, 'repo', 'a.apk').exists())
+        self.assertFalse(Path(self.basedir, 'repo', 'b.apk').exists())
+        self.assertFalse(Path(self.basedir, 'repo', 'b.apk.part').exists())
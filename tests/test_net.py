@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import hashlib
 import os
 import random
 import socket
@@ -104,6 +105,109 @@ class NetTest(unittest.TestCase):
         self.assertTrue(os.path.exists(f))
         self.assertEqual('tmp/com.downloader.aegis-3175421.apk', f)
 
+    def test_download_file_resume(self):
+        Path('tmp/f.apk').write_bytes(b'first ')
+        Path('tmp/f.apk.validator').write_text('"abc"')
+        r = MagicMock(status_code=206, headers={})
+        r.iter_content.return_value = [b'second']
+        session = MagicMock()
+        session.get.return_value = r
+        hashes = {'sha256': None}
+        f = net.download_file(
+            'https://example.com/f.apk', session=session, resume=True, hashes=hashes
+        )
+        self.assertEqual(b'first second', Path(f).read_bytes())
+        headers = session.get.call_args[1]['headers']
+        self.assertEqual('bytes=6-', headers['Range'])
+        self.assertEqual('"abc"', headers['If-Range'])
+        self.assertEqual(hashlib.sha256(b'first second').hexdigest(), hashes['sha256'])
+        self.assertFalse(os.path.exists('tmp/f.apk.validator'))
+
+        # without a validator, the download starts from zero
+        r.status_code = 200
+        r.headers = {'ETag': 'W/"weak"', 'Last-Modified': 'Tue, 01 Jan 2030'}
+        r.iter_content.return_value = [b'new']
+        net.download_file('https://example.com/f.apk', session=session, resume=True)
+        self.assertNotIn('Range', session.get.call_args[1]['headers'])
+        self.assertEqual(b'new', Path(f).read_bytes())
+
+    def test_download_file_resume_interrupted(self):
+        r = MagicMock(status_code=200, headers={'ETag': '"abc"'})
+        r.iter_content.side_effect = requests.exceptions.ChunkedEncodingError
+        session = MagicMock()
+        session.get.return_value = r
+        with (
+            patch('time.sleep'),
+            self.assertRaises(requests.exceptions.ChunkedEncodingError),
+        ):
+            net.download_file(
+                'https://example.com/f.apk', session=session, resume=True, retries=0
+            )
+        self.assertEqual('"abc"', Path('tmp/f.apk.validator').read_text())
+
+        # the server ignored If-Range because the file changed
+        Path('tmp/f.apk').write_bytes(b'old')
+        r.iter_content.side_effect = None
+        r.iter_content.return_value = [b'changed']
+        r.headers = {'ETag': '"def"'}
+        net.download_file('https://example.com/f.apk', session=session, resume=True)
+        self.assertEqual('"abc"', session.get.call_args[1]['headers']['If-Range'])
+        self.assertEqual(b'changed', Path('tmp/f.apk').read_bytes())
+        self.assertFalse(os.path.exists('tmp/f.apk.validator'))
+
+    def test_download_file_resume_416(self):
+        Path('tmp/f.apk').write_bytes(b'complete')
+        Path('tmp/f.apk.validator').write_text('"abc"')
+        r = MagicMock(status_code=416, headers={'Content-Range': 'bytes */8'})
+        session = MagicMock()
+        session.get.return_value = r
+        hashes = {'sha256': None}
+        net.download_file(
+            'https://example.com/f.apk', session=session, resume=True, hashes=hashes
+        )
+        session.get.assert_called_once()
+        self.assertEqual(b'complete', Path('tmp/f.apk').read_bytes())
+        self.assertEqual(hashlib.sha256(b'complete').hexdigest(), hashes['sha256'])
+        self.assertFalse(os.path.exists('tmp/f.apk.validator'))
+
+        # a 416 for a different size restarts from zero
+        Path('tmp/f.apk.validator').write_text('"abc"')
+        r.headers = {'Content-Range': 'bytes */100'}
+        r2 = MagicMock(status_code=200, headers={})
+        r2.iter_content.return_value = [b'longer']
+        session.get.reset_mock()
+        session.get.side_effect = [r, r2]
+        net.download_file(
+            'https://example.com/f.apk', session=session, resume=True, retries=0
+        )
+        self.assertEqual(2, session.get.call_count)
+        self.assertNotIn('Range', session.get.call_args[1]['headers'])
+        self.assertEqual(b'longer', Path('tmp/f.apk').read_bytes())
+
+    def test_get_session(self):
+        session = net.get_session()
+        self.assertIs(session, net.get_session())
+        self.assertNotIn('http://', session.adapters)
+        self.assertIn('http://', net.get_session(https_only=False).adapters)
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(session, net.get_session())
+
+    @patch('time.sleep')
+    def test_token_bucket(self, sleep):
+        now = [1000.0]
+        sleep.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+        with patch('time.monotonic', side_effect=lambda: now[0]):
+            bucket = net.TokenBucket(rate=0.5, capacity=2)
+            bucket.acquire()
+            bucket.acquire()
+            sleep.assert_not_called()
+            bucket.acquire()
+            self.assertEqual(2, sleep.call_args[0][0])
+            bucket.pause(60)
+            bucket.acquire()
+            self.assertEqual(1062, now[0])
+            self.assertEqual(4, bucket.requests)
+
     @patch.dict(os.environ, clear=True)
     def test_download_file_no_http(self):
         with self.assertRaises(requests.exceptions.InvalidSchema):
@@ -147,6 +251,31 @@ class NetTest(unittest.TestCase):
         self.assertEqual(server.reply.split(b'\n\n')[1], Path(f).read_bytes())
         server.stop()
 
+    def test_download_using_mirrors_without_sni(self):
+        r = MagicMock(status_code=200)
+        r.iter_content.return_value = [b'data']
+        pooled = MagicMock()
+        pooled.get.return_value = MagicMock(status_code=404)
+        fresh = MagicMock()
+        fresh.get.return_value = r
+        with (
+            patch('fdroidserver.net.get_session', return_value=pooled),
+            patch('requests.Session', return_value=fresh),
+        ):
+            f = net.download_using_mirrors(
+                [
+                    {'url': 'https://a.example.com/f.txt'},
+                    {'url': 'https://b.example.com/f.txt', 'worksWithoutSNI': True},
+                ],
+                local_filename='tmp/f.txt',
+            )
+        self.assertEqual(b'data', Path(f).read_bytes())
+        # the mirror without SNI never uses a pooled connection
+        pooled.get.assert_called_once()
+        self.assertEqual('https://a.example.com/f.txt', pooled.get.call_args[0][0])
+        self.assertEqual('https://b.example.com/f.txt', fresh.get.call_args[0][0])
+        fresh.close.assert_called_once()
+
     @patch.dict(os.environ, clear=True)
     def test_download_using_mirrors_retries_not_forever(self):
         """The retry logic should eventually exit with an error."""
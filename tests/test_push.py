@@ -87,3 +87,92 @@ class Push_podman_push(PushTest):
         f.write_text(f.name)
         push.podman_push(f, APPID, VERCODE)
         common.inside_exec(APPID, VERCODE, ['test', '-e', str(f)], 'podman')
+
+
+class Push_BuildInputCache(PushTest):
+    def setUp(self):
+        super().setUp()
+        self.cache = push.BuildInputCache(Path(self.testdir) / 'cache', 10000)
+        self.srclib = Path('build/srclib/foo')
+        self.srclib.mkdir(parents=True)
+        (self.srclib / 'build.gradle').write_text('apply plugin: "java"\n')
+        (self.srclib / '__pycache__').mkdir()
+        (self.srclib / '__pycache__' / 'foo.pyc').write_text('ignored')
+
+    def test_hash_tree_stable(self):
+        digest = push.BuildInputCache.hash_tree(self.srclib)
+        (self.srclib / '__pycache__' / 'bar.pyc').write_text('ignored')
+        self.assertEqual(digest, push.BuildInputCache.hash_tree(self.srclib))
+
+    def test_hash_tree_changed(self):
+        digest = push.BuildInputCache.hash_tree(self.srclib)
+        (self.srclib / 'build.gradle').write_text('changed')
+        self.assertNotEqual(digest, push.BuildInputCache.hash_tree(self.srclib))
+
+    def test_add(self):
+        digest = self.cache.add(self.srclib)
+        entry = self.cache.get_entry_path(digest)
+        self.assertTrue((entry / 'build.gradle').exists())
+        self.assertFalse((entry / '__pycache__').exists())
+        self.assertEqual(digest, self.cache.add(self.srclib))
+        self.assertEqual(1, len(self.cache._read_index()))
+
+    def test_add_file(self):
+        f = Path('metadata/com.example.yml')
+        f.parent.mkdir()
+        f.write_text('Name: Test\n')
+        digest = self.cache.add(f)
+        self.assertEqual(f.read_text(), self.cache.get_entry_path(digest).read_text())
+
+    def test_evict_lru(self):
+        self.cache.max_size = 1000
+        digests = []
+        for i in range(3):
+            f = Path(f'input{i}')
+            f.write_text(str(i) * 400)
+            digests.append(self.cache.add(f))
+        index = self.cache._read_index()
+        self.assertNotIn(digests[0], index)
+        self.assertIn(digests[1], index)
+        self.assertIn(digests[2], index)
+        self.assertFalse((self.cache.root / digests[0]).exists())
+
+    def test_evict_skips_pinned(self):
+        self.cache.max_size = 1000
+        f = Path('input0')
+        f.write_text('0' * 400)
+        with self.cache.pinned(f) as pinned:
+            for i in range(1, 3):
+                f = Path(f'input{i}')
+                f.write_text(str(i) * 400)
+                self.cache.add(f)
+            self.assertTrue(self.cache.get_entry_path(pinned).exists())
+            self.assertIn(pinned, self.cache._read_index())
+        f = Path('input3')
+        f.write_text('3' * 400)
+        self.cache.add(f)
+        self.assertFalse(self.cache.get_entry_path(pinned).exists())
+
+    @mock.patch('fdroidserver.common.inside_exec')
+    def test_podman_push_cached(self, inside_exec):
+        push.podman_push_cached([str(self.srclib)], APPID, VERCODE, self.cache)
+        digest = push.BuildInputCache.hash_tree(self.srclib)
+        cmd = inside_exec.call_args[0][2]
+        self.assertIn(f'{push.BUILD_INPUT_CACHE_MOUNT}/{digest}/tree', cmd)
+        self.assertIn(f'{common.BUILD_HOME}/{self.srclib}', cmd)
+        self.assertEqual('1000:1000', cmd[-1])
+        push.podman_push_cached([str(self.srclib)], APPID, VERCODE, self.cache, True)
+        self.assertEqual('0:0', inside_exec.call_args[0][2][-1])
+
+    def test_podman_push_cached_bad_absolute_path(self):
+        with self.assertRaises(exception.BuildException):
+            push.podman_push_cached('/etc/passwd', APPID, VERCODE, self.cache)
+
+    def test_get_build_input_cache_disabled(self):
+        self.assertIsNone(push.get_build_input_cache())
+
+    def test_get_build_input_cache(self):
+        common.config['cachedir'] = self.testdir
+        common.config['build_input_cache_size'] = '1GB'
+        cache = push.get_build_input_cache()
+        self.assertEqual(10**9, cache.max_size)
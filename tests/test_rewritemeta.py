@@ -120,6 +120,34 @@ class RewriteMetaTest(unittest.TestCase):
                 ),
             )
 
+    def test_rewrite_skips_unchanged(self):
+        os.chdir(self.testdir)
+        Path('metadata').mkdir()
+        Path('metadata/a.yml').write_text('AutoName: a')
+        Path('metadata/b.yml').write_text('AutoName: b')
+        with mock.patch('sys.argv', ['fdroid rewritemeta', '--list']):
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                rewritemeta.main()
+        self.assertEqual('metadata/a.yml\nmetadata/b.yml\n', stdout.getvalue())
+        self.assertEqual('AutoName: a', Path('metadata/a.yml').read_text())
+
+        rewritemeta.rewrite_file('metadata/b.yml')
+        mtime = Path('metadata/b.yml').stat().st_mtime_ns
+        with mock.patch('sys.argv', ['fdroid rewritemeta', '--jobs', '1']):
+            with mock.patch(
+                'fdroidserver.metadata.parse_metadata', wraps=metadata.parse_metadata
+            ) as parse_metadata:
+                rewritemeta.main()
+        self.assertEqual(2, parse_metadata.call_count)
+        self.assertEqual(mtime, Path('metadata/b.yml').stat().st_mtime_ns)
+        self.assertIn('AutoUpdateMode: None', Path('metadata/a.yml').read_text())
+
+        # the cache knows both files are properly formatted now
+        with mock.patch('sys.argv', ['fdroid rewritemeta', '--jobs', '1']):
+            with mock.patch('fdroidserver.metadata.parse_metadata') as parse_metadata:
+                rewritemeta.main()
+        parse_metadata.assert_not_called()
+
     @mock.patch('sys.argv', ['fdroid', 'rewritemeta', '--stdin'])
     @mock.patch('sys.stdout', new_callable=io.StringIO)
     @mock.patch('sys.stdin', io.StringIO('UpdateCheckMode: None\nAutoUpdateMode: None'))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+from fdroidserver import run_buildcycle
+
+
+class FakeBackend:
+    """Container backend that only records the steps it was asked to run."""
+
+    def __init__(self, fail=None, hang=None, delay=0):
+        self.calls = []
+        self.fail = fail or dict()
+        self.hang = hang or set()
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def _step(self, step, appid, vercode, timeout):
+        with self._lock:
+            self.calls.append((step, appid, vercode))
+        if (appid, step) in self.hang:
+            raise subprocess.TimeoutExpired(step, timeout)
+        if self.fail.get((appid, step), 0) > 0:
+            self.fail[(appid, step)] -= 1
+            raise RuntimeError(f'{step} failed')
+
+    def up(self, appid, vercode, timeout):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self._step('up', appid, vercode, timeout)
+        time.sleep(self.delay)
+
+    def push(self, appid, vercode, timeout):
+        self._step('push', appid, vercode, timeout)
+
+    def build(self, appid, vercode, timeout):
+        self._step('build', appid, vercode, timeout)
+
+    def pull(self, appid, vercode, timeout):
+        self._step('pull', appid, vercode, timeout)
+
+    def destroy(self, appid, vercode, timeout):
+        with self._lock:
+            self.running -= 1
+        self._step('destroy', appid, vercode, timeout)
+
+
+SCHEDULE = [
+    {'applicationId': 'com.example.a', 'versionCode': 1, 'timeout': 60},
+    {'applicationId': 'com.example.b', 'versionCode': 2, 'timeout': 60},
+    {'applicationId': 'com.example.c', 'versionCode': 3},
+]
+
+
+class BuildCycleRunnerTest(unittest.TestCase):
+    def _run(self, backend, **kwargs):
+        self.stream = io.StringIO()
+        runner = run_buildcycle.BuildCycleRunner(
+            backend, stream=self.stream, backoff=0, **kwargs
+        )
+        return runner.run(SCHEDULE)
+
+    def _events(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_all_steps(self):
+        backend = FakeBackend()
+        results = self._run(backend)
+        self.assertEqual(
+            ['up', 'push', 'build', 'pull', 'destroy'],
+            [c[0] for c in backend.calls if c[1] == 'com.example.a'],
+        )
+        self.assertEqual({'success'}, {r['status'] for r in results.values()})
+        events = self._events()
+        self.assertEqual(3, len([e for e in events if e['event'] == 'queued']))
+        self.assertEqual(3, len([e for e in events if e['event'] == 'success']))
+
+    def test_concurrent(self):
+        backend = FakeBackend(delay=0.1)
+        self._run(backend, jobs=3)
+        self.assertEqual(3, backend.max_running)
+
+    def test_jobs_limit(self):
+        backend = FakeBackend(delay=0.05)
+        self._run(backend, jobs=2)
+        self.assertEqual(2, backend.max_running)
+
+    def test_failure_destroys(self):
+        backend = FakeBackend(fail={('com.example.b', 'build'): 1})
+        results = self._run(backend)
+        self.assertEqual('failure', results['com.example.b:2']['status'])
+        self.assertIn('build', results['com.example.b:2']['error'])
+        self.assertIn(('destroy', 'com.example.b', 2), backend.calls)
+        self.assertNotIn(('pull', 'com.example.b', 2), backend.calls)
+
+    def test_retry(self):
+        backend = FakeBackend(fail={('com.example.b', 'push'): 1})
+        results = self._run(backend, retries=1)
+        self.assertEqual('success', results['com.example.b:2']['status'])
+        self.assertEqual(2, results['com.example.b:2']['attempts'])
+        self.assertEqual(1, len([e for e in self._events() if e['event'] == 'retry']))
+
+    def test_timeout_not_retried(self):
+        backend = FakeBackend(hang={('com.example.a', 'build')})
+        results = self._run(backend, retries=3)
+        self.assertEqual('timeout', results['com.example.a:1']['status'])
+        self.assertEqual(1, results['com.example.a:1']['attempts'])
+
+    @mock.patch('subprocess.run')
+    def test_subprocess_backend(self, subprocess_run):
+        backend = run_buildcycle.SubprocessBackend('podman')
+        backend.build('com.example', 123, 60)
+        cmd = subprocess_run.call_args[0][0]
+        self.assertEqual(
+            ['exec', '--virt-container-type', 'podman', 'com.example:123'],
+            cmd[3:7],
+        )
+        self.assertEqual(60, subprocess_run.call_args[1]['timeout'])
+        self.assertIs(sys.stderr, subprocess_run.call_args[1]['stdout'])
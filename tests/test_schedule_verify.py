@@ -33,7 +33,7 @@ FULL_LIST = [
 ]
 
 
-def _mock(repo):  # pylint: disable=unused-argument
+def _mock(repo, **kwargs):  # pylint: disable=unused-argument
     indexf = basedir / 'repo' / 'index-v2.json'
     return json.loads(indexf.read_text()), None
 
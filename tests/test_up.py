@@ -109,6 +109,255 @@ class Up_run_fake_podman(UpTest):
         mock_client_ping.assert_called_once()
 
 
+@skipIf(importlib.util.find_spec("podman") is None, 'Requires podman-py to run.')
+class Up_podman_container_lookup(UpTest):
+    def setUp(self):
+        super().setUp()
+        self.client = mock.Mock()
+        self.container = mock.Mock()
+        self.container.name = common.get_container_name(APPID, VERCODE)
+        self.container.id = 'abcdef0123456789'
+        self.container.image.tags = [common.PODMAN_BUILDSERVER_IMAGE]
+
+    def test_lookup_by_stored_id(self):
+        common.set_podman_container_id(APPID, VERCODE, self.container.id)
+        self.client.containers.get.return_value = self.container
+        with mock.patch('fdroidserver.common.get_podman_client', lambda: self.client):
+            self.assertEqual(
+                self.container, common.get_podman_container(APPID, VERCODE)
+            )
+        self.client.containers.get.assert_called_once_with(self.container.id)
+        self.client.containers.list.assert_not_called()
+
+    def test_lookup_by_name_stores_id(self):
+        self.client.containers.get.return_value = self.container
+        with mock.patch('fdroidserver.common.get_podman_client', lambda: self.client):
+            common.get_podman_container(APPID, VERCODE)
+        self.client.containers.get.assert_called_once_with(self.container.name)
+        self.assertEqual(
+            self.container.id,
+            common.get_podman_container_id_path(APPID, VERCODE).read_text(),
+        )
+
+    def test_not_found(self):
+        from podman.errors import NotFound
+
+        common.set_podman_container_id(APPID, VERCODE, 'stale')
+        self.client.containers.get.side_effect = NotFound('not found')
+        with mock.patch('fdroidserver.common.get_podman_client', lambda: self.client):
+            with self.assertRaises(exception.BuildException):
+                common.get_podman_container(APPID, VERCODE)
+        self.assertFalse(common.get_podman_container_id_path(APPID, VERCODE).exists())
+
+    def test_wrong_image(self):
+        self.container.image.tags = ['debian:latest']
+        self.client.containers.get.return_value = self.container
+        with mock.patch('fdroidserver.common.get_podman_client', lambda: self.client):
+            with self.assertRaises(exception.BuildException):
+                common.get_podman_container(APPID, VERCODE)
+
+
+class Up_podman_pool(UpTest):
+    def setUp(self):
+        super().setUp()
+        common.config = {'cachedir': self.testdir, 'podman_warm_pool_size': 2}
+        patcher = mock.patch('os.cpu_count', return_value=8)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock()
+        self.image = mock.Mock()
+        self.image.id = 'image0'
+
+    def _pooled(self, name, image_id='image0', cpus=2, memory=1024, status='running'):
+        c = mock.Mock()
+        c.name = name
+        c.image.id = image_id
+        c.labels = up.get_podman_resource_labels(cpus, memory)
+        c.status = status
+        c.attrs = {'Pod': f'{name}_pod_id'}
+        return c
+
+    def test_claim(self):
+        c = self._pooled('fdroid_pool_b')
+        self.client.containers.list.return_value = [
+            self._pooled('fdroid_pool_a', image_id='old'),
+            self._pooled('fdroid_pool_c', memory=2048),
+            self._pooled('fdroid_pool_d', cpus=4),
+            c,
+        ]
+        self.assertEqual(
+            c,
+            up.claim_podman_pool_container(
+                self.client, self.image, APPID, VERCODE, 2, 1024
+            ),
+        )
+        c.rename.assert_called_once_with(common.get_container_name(APPID, VERCODE))
+
+    def test_claim_skips_claimed(self):
+        # the pool label stays on claimed containers, only the name changes
+        self.client.containers.list.return_value = [
+            self._pooled(common.get_container_name('com.example', 1))
+        ]
+        self.assertIsNone(
+            up.claim_podman_pool_container(
+                self.client, self.image, APPID, VERCODE, 2, 1024
+            )
+        )
+
+    def test_claim_empty(self):
+        self.client.containers.list.return_value = [
+            self._pooled('fdroid_pool_a', status='exited')
+        ]
+        self.assertIsNone(
+            up.claim_podman_pool_container(
+                self.client, self.image, APPID, VERCODE, 2, 1024
+            )
+        )
+
+    @mock.patch('fdroidserver.up.create_podman_container')
+    @mock.patch('fdroidserver.up.get_podman_buildserver_image')
+    def test_fill(self, get_podman_buildserver_image, create_podman_container):
+        get_podman_buildserver_image.return_value = self.image
+        outdated = self._pooled('fdroid_pool_a', image_id='old')
+        self.client.containers.list.return_value = [
+            outdated,
+            self._pooled('fdroid_pool_b'),
+            self._pooled(common.get_container_name('com.example', 1)),
+        ]
+        with mock.patch('fdroidserver.common.get_podman_client', lambda: self.client):
+            up.fill_podman_pool(cpus=2, memory=1024)
+        self.client.pods.get.assert_called_once_with(outdated.attrs['Pod'])
+        create_podman_container.assert_called_once()
+        self.assertTrue(
+            create_podman_container.call_args[0][2].startswith(
+                up.PODMAN_POOL_NAME_PREFIX
+            )
+        )
+        self.assertEqual(
+            '2', create_podman_container.call_args[1]['labels'][up.PODMAN_CPUS_LABEL]
+        )
+
+    @mock.patch('fdroidserver.up.create_podman_container')
+    @mock.patch('fdroidserver.up.get_podman_buildserver_image')
+    def test_fill_makes_room(
+        self, get_podman_buildserver_image, create_podman_container
+    ):
+        get_podman_buildserver_image.return_value = self.image
+        other = self._pooled('fdroid_pool_a', memory=2048)
+        self.client.containers.list.return_value = [
+            other,
+            self._pooled('fdroid_pool_b', memory=2048),
+        ]
+        with mock.patch('fdroidserver.common.get_podman_client', lambda: self.client):
+            up.fill_podman_pool(size=2, cpus=2, memory=1024)
+        # one was used up, so one is replaced with the requested size
+        self.client.pods.get.assert_called_once_with(other.attrs['Pod'])
+        self.assertEqual(1, create_podman_container.call_count)
+        self.assertEqual(
+            str(1024),
+            create_podman_container.call_args[1]['labels'][up.PODMAN_MEMORY_LABEL],
+        )
+
+    @mock.patch('sys.argv', ['fdroid up', '--fill-pool'])
+    @mock.patch('fdroidserver.up.fill_podman_pool')
+    def test_main_fill_pool(self, fill_podman_pool):
+        up.main()
+        fill_podman_pool.assert_called_once()
+
+    @mock.patch('subprocess.Popen')
+    def test_spawn_fill(self, popen):
+        up.spawn_fill_podman_pool(cpus='4', memory=str(8 * 1024**3))
+        self.assertEqual(
+            ['up', '--fill-pool', '--cpus', '4', '--memory', str(8 * 1024**3)],
+            popen.call_args[0][0][3:],
+        )
+
+    @mock.patch('subprocess.Popen')
+    def test_spawn_fill_disabled(self, popen):
+        common.config['podman_warm_pool_size'] = 0
+        up.spawn_fill_podman_pool()
+        popen.assert_not_called()
+
+
+class Up_podman_resources(UpTest):
+    def setUp(self):
+        super().setUp()
+        common.config = {'cachedir': self.testdir}
+        self.ledgerpath = Path(self.testdir) / 'podman_resources.json'
+        self.ledger_class = up.PodmanResourceLedger
+
+    def _ledger(self):
+        return self.ledger_class(self.ledgerpath, 8, 16 * 1024**3)
+
+    def test_reserve_and_release(self):
+        with self._ledger() as ledger:
+            self.assertEqual('0,1,2,3', ledger.reserve('a', 1, 4, 1024**3, 60))
+            self.assertEqual('4,5', ledger.reserve('b', 1, 2, 1024**3, 60))
+            self.assertFalse(ledger.fits(4, 1024**3))
+            self.assertTrue(ledger.fits(2, 1024**3))
+        with self._ledger() as ledger:
+            self.assertEqual(2, ledger.get_free_cpus())
+            ledger.release('a', 1)
+            self.assertEqual('0,1,2,3', ledger.pick_cpuset(4))
+            self.assertEqual(1, len(ledger.data['history']['a']))
+
+    def test_expired(self):
+        with self._ledger() as ledger:
+            ledger.reserve('a', 1, 8, 1024**3, -1)
+        with self.assertLogs(level='WARNING'):
+            with self._ledger() as ledger:
+                self.assertEqual(8, ledger.get_free_cpus())
+
+    def test_estimate_wait_from_history(self):
+        with self._ledger() as ledger:
+            ledger.data['history']['a'] = [100, 200, 300]
+            ledger.reserve('a', 1, 8, 1024**3, 3600)
+            self.assertTrue(190 < ledger.estimate_wait() <= 200)
+
+    @mock.patch('fdroidserver.up.PodmanResourceLedger')
+    def test_reserve_no_wait(self, PodmanResourceLedger):
+        PodmanResourceLedger.side_effect = self._ledger
+        up.reserve_podman_resources('a', 1, 8, 1024**3, 60)
+        with self.assertRaises(exception.BuildException):
+            up.reserve_podman_resources('b', 1, 1, 1024**3, 60, wait=False)
+
+    @mock.patch('fdroidserver.up.PodmanResourceLedger')
+    def test_reserve_too_big(self, PodmanResourceLedger):
+        PodmanResourceLedger.side_effect = self._ledger
+        with self.assertRaises(exception.BuildException):
+            up.reserve_podman_resources('a', 1, 1, 32 * 1024**3, 60)
+
+    @mock.patch('fdroidserver.up.release_podman_resources')
+    @mock.patch('fdroidserver.up.reserve_podman_resources', return_value='0')
+    @mock.patch('fdroidserver.up.create_podman_container')
+    @mock.patch('fdroidserver.up.get_podman_buildserver_image')
+    @mock.patch('fdroidserver.common.get_podman_client')
+    def test_run_podman_failed_start_releases(
+        self, get_podman_client, get_image, create, reserve, release
+    ):
+        common.config['podman_admission_control'] = True
+        get_podman_client.return_value.containers.exists.return_value = False
+        get_podman_client.return_value.pods.exists.return_value = False
+        create.return_value.id = 'abc'
+        create.return_value.status = 'exited'
+        with self.assertRaises(exception.BuildException):
+            up.run_podman(APPID, VERCODE, 1, 1024**3)
+        release.assert_called_once_with(APPID, VERCODE)
+
+    def test_get_podman_cpu_kwargs(self):
+        kwargs = up.get_podman_cpu_kwargs(2, '0,1')
+        self.assertEqual(2 * kwargs['cpu_period'], kwargs['cpu_quota'])
+        self.assertEqual(2048, kwargs['cpu_shares'])
+        self.assertEqual('0,1', kwargs['cpuset_cpus'])
+        self.assertNotIn('cpuset_cpus', up.get_podman_cpu_kwargs(1))
+
+    def test_get_build_timeout_default(self):
+        self.assertEqual(
+            up.schedule_buildcycle.DEFAULT_BUILD_TIMEOUT,
+            up.get_build_timeout(APPID, VERCODE),
+        )
+
+
 @skipIf(importlib.util.find_spec("vagrant") is None, 'Requires python-vagrant to run.')
 class Up_run_vagrant(UpTest):
     def setUp(self):